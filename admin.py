@@ -1,12 +1,28 @@
-from datetime import timedelta
+from datetime import datetime, timedelta
+import hmac
 import os
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session as flask_session
+from sqlalchemy import tuple_
+from flask import Blueprint, render_template, request, redirect, url_for, flash, Response, session as flask_session
 from werkzeug.security import generate_password_hash, check_password_hash
 
 from models import ChipCreation, AiRequestLog
+from render_cache import render_cache, layout_cache
+from render_executor import render_executor
+from render_sessions import render_sessions
+from log_writer import log_writer
+from ai_service import openai_clients, model_list_cache, ai_stream_bridge
+from prompt_index import prompt_stats
+from generation_cache import generation_cache
+from generation_policy import policy_stats
+from metrics import metrics, ai_model_summary
+from content_store import attach_texts, blob_stats
+from retention import log_archiver
+from admission import ai_admission
 
 ADMIN_USERNAME = os.environ.get("ADMIN_USER", "admin")
 ADMIN_PASSWORD_HASH = generate_password_hash(os.environ.get("ADMIN_PASS", "adminpass"), method='pbkdf2:sha256')
+# Prometheus 抓取 /admin/metrics 时使用的 Bearer Token；为空时只能用管理员会话访问
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin', template_folder='templates/admin')
 
@@ -56,25 +72,120 @@ def admin_required(f):
 @admin_bp.route('/dashboard')
 @admin_required
 def dashboard():
-    total_chip_creations = ChipCreation.query.count()
-    total_ai_requests = AiRequestLog.query.count()
-    successful_ai_requests = AiRequestLog.query.filter_by(succeeded=True).count()
-    return render_template('dashboard.html', total_chips=total_chip_creations, total_ai=total_ai_requests, successful_ai=successful_ai_requests)
+    # 总数来自随日志批量写入维护的计数行（见 log_writer.count_rows），不再对日志表做 COUNT 扫描
+    counters = log_writer.counter_values()
+    return render_template('dashboard.html', total_chips=counters.get('chip_creations', 0), total_ai=counters.get('ai_requests', 0),
+                           successful_ai=counters.get('ai_requests_succeeded', 0),
+                           render_cache_stats=render_cache.stats(), layout_cache_stats=layout_cache.stats(),
+                           render_pool_stats=render_executor.stats(),
+                           render_session_stats=render_sessions.stats(),
+                           log_writer_stats=log_writer.stats(),
+                           openai_client_stats=openai_clients.stats(),
+                           model_list_stats=model_list_cache.stats(),
+                           prompt_size_stats=prompt_stats.stats(),
+                           generation_cache_stats=generation_cache.stats(),
+                           ai_stream_stats=ai_stream_bridge.stats(),
+                           generation_policy_stats=policy_stats.stats(),
+                           ai_model_stats=ai_model_summary(),
+                           content_blob_stats=blob_stats(),
+                           retention_stats=log_archiver.stats(),
+                           admission_stats=ai_admission.stats())
+
+
+def _component_stats():
+    return {
+        "render_cache": render_cache.stats(),
+        "layout_cache": layout_cache.stats(),
+        "render_pool": render_executor.stats(),
+        "render_sessions": render_sessions.stats(),
+        "log_writer": log_writer.stats(),
+        "openai_clients": openai_clients.stats(),
+        "model_list_cache": model_list_cache.stats(),
+        "prompt": prompt_stats.stats(),
+        "generation_cache": generation_cache.stats(),
+        "ai_streams": ai_stream_bridge.stats(),
+        "generation_policy": policy_stats.stats(),
+        "retention": log_archiver.stats(),
+        "admission": ai_admission.stats(),
+    }
+
+
+def _metrics_token_ok():
+    if not METRICS_TOKEN:
+        return False
+    header = request.headers.get('Authorization', '')
+    return header.startswith('Bearer ') and hmac.compare_digest(header[7:].strip(), METRICS_TOKEN)
+
+
+@admin_bp.route('/metrics')
+def metrics_route():
+    """Prometheus 文本格式的指标（当前 worker 进程）。需要管理员会话，或 Authorization: Bearer <METRICS_TOKEN>。"""
+    if not (is_admin_logged_in() or _metrics_token_ok()):
+        return Response("unauthorized\n", status=401, mimetype='text/plain')
+    return Response(metrics.render(_component_stats()), content_type='text/plain; version=0.0.4; charset=utf-8',
+                    headers={"Cache-Control": "no-store"})
+
+
+PER_PAGE = 20
+_CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def _encode_cursor(row):
+    return f"{row.created_at.strftime(_CURSOR_TIME_FORMAT)}~{row.id}"
+
+
+def _decode_cursor(value):
+    if not value:
+        return None
+    try:
+        created_at, row_id = value.split('~', 1)
+        return datetime.strptime(created_at, _CURSOR_TIME_FORMAT), int(row_id)
+    except ValueError:
+        return None
+
+
+def keyset_page(query, model, per_page=PER_PAGE):
+    """
+    按 (created_at, id) 倒序的游标分页：?before=游标 取更早的一页，?after=游标 取更新的一页。
+    走 created_at 索引，不用 OFFSET，也不做 COUNT，翻到多深都只读一页的行。
+    """
+    key = tuple_(model.created_at, model.id)
+    after = _decode_cursor(request.args.get('after'))
+    before = _decode_cursor(request.args.get('before'))
+    if after is not None:
+        rows = query.filter(key > tuple_(*after)).order_by(model.created_at.asc(), model.id.asc()).limit(per_page + 1).all()
+        has_newer = len(rows) > per_page
+        rows = rows[:per_page][::-1]
+        has_older = True
+    else:
+        if before is not None:
+            query = query.filter(key < tuple_(*before))
+        rows = query.order_by(model.created_at.desc(), model.id.desc()).limit(per_page + 1).all()
+        has_older = len(rows) > per_page
+        rows = rows[:per_page]
+        has_newer = before is not None
+    return {
+        "items": rows,
+        "newer_cursor": _encode_cursor(rows[0]) if rows and has_newer else None,
+        "older_cursor": _encode_cursor(rows[-1]) if rows and has_older else None,
+    }
 
 
 @admin_bp.route('/chip_creations')
 @admin_required
 def chip_creations_list():
-    page = request.args.get('page', 1, type=int)
-    per_page = 20
-    creations = ChipCreation.query.order_by(ChipCreation.created_at.desc()).paginate(page=page, per_page=per_page, error_out=False)
-    return render_template('chip_creations.html', creations=creations)
+    username = request.args.get('username', '').strip()
+    query = ChipCreation.query.filter_by(username=username) if username else ChipCreation.query
+    creations = keyset_page(query, ChipCreation)
+    attach_texts(creations["items"])
+    return render_template('chip_creations.html', creations=creations, username=username)
 
 
 @admin_bp.route('/ai_requests')
 @admin_required
 def ai_requests_list():
-    page = request.args.get('page', 1, type=int)
-    per_page = 20
-    ai_logs = AiRequestLog.query.order_by(AiRequestLog.created_at.desc()).paginate(page=page, per_page=per_page, error_out=False)
-    return render_template('ai_requests.html', ai_logs=ai_logs)
+    username = request.args.get('username', '').strip()
+    query = AiRequestLog.query.filter_by(username=username) if username else AiRequestLog.query
+    ai_logs = keyset_page(query, AiRequestLog)
+    attach_texts(ai_logs["items"])
+    return render_template('ai_requests.html', ai_logs=ai_logs, username=username)
@@ -0,0 +1,289 @@
+# admission.py
+"""
+AI 生成请求的准入控制：按用户的令牌桶限速 + 每用户 / 全局并发流上限。
+
+状态放在 instance/limiter.db（独立的 SQLite 文件，WAL 模式，不与业务库争锁），所有 gunicorn worker 共享；
+每次检查都是一个 BEGIN IMMEDIATE 事务里的读-改-写，跨进程也是原子的。
+- 令牌桶：每个用户每分钟补充 AI_RATE_PER_MINUTE 个令牌，最多攒 AI_RATE_BURST 个，没有令牌时立即 429（带 Retry-After）；
+- 每个用户进行中 + 排队中的流不超过 AI_MAX_STREAMS_PER_USER，超出立即 429；
+- 全局进行中的流不超过 AI_MAX_STREAMS_GLOBAL，超出时先到先得地排队，SSE 中推送 queued 事件告知位置；
+  排队人数达到 AI_ADMISSION_QUEUE_MAX 时 429，等待超过 AI_ADMISSION_QUEUE_TIMEOUT 秒返回错误事件。
+槽位在流结束（包括客户端断开）时释放；客户端断开后仍在后台跑完的上游生成通过 hold() 继续占着槽位，
+直到它也调用 release()。崩溃进程留下的槽位按 pid 是否存活和 AI_SLOT_MAX_AGE 回收。
+limiter.db 出错时放行请求（fail open），只打印日志。
+"""
+import math
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from utils import INSTANCE_FOLDER_PATH
+
+AI_ADMISSION_ENABLED = os.environ.get("AI_ADMISSION", "1") != "0"
+AI_RATE_PER_MINUTE = float(os.environ.get("AI_RATE_PER_MINUTE", "10"))
+AI_RATE_BURST = float(os.environ.get("AI_RATE_BURST", "5"))
+AI_MAX_STREAMS_PER_USER = int(os.environ.get("AI_MAX_STREAMS_PER_USER", "2"))
+AI_MAX_STREAMS_GLOBAL = int(os.environ.get("AI_MAX_STREAMS_GLOBAL", "64"))
+AI_ADMISSION_QUEUE_MAX = int(os.environ.get("AI_ADMISSION_QUEUE_MAX", "64"))
+AI_ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("AI_ADMISSION_QUEUE_TIMEOUT", "60"))
+AI_ADMISSION_POLL = float(os.environ.get("AI_ADMISSION_POLL", "0.5"))
+AI_SLOT_MAX_AGE = float(os.environ.get("AI_SLOT_MAX_AGE", "900"))
+AI_LIMITER_DB = os.environ.get("AI_LIMITER_DB") or os.path.join(INSTANCE_FOLDER_PATH, 'limiter.db')
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS bucket (username TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS slot (id TEXT PRIMARY KEY, username TEXT NOT NULL, pid INTEGER NOT NULL, acquired REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS waiting (id TEXT PRIMARY KEY, username TEXT NOT NULL, enqueued REAL NOT NULL, heartbeat REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS ix_slot_username ON slot (username)",
+    "CREATE INDEX IF NOT EXISTS ix_waiting_enqueued ON waiting (enqueued, id)",
+)
+
+
+class AdmissionRejected(Exception):
+    """请求被拒绝（路由返回 429）。"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+class AdmissionTimeout(Exception):
+    """排队超时。"""
+
+
+class Ticket:
+    def __init__(self, ticket_id, username, position, enqueued=None):
+        self.id = ticket_id  # None 表示未受管控（准入关闭或 limiter.db 不可用）
+        self.username = username
+        self.position = position  # 0 表示已占到槽位，否则为排队位置（从 1 开始）
+        self.enqueued = enqueued
+        self.holders = 1  # 还需要调用 release() 的次数，见 AIAdmission.hold
+        self.lock = threading.Lock()
+
+
+def _pid_alive(pid):
+    if os.name == 'nt':
+        return True  # Windows 上 os.kill(pid, 0) 会发送 CTRL_C_EVENT，只依赖 AI_SLOT_MAX_AGE 回收
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class AdmissionController:
+    def __init__(self, db_path=AI_LIMITER_DB, enabled=AI_ADMISSION_ENABLED, rate_per_minute=AI_RATE_PER_MINUTE,
+                 burst=AI_RATE_BURST, per_user=AI_MAX_STREAMS_PER_USER, global_max=AI_MAX_STREAMS_GLOBAL,
+                 queue_max=AI_ADMISSION_QUEUE_MAX, queue_timeout=AI_ADMISSION_QUEUE_TIMEOUT,
+                 poll_interval=AI_ADMISSION_POLL, slot_max_age=AI_SLOT_MAX_AGE):
+        self.db_path = db_path
+        self.enabled = enabled
+        self.rate_per_second = rate_per_minute / 60.0
+        self.burst = max(1.0, burst)
+        self.per_user = max(1, per_user)
+        self.global_max = max(1, global_max)
+        self.queue_max = max(0, queue_max)
+        self.queue_timeout = queue_timeout
+        self.poll_interval = max(0.05, poll_interval)
+        self.slot_max_age = slot_max_age
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._cleaned_pid = None
+        self.admitted = 0
+        self.queued = 0
+        self.rejected_rate = 0
+        self.rejected_concurrency = 0
+        self.rejected_queue_full = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def _count(self, field):
+        with self._stats_lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def _connection(self):
+        # 每个线程一个连接；fork 后子进程重新连接
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in _SCHEMA:
+            conn.execute(statement)
+        if self._cleaned_pid != os.getpid():
+            # 新进程可能复用了之前某个已退出进程的 pid，它留下的槽位不可能属于本进程
+            conn.execute("DELETE FROM slot WHERE pid = ?", (os.getpid(),))
+            self._cleaned_pid = os.getpid()
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _reap(self, conn, now):
+        pids = [row[0] for row in conn.execute("SELECT DISTINCT pid FROM slot")]
+        dead = [pid for pid in pids if not _pid_alive(pid)]
+        if dead:
+            conn.execute(f"DELETE FROM slot WHERE pid IN ({','.join('?' * len(dead))})", dead)
+        conn.execute("DELETE FROM slot WHERE acquired < ?", (now - self.slot_max_age,))
+        # 排队者每次轮询都会更新心跳，长时间没有更新说明其进程已不在
+        conn.execute("DELETE FROM waiting WHERE heartbeat < ?", (now - max(5.0, self.poll_interval * 10),))
+
+    def _take_token(self, conn, username, now):
+        """取一个令牌，返回 0；没有令牌时返回需要等待的秒数（不修改桶）。"""
+        if self.rate_per_second <= 0:
+            return 0
+        row = conn.execute("SELECT tokens, updated FROM bucket WHERE username = ?", (username,)).fetchone()
+        tokens = self.burst if row is None else min(self.burst, row[0] + (now - row[1]) * self.rate_per_second)
+        if tokens < 1:
+            return (1 - tokens) / self.rate_per_second
+        conn.execute("INSERT OR REPLACE INTO bucket (username, tokens, updated) VALUES (?, ?, ?)", (username, tokens - 1, now))
+        return 0
+
+    def admit(self, username):
+        """
+        限速和每用户上限检查。通过时返回 Ticket：能立即占到槽位时 position 为 0，否则已进入队列（需要 wait_turn）。
+        被拒绝时抛出 AdmissionRejected（此时不消耗令牌）。
+        """
+        if not self.enabled:
+            return Ticket(None, username, 0)
+        now = time.time()
+        try:
+            with self._transaction() as conn:
+                self._reap(conn, now)
+                user_streams = (conn.execute("SELECT COUNT(*) FROM slot WHERE username = ?", (username,)).fetchone()[0]
+                                + conn.execute("SELECT COUNT(*) FROM waiting WHERE username = ?", (username,)).fetchone()[0])
+                if user_streams >= self.per_user:
+                    self._count('rejected_concurrency')
+                    raise AdmissionRejected(f"您已有 {user_streams} 个AI生成在进行或排队中，请等待完成后再试。", 5)
+                wait = self._take_token(conn, username, now)
+                if wait:
+                    self._count('rejected_rate')
+                    raise AdmissionRejected(f"请求过于频繁，请在 {int(math.ceil(wait))} 秒后再试。", wait)
+                ticket_id = uuid.uuid4().hex
+                active = conn.execute("SELECT COUNT(*) FROM slot").fetchone()[0]
+                waiting = conn.execute("SELECT COUNT(*) FROM waiting").fetchone()[0]
+                if waiting == 0 and active < self.global_max:
+                    conn.execute("INSERT INTO slot (id, username, pid, acquired) VALUES (?, ?, ?, ?)",
+                                 (ticket_id, username, os.getpid(), now))
+                    self._count('admitted')
+                    return Ticket(ticket_id, username, 0)
+                if waiting >= self.queue_max:
+                    self._count('rejected_queue_full')
+                    raise AdmissionRejected("服务器繁忙：排队的AI生成请求过多，请稍后再试。", 10)
+                conn.execute("INSERT INTO waiting (id, username, enqueued, heartbeat) VALUES (?, ?, ?, ?)",
+                             (ticket_id, username, now, now))
+                self._count('queued')
+                return Ticket(ticket_id, username, waiting + 1, enqueued=now)
+        except sqlite3.Error as e:
+            self._count('errors')
+            print(f"准入控制不可用，直接放行: {e}")
+            return Ticket(None, username, 0)
+
+    def wait_turn(self, ticket):
+        """排队等待槽位：每次轮询产出当前位置，占到槽位后正常结束；超时抛出 AdmissionTimeout（已离开队列）。"""
+        deadline = ticket.enqueued + self.queue_timeout
+        while True:
+            now = time.time()
+            timed_out = False
+            try:
+                with self._transaction() as conn:
+                    self._reap(conn, now)
+                    if conn.execute("UPDATE waiting SET heartbeat = ? WHERE id = ?", (now, ticket.id)).rowcount == 0:
+                        # 被当成失联清理掉了（例如进程长时间卡住），重新排到队尾
+                        conn.execute("INSERT INTO waiting (id, username, enqueued, heartbeat) VALUES (?, ?, ?, ?)",
+                                     (ticket.id, ticket.username, now, now))
+                        ticket.enqueued = now
+                    enqueued = conn.execute("SELECT enqueued FROM waiting WHERE id = ?", (ticket.id,)).fetchone()[0]
+                    position = conn.execute("SELECT COUNT(*) FROM waiting WHERE enqueued < ? OR (enqueued = ? AND id <= ?)",
+                                            (enqueued, enqueued, ticket.id)).fetchone()[0]
+                    free = self.global_max - conn.execute("SELECT COUNT(*) FROM slot").fetchone()[0]
+                    if position <= free:
+                        conn.execute("DELETE FROM waiting WHERE id = ?", (ticket.id,))
+                        conn.execute("INSERT INTO slot (id, username, pid, acquired) VALUES (?, ?, ?, ?)",
+                                     (ticket.id, ticket.username, os.getpid(), now))
+                        ticket.position = 0
+                        self._count('admitted')
+                        return
+                    if now >= deadline:
+                        conn.execute("DELETE FROM waiting WHERE id = ?", (ticket.id,))
+                        timed_out = True
+            except sqlite3.Error as e:
+                self._count('errors')
+                print(f"准入控制不可用，直接放行: {e}")
+                ticket.id = None
+                ticket.position = 0
+                return
+            if timed_out:
+                self._count('timeouts')
+                ticket.id = None
+                raise AdmissionTimeout(f"排队等待超过 {self.queue_timeout:g} 秒，请稍后再试。")
+            ticket.position = position
+            yield position
+            time.sleep(self.poll_interval)
+
+    def hold(self, ticket):
+        """多一个持有者：槽位要等每个持有者都调用过 release() 才释放。"""
+        with ticket.lock:
+            ticket.holders += 1
+
+    def release(self, ticket):
+        """释放槽位或离开队列（流结束、出错或客户端断开时调用）；还有其它持有者时只减少计数。"""
+        with ticket.lock:
+            ticket.holders -= 1
+            if ticket.holders > 0:
+                return
+        if ticket.id is None:
+            return
+        try:
+            with self._transaction() as conn:
+                conn.execute("DELETE FROM slot WHERE id = ?", (ticket.id,))
+                conn.execute("DELETE FROM waiting WHERE id = ?", (ticket.id,))
+        except sqlite3.Error as e:
+            self._count('errors')
+            print(f"释放准入槽位失败（将按进程存活/超时回收）: {e}")
+        ticket.id = None
+
+    def stats(self):
+        active = waiting = None
+        if self.enabled:
+            try:
+                conn = self._connection()
+                active = conn.execute("SELECT COUNT(*) FROM slot").fetchone()[0]
+                waiting = conn.execute("SELECT COUNT(*) FROM waiting").fetchone()[0]
+            except sqlite3.Error:
+                pass
+        with self._stats_lock:
+            return {
+                "enabled": self.enabled,
+                "active": active,
+                "waiting": waiting,
+                "global_max": self.global_max,
+                "admitted": self.admitted,
+                "queued": self.queued,
+                "rejected": self.rejected_rate + self.rejected_concurrency + self.rejected_queue_full,
+                "rejected_rate": self.rejected_rate,
+                "rejected_concurrency": self.rejected_concurrency,
+                "rejected_queue_full": self.rejected_queue_full,
+                "timeouts": self.timeouts,
+                "errors": self.errors,
+            }
+
+
+ai_admission = AdmissionController()
@@ -1,27 +1,46 @@
 # ai_service.py
+import hashlib
 import openai
 import json
 import os
 import traceback
 
-SILICONFLOW_BASE_URL = "https://api.siliconflow.cn/v1"
+from openai_clients import OpenAIClientRegistry
+from model_list_cache import ModelListCache
+from async_bridge import AsyncStreamBridge
+from generation_policy import retrying_stream, ahedged_stream
+from stream_json import StreamMeta
+from prompt_index import (
+    PROMPT_RETRIEVAL, PROMPT_SECTION_BUDGET, PROMPT_MAX_SECTIONS, load_tutorial_index, estimate_tokens, prompt_stats,
+)
+
+# 任意 OpenAI 兼容的上游都可以，压测时可指向 benchmarks/mock_siliconflow.py
+SILICONFLOW_BASE_URL = os.environ.get("SILICONFLOW_BASE_URL", "https://api.siliconflow.cn/v1")
+# 按 API Key 复用的客户端（共享连接池），见 openai_clients.py；异步客户端只在 async_bridge 的事件循环中使用
+openai_clients = OpenAIClientRegistry(SILICONFLOW_BASE_URL)
+async_openai_clients = OpenAIClientRegistry(SILICONFLOW_BASE_URL, async_client=True)
+AI_ASYNC_STREAMING = os.environ.get("AI_ASYNC_STREAMING", "1") != "0"
+ai_stream_bridge = AsyncStreamBridge()
 PROMPT_TUTORIAL_FILE = os.path.join(os.path.dirname(__file__), '芯片教程_gemini优化版 - v1.0.5.txt')
 
 
+BASE_SYSTEM_PROMPT = (
+    "You are an expert AI assistant specialized in generating JSON configurations "
+    "for a chip logic diagram visualizer. Your goal is to convert a user's natural language "
+    "description of a chip's logic into a valid JSON object. "
+    "The JSON must have two top-level keys: 'nodes' and 'edges'. "
+    "Strictly adhere to the JSON structure and type definitions provided in the tutorial. "
+    "Do NOT add any explanatory text before or after the JSON object itself. "
+    "Your entire response should be ONLY the valid JSON object, starting with '{' and ending with '}'."
+)
+TUTORIAL_INTRO = "\n\nHere is a detailed guide and examples on the JSON structure you must follow:\n"
+
+
 def load_system_prompt_from_file():
     try:
         with open(PROMPT_TUTORIAL_FILE, 'r', encoding='utf-8') as f:
             tutorial_content = f.read()
-        base_system_prompt = (
-            "You are an expert AI assistant specialized in generating JSON configurations "
-            "for a chip logic diagram visualizer. Your goal is to convert a user's natural language "
-            "description of a chip's logic into a valid JSON object. "
-            "The JSON must have two top-level keys: 'nodes' and 'edges'. "
-            "Strictly adhere to the JSON structure and type definitions provided in the tutorial. "
-            "Do NOT add any explanatory text before or after the JSON object itself. "
-            "Your entire response should be ONLY the valid JSON object, starting with '{' and ending with '}'."
-        )
-        full_system_prompt = f"{base_system_prompt}\n\nHere is a detailed guide and examples on the JSON structure you must follow:\n{tutorial_content}"
+        full_system_prompt = f"{BASE_SYSTEM_PROMPT}{TUTORIAL_INTRO}{tutorial_content}"
         return full_system_prompt
     except FileNotFoundError:
         print(f"错误: 提示词教程文件 '{PROMPT_TUTORIAL_FILE}' 未找到。将使用默认提示。")
@@ -32,6 +51,26 @@ def load_system_prompt_from_file():
         return "You are an AI assistant that generates JSON for chip diagrams. Respond ONLY with the valid JSON object with 'nodes' and 'edges' keys."
 
 SYSTEM_PROMPT = load_system_prompt_from_file()
+SYSTEM_PROMPT_TOKENS = estimate_tokens(SYSTEM_PROMPT)
+# 教程章节索引：每次只发送核心规则 + 与描述相关的小节，见 prompt_index.py；建索引失败时退回完整教程
+tutorial_index = load_tutorial_index(PROMPT_TUTORIAL_FILE) if PROMPT_RETRIEVAL else None
+# 提示词版本：教程内容或检索参数变化后，生成结果缓存（generation_cache.py）里的旧结果自动失效
+PROMPT_VERSION = hashlib.sha256(
+    json.dumps([SYSTEM_PROMPT, tutorial_index is not None, PROMPT_SECTION_BUDGET, PROMPT_MAX_SECTIONS]).encode('utf-8')
+).hexdigest()[:16]
+
+
+def build_system_prompt(user_description):
+    """返回本次请求的系统提示，并记录其大小。"""
+    if tutorial_index is None:
+        prompt, sections = SYSTEM_PROMPT, []
+    else:
+        tutorial_text, sections = tutorial_index.select(user_description)
+        prompt = f"{BASE_SYSTEM_PROMPT}{TUTORIAL_INTRO}{tutorial_text}"
+    prompt_tokens = estimate_tokens(prompt)
+    prompt_stats.record(prompt_tokens, SYSTEM_PROMPT_TOKENS, len(sections))
+    print(f"AI Service (prompt): 系统提示约 {prompt_tokens} tokens（完整教程约 {SYSTEM_PROMPT_TOKENS}），选中 {len(sections)} 个小节。")
+    return prompt
 
 
 # 尝试从环境变量获取后备Key，如果应用需要即使在用户未提供Key时也能列出模型
@@ -54,9 +93,9 @@ PRESET_SILICONFLOW_MODELS = [
 DEFAULT_CHAT_MODEL = "deepseek-ai/DeepSeek-V2-Chat"
 
 
-def get_available_models(user_api_key=None):
+def fetch_available_models(user_api_key=None):
     """
-    尝试从 SiliconFlow API 获取模型列表。
+    尝试从 SiliconFlow API 获取模型列表（直接请求上游，不经缓存）。
     如果失败或用户未提供有效 key，则返回预设模型列表。
     """
     key_to_use = user_api_key or FALLBACK_API_KEY_FOR_MODELS
@@ -69,11 +108,7 @@ def get_available_models(user_api_key=None):
     error_message_str = None # 用于存储错误信息字符串
 
     try:
-        client_for_models = openai.OpenAI(
-            api_key=key_to_use,
-            base_url=SILICONFLOW_BASE_URL,
-            timeout=10.0, # 设置10秒超时
-        )
+        client_for_models = openai_clients.get(key_to_use, timeout=10.0) # 设置10秒超时
         masked_key = f"...{key_to_use[-4:]}" if len(key_to_use) > 4 else "****"
         print(f"AI Service (get_models): 正在使用 API Key (Masked: {masked_key}) 获取模型列表...")
         
@@ -88,16 +123,11 @@ def get_available_models(user_api_key=None):
                 print(f"AI Service (get_models): 从API获取到 {len(fetched_model_ids)} 个模型。")
                 # 合并API获取的列表和预设列表，确保预设的都在，并且去重
                 # 并且确保默认模型在最前面（如果存在）
-                combined_models = []
+                head = []
                 if DEFAULT_CHAT_MODEL in PRESET_SILICONFLOW_MODELS or DEFAULT_CHAT_MODEL in fetched_model_ids:
-                    combined_models.append(DEFAULT_CHAT_MODEL)
-                
-                for model_id in PRESET_SILICONFLOW_MODELS: # 先加预设
-                    if model_id not in combined_models:
-                        combined_models.append(model_id)
-                for model_id in fetched_model_ids: # 再加API获取的
-                    if model_id not in combined_models:
-                        combined_models.append(model_id)
+                    head.append(DEFAULT_CHAT_MODEL)
+                # dict.fromkeys 保序去重：先预设，再加API获取的
+                combined_models = list(dict.fromkeys(head + PRESET_SILICONFLOW_MODELS + fetched_model_ids))
                 
                 print(f"AI Service (get_models): 合并和去重后模型数量: {len(combined_models)}")
                 return combined_models, None # 返回成功获取的列表
@@ -128,6 +158,93 @@ def get_available_models(user_api_key=None):
     return PRESET_SILICONFLOW_MODELS, error_message_str
 
 
+# 按 Key 指纹缓存的模型列表，页面加载不再同步等待上游，见 model_list_cache.py
+model_list_cache = ModelListCache(fetch_available_models, PRESET_SILICONFLOW_MODELS)
+
+
+def get_available_models(user_api_key=None):
+    """
+    返回 (models, error, refreshing)。命中缓存（包括过期条目）时立即返回；
+    未命中时先返回预设列表，refreshing 为 True 表示后台正在刷新，稍后再取即可拿到完整列表。
+    """
+    return model_list_cache.get(user_api_key or FALLBACK_API_KEY_FOR_MODELS)
+
+
+# 备用模型：空字符串表示取 PRESET_SILICONFLOW_MODELS 中第一个与所选模型不同的，"none" 表示不使用备用模型
+AI_FALLBACK_MODEL = os.environ.get("AI_FALLBACK_MODEL", "").strip()
+
+
+def pick_fallback_model(primary_model):
+    if AI_FALLBACK_MODEL.lower() == "none":
+        return None
+    if AI_FALLBACK_MODEL:
+        return AI_FALLBACK_MODEL if AI_FALLBACK_MODEL != primary_model else None
+    return next((m for m in PRESET_SILICONFLOW_MODELS if m != primary_model), None)
+
+
+def metric_model_label(model):
+    """
+    指标里的模型标签。model_name 来自表单，任意取值会让 Prometheus 序列数无界增长，
+    所以只保留预设、默认/备用模型和已缓存的上游模型列表中的名字，其余归为 "other"。
+    """
+    if not model:
+        return "unknown"
+    if model in (DEFAULT_CHAT_MODEL, AI_FALLBACK_MODEL) or model in model_list_cache.known_models():
+        return model
+    return "other"
+
+
+# 生成参数（同步与异步两条路径共用）
+GENERATION_PARAMS = {
+    "max_tokens": 4096, # 确保足够生成复杂的JSON
+    "temperature": 0.2, # 较低的温度以获得更确定的输出
+    "top_p": 0.9,
+}
+# 设为 1 时请求上游在流的最后一块返回 token 用量（stream_options.include_usage）；不支持该参数的上游保持 0，
+# 此时用量按 prompt_index.estimate_tokens 估算
+if os.environ.get("AI_STREAM_USAGE", "0") == "1":
+    GENERATION_PARAMS["stream_options"] = {"include_usage": True}
+
+
+def _prepare_generation(user_description, model_name):
+    messages = [
+        {"role": "system", "content": build_system_prompt(user_description)},
+        {"role": "user", "content": user_description}
+    ]
+    model_to_use = model_name if model_name and model_name.strip() else DEFAULT_CHAT_MODEL
+    return messages, model_to_use
+
+
+def generation_error_message(e, model_to_use):
+    """把上游异常转换成返回给前端的错误信息。"""
+    if isinstance(e, openai.APIConnectionError):
+        return f"AI API 连接错误: {str(e)}"
+    if isinstance(e, openai.AuthenticationError):
+        err_body_msg = e.body.get('message', str(e)) if hasattr(e, 'body') and isinstance(e.body, dict) else str(e)
+        return f"AI 认证失败 (API Key 可能无效或模型 '{model_to_use}' 不可用): {err_body_msg}"
+    if isinstance(e, openai.RateLimitError):
+        return f"AI 速率限制错误: {str(e)}"
+    if isinstance(e, openai.APIStatusError):
+        err_body_text = e.response.text if hasattr(e, 'response') else str(e)
+        try:
+            err_detail_json = json.loads(err_body_text)
+            err_detail = err_detail_json.get("message", err_body_text)
+        except json.JSONDecodeError:
+            err_detail = err_body_text
+        return f"AI API 状态错误 (Status {e.status_code}) 使用模型 '{model_to_use}': {err_detail}"
+    traceback.print_exc()
+    return f"AI 生成时发生未知错误，模型 '{model_to_use}': {str(e)}"
+
+
+def _usage_meta(model, usage, messages, pieces):
+    """上游流结束时附带的元信息：实际模型和 token 用量（上游没有返回用量时为估算值）。"""
+    if usage is not None and getattr(usage, 'prompt_tokens', None) is not None:
+        return StreamMeta(model=model, prompt_tokens=usage.prompt_tokens,
+                          completion_tokens=usage.completion_tokens, usage_estimated=False)
+    return StreamMeta(model=model, prompt_tokens=sum(estimate_tokens(m["content"]) for m in messages),
+                      completion_tokens=estimate_tokens("".join(pieces)), usage_estimated=True)
+
+
 def generate_chip_json_stream(user_description: str, api_key: str, model_name: str = None):
     if not api_key:
         print("AI Service (generate_stream): API Key 未提供。")
@@ -136,70 +253,106 @@ def generate_chip_json_stream(user_description: str, api_key: str, model_name: s
         return
 
     try:
-        client_for_request = openai.OpenAI(
-            api_key=api_key,
-            base_url=SILICONFLOW_BASE_URL,
-            timeout=30.0, # 为生成内容设置更长的超时
-        )
+        client_for_request = openai_clients.get(api_key, timeout=30.0) # 为生成内容设置更长的超时
     except Exception as e:
         print(f"AI Service (generate_stream): 初始化OpenAI客户端失败: {e}")
         yield json.dumps({"error": f"Failed to initialize AI service client: {e}"})
         return
 
-    messages = [
-        {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "user", "content": user_description}
-    ]
-    
-    model_to_use = model_name if model_name and model_name.strip() else DEFAULT_CHAT_MODEL
+    messages, model_to_use = _prepare_generation(user_description, model_name)
     masked_key = f"...{api_key[-4:]}" if len(api_key) > 4 else "****"
     print(f"AI Service (generate_stream): 模型 '{model_to_use}', API Key (Masked: {masked_key}), 描述长度 {len(user_description)}.")
 
-    try:
+    def open_stream(model):
         stream = client_for_request.chat.completions.create(
-            model=model_to_use,
+            model=model,
             messages=messages,
             stream=True,
-            max_tokens=4096, # 确保足够生成复杂的JSON
-            temperature=0.2, # 较低的温度以获得更确定的输出
-            top_p=0.9,
+            **GENERATION_PARAMS,
         )
+        pieces = []
+        usage = None
+        started = False
         for chunk in stream:
+            usage = getattr(chunk, 'usage', None) or usage
+            if not started:
+                # 任何增量（包括推理模型的 reasoning_content）都算首个 token，重试/对冲据此判断上游已开始输出
+                started = True
+                yield StreamMeta(model=model)
             # 检查 chunk 和 choices 是否存在且不为空
             if chunk and chunk.choices and len(chunk.choices) > 0:
                 delta = chunk.choices[0].delta
                 if delta and delta.content:
-                    content_chunk = delta.content
-                    yield content_chunk # 直接 yield 字符串内容块
-            # else:
-                # print(f"AI Service (generate_stream): Received an empty or improperly structured chunk: {chunk}")
-                # 可以选择忽略或记录这些空块
-    
-    except openai.APIConnectionError as e:
-        err_msg = f"AI API 连接错误: {str(e)}"
-        print(f"AI Service (generate_stream): {err_msg}")
-        yield json.dumps({"error": err_msg})
-    except openai.AuthenticationError as e:
-        err_body_msg = e.body.get('message', str(e)) if hasattr(e, 'body') and e.body else str(e)
-        err_msg = f"AI 认证失败 (API Key 可能无效或模型 '{model_to_use}' 不可用): {err_body_msg}"
-        print(f"AI Service (generate_stream): {err_msg}")
-        yield json.dumps({"error": err_msg})
-    except openai.RateLimitError as e:
-        err_msg = f"AI 速率限制错误: {str(e)}"
-        print(f"AI Service (generate_stream): {err_msg}")
-        yield json.dumps({"error": err_msg})
-    except openai.APIStatusError as e:
-        err_body_text = e.response.text if hasattr(e, 'response') else str(e)
-        try: 
-            err_detail_json = json.loads(err_body_text)
-            err_detail = err_detail_json.get("message", err_body_text)
-        except json.JSONDecodeError:
-            err_detail = err_body_text
-        err_msg = f"AI API 状态错误 (Status {e.status_code}) 使用模型 '{model_to_use}': {err_detail}"
+                    pieces.append(delta.content)
+                    yield delta.content # 直接 yield 字符串内容块
+        yield _usage_meta(model, usage, messages, pieces)
+
+    try:
+        # 首个 token 之前的暂时性失败会重试，重试用尽后改用备用模型，见 generation_policy.py
+        yield from retrying_stream(open_stream, model_to_use, pick_fallback_model(model_to_use))
+    except Exception as e:
+        err_msg = generation_error_message(e, model_to_use)
         print(f"AI Service (generate_stream): {err_msg}")
         yield json.dumps({"error": err_msg})
+
+
+async def agenerate_chip_json_stream(user_description: str, api_key: str, model_name: str = None):
+    """generate_chip_json_stream 的异步版本，在 async_bridge 的事件循环中运行，产出相同的文本块。"""
+    if not api_key:
+        print("AI Service (generate_stream): API Key 未提供。")
+        yield json.dumps({"error": "API Key for AI service is missing."})
+        return
+
+    try:
+        client_for_request = async_openai_clients.get(api_key, timeout=30.0)
     except Exception as e:
-        err_msg = f"AI 生成时发生未知错误，模型 '{model_to_use}': {str(e)}"
-        print(f"AI Service (generate_stream): {err_msg}")
-        traceback.print_exc()
-        yield json.dumps({"error": err_msg})
\ No newline at end of file
+        print(f"AI Service (generate_stream): 初始化OpenAI客户端失败: {e}")
+        yield json.dumps({"error": f"Failed to initialize AI service client: {e}"})
+        return
+
+    messages, model_to_use = _prepare_generation(user_description, model_name)
+    masked_key = f"...{api_key[-4:]}" if len(api_key) > 4 else "****"
+    print(f"AI Service (generate_stream/async): 模型 '{model_to_use}', API Key (Masked: {masked_key}), 描述长度 {len(user_description)}.")
+
+    async def open_stream(model):
+        stream = await client_for_request.chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=True,
+            **GENERATION_PARAMS,
+        )
+        # 客户端断开或对冲落败时协程被取消，async with 负责关闭上游连接
+        pieces = []
+        usage = None
+        started = False
+        async with stream:
+            async for chunk in stream:
+                usage = getattr(chunk, 'usage', None) or usage
+                if not started:
+                    started = True
+                    yield StreamMeta(model=model)
+                if chunk and chunk.choices and len(chunk.choices) > 0:
+                    delta = chunk.choices[0].delta
+                    if delta and delta.content:
+                        pieces.append(delta.content)
+                        yield delta.content
+        yield _usage_meta(model, usage, messages, pieces)
+
+    try:
+        # 重试、对冲与备用模型，见 generation_policy.py
+        async for text in ahedged_stream(open_stream, model_to_use, pick_fallback_model(model_to_use)):
+            yield text
+    except Exception as e:
+        err_msg = generation_error_message(e, model_to_use)
+        print(f"AI Service (generate_stream/async): {err_msg}")
+        yield json.dumps({"error": err_msg})
+
+
+def stream_chip_json(user_description: str, api_key: str, model_name: str = None):
+    """
+    路由使用的入口，返回文本块的同步迭代器（上游流结束时还有一个 StreamMeta，带实际模型和 token 用量）。AI_ASYNC_STREAMING 开启时，上游流在每个进程唯一的事件循环线程里
+    以 AsyncOpenAI 运行，请求线程只从队列中取块；关闭时退回原来的同步客户端。
+    """
+    if AI_ASYNC_STREAMING:
+        return ai_stream_bridge.iterate(lambda: agenerate_chip_json_stream(user_description, api_key, model_name))
+    return generate_chip_json_stream(user_description, api_key, model_name)
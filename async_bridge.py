@@ -0,0 +1,108 @@
+# async_bridge.py
+"""
+在同步的 Flask 请求线程里消费异步生成器。
+
+每个进程只有一个后台事件循环线程（首次使用时启动，fork 后在子进程里重新启动），
+所有 AI 上游流都作为协程在这个循环里运行，请求线程只在一个队列上等待文本块。
+Flask/WSGI 无法把连接交还给事件循环，所以每个 SSE 连接仍占用一个请求线程，但它只是阻塞在队列上：
+配合 gunicorn 的 gthread worker（如 --threads 256），单个进程即可同时服务数百个生成，
+上游连接全部由事件循环复用。关闭 iterate() 返回的同步生成器会取消对应的协程、关闭上游连接；
+但这只在直接消费该生成器时发生。路由的 AI 生成经过 generation_cache，由后台的生成线程消费上游流，
+客户端断开后上游仍会跑完（结果写入缓存，准入槽位也一直占到那时，见 main_routes._holding_slot）；
+只有关闭生成结果缓存（GENERATION_CACHE=0）时，客户端断开才会取消协程。
+"""
+import asyncio
+import os
+import queue
+import threading
+
+AI_ASYNC_MAX_STREAMS = int(os.environ.get("AI_ASYNC_MAX_STREAMS", "512"))
+
+_CHUNK = 0
+_ERROR = 1
+_DONE = 2
+
+
+class AsyncStreamBridge:
+    def __init__(self, max_streams=AI_ASYNC_MAX_STREAMS):
+        self.max_streams = max(1, max_streams)
+        self._lock = threading.Lock()
+        self._loop = None
+        self._semaphore = None
+        self._pid = None
+        self.started = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.active = 0
+        self.waiting = 0
+        self.peak_active = 0
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="ai-stream-loop", daemon=True).start()
+                self._loop = loop
+                self._semaphore = asyncio.Semaphore(self.max_streams)
+                self._pid = os.getpid()
+            return self._loop
+
+    def iterate(self, agen_factory):
+        """
+        返回同步生成器；agen_factory() 在事件循环中被调用，返回异步生成器。关闭同步生成器会取消协程，
+        但只有直接消费它的调用方才会关闭它：经 generation_cache 的路由路径由生成线程消费到结束，客户端断开不会取消。
+        """
+        loop = self._ensure_loop()
+        chunks = queue.Queue()
+        future = asyncio.run_coroutine_threadsafe(self._pump(agen_factory, chunks), loop)
+        try:
+            while True:
+                kind, value = chunks.get()
+                if kind == _CHUNK:
+                    yield value
+                elif kind == _ERROR:
+                    raise value
+                else:
+                    return
+        finally:
+            if not future.done():
+                future.cancel()
+
+    async def _pump(self, agen_factory, chunks):
+        # 只在事件循环线程中执行，计数器不需要加锁
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.started += 1
+        self.active += 1
+        self.peak_active = max(self.peak_active, self.active)
+        try:
+            async for chunk in agen_factory():
+                chunks.put_nowait((_CHUNK, chunk))
+            self.completed += 1
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        except Exception as e:
+            self.failed += 1
+            chunks.put_nowait((_ERROR, e))
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+            chunks.put_nowait((_DONE, None))
+
+    def stats(self):
+        return {
+            "running": self._pid == os.getpid(),
+            "max_streams": self.max_streams,
+            "active": self.active,
+            "waiting": self.waiting,
+            "peak_active": self.peak_active,
+            "started": self.started,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+        }
@@ -1,3 +1,7 @@
+import os
+import threading
+import time
+from collections import OrderedDict
 from datetime import timedelta
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask import Blueprint, render_template, request, redirect, url_for, flash
@@ -9,7 +13,7 @@ from flask_login import (
     login_required,
     current_user,
 )
-from utils import load_users, save_users
+from utils import get_user_record, create_user
 
 login_manager = LoginManager()
 login_manager.login_view = 'auth.login'
@@ -25,16 +29,36 @@ class User(UserMixin):
 
     @staticmethod
     def get(user_id):
-        users = load_users()
-        if user_id in users:
-            user_data = users[user_id]
-            return User(id=user_id, username=user_data['username'], password_hash=user_data['password_hash'])
+        record = get_user_record(user_id)
+        if record is not None:
+            return User(id=record.username, username=record.username, password_hash=record.password_hash)
         return None
 
 
+# user_loader 在每个已登录请求上都会调用，前面加一层进程内 TTL + LRU 缓存。
+# 只缓存存在的用户；用户数据目前只增不改，TTL 只是为了限制多进程之间的陈旧时间。
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", "300"))
+USER_CACHE_MAX = int(os.environ.get("USER_CACHE_MAX", "1024"))
+_user_cache = OrderedDict()
+_user_cache_lock = threading.Lock()
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.get(user_id)
+    now = time.monotonic()
+    with _user_cache_lock:
+        cached = _user_cache.get(user_id)
+        if cached is not None and cached[1] > now:
+            _user_cache.move_to_end(user_id)
+            return cached[0]
+    user = User.get(user_id)
+    if user is not None:
+        with _user_cache_lock:
+            _user_cache[user_id] = (user, now + USER_CACHE_TTL)
+            _user_cache.move_to_end(user_id)
+            while len(_user_cache) > USER_CACHE_MAX:
+                _user_cache.popitem(last=False)
+    return user
 
 
 auth_bp = Blueprint('auth', __name__)
@@ -50,17 +74,21 @@ def register():
         if not username or not password:
             flash('用户名和密码不能为空！', 'danger')
             return redirect(url_for('auth.register'))
-        users = load_users()
-        if username in users:
+        if get_user_record(username) is not None:
             flash('该用户名已被注册！', 'warning')
             return redirect(url_for('auth.register'))
         hashed_password = generate_password_hash(password, method='pbkdf2:sha256')
-        users[username] = {'username': username, 'password_hash': hashed_password}
-        if save_users(users):
+        try:
+            created = create_user(username, hashed_password)
+        except Exception as e:
+            print(f"注册用户 '{username}' 时数据库出错: {e}")
+            flash('注册过程中发生错误，请稍后再试。', 'danger')
+            return redirect(url_for('auth.register'))
+        if created:
             flash('注册成功！请登录。', 'success')
             return redirect(url_for('auth.login'))
         else:
-            flash('注册过程中发生错误，请稍后再试。', 'danger')
+            flash('该用户名已被注册！', 'warning')
             return redirect(url_for('auth.register'))
     return render_template('register.html')
 
@@ -0,0 +1,38 @@
+# benchmarks/bench_large_graph.py
+"""
+大图模式的时间预算检查：渲染一张 2 万节点 / 4 万多条边的合成芯片图，
+超过预算时以非零状态码退出，可以直接放进 CI。
+用法: python benchmarks/bench_large_graph.py [--nodes 20000] [--fan-in 3] [--budget 10]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from chip_logic import chip_json_to_svg_html, LARGE_GRAPH_NODE_THRESHOLD  # noqa: E402
+from synthetic_chips import make_chip  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--nodes', type=int, default=20000)
+    parser.add_argument('--fan-in', type=int, default=3)
+    parser.add_argument('--budget', type=float, default=10.0, help='允许的最长渲染时间（秒）')
+    args = parser.parse_args()
+    chip = make_chip(args.nodes, fan_in=args.fan_in, seed=42)
+    if len(chip["nodes"]) <= LARGE_GRAPH_NODE_THRESHOLD:
+        print(f"注意：节点数 {len(chip['nodes'])} 未超过大图阈值 {LARGE_GRAPH_NODE_THRESHOLD}，测的是普通模式。")
+    start = time.perf_counter()
+    html = chip_json_to_svg_html(chip)
+    elapsed = time.perf_counter() - start
+    print(f"节点 {len(chip['nodes'])}, 边 {len(chip['edges'])}: 渲染耗时 {elapsed:.2f}s, 输出 {len(html) / 1e6:.1f} MB (预算 {args.budget:.1f}s)")
+    if elapsed > args.budget:
+        print("失败：超出时间预算。")
+        sys.exit(1)
+    print("通过。")
+
+
+if __name__ == '__main__':
+    main()
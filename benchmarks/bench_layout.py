@@ -0,0 +1,49 @@
+# benchmarks/bench_layout.py
+"""
+对比 Graphviz (dot 子进程) 与内置分层布局的耗时。
+用法: python benchmarks/bench_layout.py [--sizes 10,50,200,500,1000,2000] [--repeat 3]
+"""
+import argparse
+import os
+import shutil
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from chip_logic import calculate_node_dimensions, compute_graphviz_layout, compute_layered_layout  # noqa: E402
+from synthetic_chips import make_chip  # noqa: E402
+
+
+def best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', default='10,50,200,500,1000,2000')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    has_dot = shutil.which('dot') is not None
+    if not has_dot:
+        print("未找到 Graphviz 的 dot 可执行文件，只测试内置分层布局。")
+    print(f"{'节点数':>8} {'边数':>8} {'graphviz(ms)':>14} {'layered(ms)':>14} {'加速比':>8}")
+    for size in [int(s) for s in args.sizes.split(',') if s.strip()]:
+        chip = make_chip(size, seed=size)
+        node_id_map = {node["id"]: {"data": node, "dimensions": calculate_node_dimensions(node), "ports": {}} for node in chip["nodes"]}
+        edges = chip["edges"]
+        layered_s = best_time(lambda: compute_layered_layout(node_id_map, edges), args.repeat)
+        graphviz_s = best_time(lambda: compute_graphviz_layout(node_id_map, edges), args.repeat) if has_dot else None
+        gv_text = f"{graphviz_s * 1000:14.1f}" if graphviz_s is not None else f"{'-':>14}"
+        speedup = f"{graphviz_s / layered_s:8.1f}" if graphviz_s is not None and layered_s > 0 else f"{'-':>8}"
+        print(f"{size:>8} {len(edges):>8} {gv_text} {layered_s * 1000:14.1f} {speedup}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+# benchmarks/bench_module_spec.py
+"""
+模块规格查找的单节点耗时微基准。
+"未缓存 x2" 模拟旧流程：calculate_node_dimensions 和 generate_node_svg 各自重新构建一次规格；
+"缓存 x1" 是现在的流程：每个节点查一次记忆化的 ModuleSpec，并把它传给 calculate_node_dimensions。
+用法: python benchmarks/bench_module_spec.py [--nodes 2000] [--repeat 5]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from chip_logic import calculate_node_dimensions, get_module_spec, module_spec_key, _compile_module_spec  # noqa: E402
+from synthetic_chips import make_chip  # noqa: E402
+
+
+def per_node_ns(func, nodes, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for node in nodes:
+            func(node)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(nodes) * 1e9
+
+
+def uncached_twice(node):
+    spec = _compile_module_spec(*module_spec_key(node))
+    calculate_node_dimensions(node, spec)
+    _compile_module_spec(*module_spec_key(node))
+
+
+def cached_once(node):
+    calculate_node_dimensions(node, get_module_spec(node))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--nodes', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    nodes = make_chip(args.nodes, seed=1)["nodes"]
+    before = per_node_ns(uncached_twice, nodes, args.repeat)
+    after = per_node_ns(cached_once, nodes, args.repeat)
+    print(f"节点数: {len(nodes)}")
+    print(f"未缓存 x2 (旧流程): {before:10.0f} ns/节点")
+    print(f"缓存 x1   (新流程): {after:10.0f} ns/节点")
+    print(f"加速比: {before / after:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+# benchmarks/bench_pipeline.py
+"""
+芯片渲染流水线的分阶段基准：对不同规模和扇出的合成芯片（覆盖 MODULE_CATALOG 的所有类型和多行 Sticker），
+分别计时 get_module_spec、calculate_node_dimensions、布局、SVG 生成和完整的 chip_json_to_svg_html，
+并用 tracemalloc 记录每个阶段的峰值内存（不含 dot 子进程）。
+结果写入 JSON；给出 --baseline 时与之逐项比较，任何一项变慢/变大超过阈值即以非零状态码退出。
+用法: python benchmarks/bench_pipeline.py [--sizes 20,100,500] [--fan-out 1,4] [--engine graphviz|layered]
+                                        [--output results.json] [--baseline baseline.json] [--threshold 0.2]
+先在基准提交上运行一次 --output baseline.json，改动后再用 --baseline baseline.json 比较。
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from chip_logic import (LAYOUT_ENGINES, calculate_node_dimensions, chip_json_to_svg_html,  # noqa: E402
+                        get_module_spec, iter_chip_svg_html, prepare_chip_render)
+from render_cache import layout_cache  # noqa: E402
+from synthetic_chips import make_mixed_chip  # noqa: E402
+
+RESULT_VERSION = 1
+STAGES = ("module_spec", "node_dimensions", "layout", "svg", "total")
+
+
+def stage_functions(chip, engine):
+    """返回 {阶段名: 无参函数}。module_spec 测的是已预热的记忆化查找，即服务器上每次渲染实际付出的代价。"""
+    nodes = chip["nodes"]
+    edges = chip["edges"]
+    specs = [get_module_spec(node) for node in nodes]
+    node_id_map = {node["id"]: {"data": node, "spec": spec, "dimensions": calculate_node_dimensions(node, spec), "ports": {}}
+                   for node, spec in zip(nodes, specs)}
+    layout_cache.clear()
+    plan = prepare_chip_render(chip, layout_engine=engine)
+    layout = LAYOUT_ENGINES[engine]
+
+    def total():
+        layout_cache.clear()  # 不让布局缓存掩盖布局阶段的变化
+        chip_json_to_svg_html(chip, layout_engine=engine)
+
+    return {
+        "module_spec": lambda: [get_module_spec(node) for node in nodes],
+        "node_dimensions": lambda: [calculate_node_dimensions(node, spec) for node, spec in zip(nodes, specs)],
+        "layout": lambda: layout(node_id_map, edges),
+        "svg": lambda: "".join(iter_chip_svg_html(plan)),
+        "total": total,
+    }
+
+
+def time_stage(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return {"min_ms": round(min(samples), 3), "median_ms": round(statistics.median(samples), 3)}
+
+
+def peak_kb(func):
+    """单独运行一次并返回期间新分配内存的峰值（KB）；与计时分开，避免 tracemalloc 的开销影响时间。"""
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return round(peak / 1024, 1)
+
+
+def run_case(size, fan_out, sticker_ratio, engine, repeat, seed):
+    chip = make_mixed_chip(size, fan_out=fan_out, sticker_ratio=sticker_ratio, seed=seed)
+    stages = {}
+    for name, func in stage_functions(chip, engine).items():
+        func()  # 预热
+        stages[name] = time_stage(func, repeat)
+        stages[name]["peak_kb"] = peak_kb(func)
+    return {
+        "nodes": len(chip["nodes"]),
+        "edges": len(chip["edges"]),
+        "stickers": sum(1 for node in chip["nodes"] if node["type"] == "Sticker"),
+        "fan_out": fan_out,
+        "stages": stages,
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(results, baseline, threshold, min_delta_ms, min_delta_kb):
+    """逐个 (用例, 阶段) 比较 min_ms 和 peak_kb，返回回归项的描述列表。绝对差低于下限的视为噪声。"""
+    regressions = []
+    print(f"\n与基准比较（{baseline['meta'].get('git_revision') or '?'}，阈值 +{threshold * 100:.0f}%）:")
+    print(f"{'用例':<14} {'阶段':<16} {'基准(ms)':>10} {'本次(ms)':>10} {'变化':>8} {'基准(KB)':>10} {'本次(KB)':>10} {'变化':>8}")
+    for case, current in results["cases"].items():
+        base_case = baseline["cases"].get(case)
+        if base_case is None:
+            print(f"{case:<14} 基准中没有此用例，跳过")
+            continue
+        for stage, now in current["stages"].items():
+            before = base_case["stages"].get(stage)
+            if before is None:
+                continue
+            time_change = now["min_ms"] / before["min_ms"] - 1 if before["min_ms"] else 0.0
+            mem_change = now["peak_kb"] / before["peak_kb"] - 1 if before["peak_kb"] else 0.0
+            flags = []
+            if time_change > threshold and now["min_ms"] - before["min_ms"] > min_delta_ms:
+                flags.append("时间")
+            if mem_change > threshold and now["peak_kb"] - before["peak_kb"] > min_delta_kb:
+                flags.append("内存")
+            mark = f"  <- {'/'.join(flags)}回归" if flags else ""
+            print(f"{case:<14} {stage:<16} {before['min_ms']:>10.2f} {now['min_ms']:>10.2f} {time_change * 100:>7.1f}% "
+                  f"{before['peak_kb']:>10.1f} {now['peak_kb']:>10.1f} {mem_change * 100:>7.1f}%{mark}")
+            if flags:
+                regressions.append(f"{case} {stage}: {'/'.join(flags)}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='20,100,500', help='节点数列表（含 Sticker）')
+    parser.add_argument('--fan-out', default='1,4', help='每个输出端口最多连接的下游端口数列表')
+    parser.add_argument('--sticker-ratio', type=float, default=0.05)
+    parser.add_argument('--engine', choices=sorted(LAYOUT_ENGINES), default=None,
+                        help='布局引擎，默认有 dot 时用 graphviz，否则用 layered')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='把结果写入该 JSON 文件')
+    parser.add_argument('--baseline', help='与之比较的基准 JSON（之前某次 --output 的结果）')
+    parser.add_argument('--threshold', type=float, default=0.2, help='允许的相对变慢/变大比例')
+    parser.add_argument('--min-delta-ms', type=float, default=0.5, help='低于该绝对差的时间变化不算回归')
+    parser.add_argument('--min-delta-kb', type=float, default=64.0, help='低于该绝对差的内存变化不算回归')
+    args = parser.parse_args()
+
+    engine = args.engine
+    if engine is None:
+        engine = "graphviz" if shutil.which('dot') else "layered"
+        if engine != "graphviz":
+            print("未找到 Graphviz 的 dot 可执行文件，布局阶段使用内置分层布局。")
+    meta = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_revision": _git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "engine": engine,
+        "repeat": args.repeat,
+        "seed": args.seed,
+        "sticker_ratio": args.sticker_ratio,
+    }
+    results = {"version": RESULT_VERSION, "meta": meta, "cases": {}}
+    print(f"{'用例':<14} {'节点':>6} {'边':>6} " + " ".join(f"{stage + '(ms)':>18}" for stage in STAGES) + f" {'峰值(KB)':>10}")
+    for size in [int(s) for s in args.sizes.split(',') if s.strip()]:
+        for fan_out in [int(s) for s in args.fan_out.split(',') if s.strip()]:
+            case = f"n{size}-fo{fan_out}"
+            result = run_case(size, fan_out, args.sticker_ratio, engine, args.repeat, args.seed)
+            results["cases"][case] = result
+            stages = result["stages"]
+            print(f"{case:<14} {result['nodes']:>6} {result['edges']:>6} "
+                  + " ".join(f"{stages[stage]['min_ms']:>18.2f}" for stage in STAGES)
+                  + f" {stages['total']['peak_kb']:>10.1f}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已写入 {args.output}")
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        for key in ("engine", "python", "repeat", "seed", "sticker_ratio"):
+            if baseline["meta"].get(key) != meta[key]:
+                print(f"注意：基准的 {key} 为 {baseline['meta'].get(key)!r}，本次为 {meta[key]!r}，结果可能不可比。")
+        regressions = compare(results, baseline, args.threshold, args.min_delta_ms, args.min_delta_kb)
+        if regressions:
+            print(f"\n失败：{len(regressions)} 项超出阈值：" + "；".join(regressions))
+            sys.exit(1)
+        print("\n通过：没有超出阈值的回归。")
+
+
+if __name__ == '__main__':
+    main()
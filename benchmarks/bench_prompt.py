@@ -0,0 +1,49 @@
+# benchmarks/bench_prompt.py
+"""
+对比完整教程与按描述检索拼装的系统提示大小（估算 token）及检索耗时。
+用法: python benchmarks/bench_prompt.py [--budget 3000] [描述 ...]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from prompt_index import TutorialIndex, estimate_tokens, PROMPT_MAX_SECTIONS  # noqa: E402
+from ai_service import PROMPT_TUTORIAL_FILE, SYSTEM_PROMPT  # noqa: E402
+
+SAMPLE_DESCRIPTIONS = [
+    "做一个计时器，每秒加一，把结果输出",
+    "当玩家靠近时给物体施加一个向上的力",
+    "把输入的字符串转成大写然后和常量拼接",
+    "根据时间的正弦值改变颜色",
+    "检测碰撞后删除物体",
+    "split a vector into x and y and add them",
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--budget', type=int, default=3000)
+    parser.add_argument('descriptions', nargs='*')
+    args = parser.parse_args()
+    with open(PROMPT_TUTORIAL_FILE, 'r', encoding='utf-8') as f:
+        text = f.read()
+    start = time.perf_counter()
+    index = TutorialIndex(text)
+    build_ms = (time.perf_counter() - start) * 1000
+    full_tokens = estimate_tokens(SYSTEM_PROMPT)
+    print(f"索引: {len(index.section_indices)} 个小节，核心章节约 {index.core_tokens} tokens，建索引 {build_ms:.1f} ms")
+    print(f"完整系统提示约 {full_tokens} tokens")
+    print(f"{'tokens':>8} {'节省':>7} {'小节':>4} {'检索(ms)':>9}  描述")
+    for description in args.descriptions or SAMPLE_DESCRIPTIONS:
+        start = time.perf_counter()
+        tutorial_text, sections = index.select(description, budget_tokens=args.budget, max_sections=PROMPT_MAX_SECTIONS)
+        select_ms = (time.perf_counter() - start) * 1000
+        tokens = estimate_tokens(tutorial_text) + (full_tokens - index.full_tokens)
+        print(f"{tokens:>8} {1 - tokens / full_tokens:>7.1%} {len(sections):>4} {select_ms:>9.2f}  {description}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+# benchmarks/load_ai_stream.py
+"""
+AI 流式生成接口的并发压测：在本进程内启动多线程 WSGI 服务器，用假的上游模型（按固定间隔吐 token）
+同时发起 N 个 /generate_chip_ai_stream 请求，统计首字节时间、总耗时、线程数和事件循环上的峰值并发。
+用法: python benchmarks/load_ai_stream.py [--clients 300] [--tokens 40] [--interval 0.05] [--mode async|sync]
+"""
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# 只测流式转发本身：关闭生成结果缓存、局部渲染和准入控制（所有请求来自同一个测试账号，否则会被限速）
+os.environ.setdefault("GENERATION_CACHE", "0")
+os.environ.setdefault("AI_PARTIAL_RENDER_INTERVAL", "0")
+os.environ.setdefault("AI_ADMISSION", "0")
+
+
+class _Obj:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def _chunk(text):
+    return _Obj(choices=[_Obj(delta=_Obj(content=text))])
+
+
+def _fake_tokens(count):
+    chip = json.dumps({"nodes": [{"id": f"n{i}", "type": "ADD"} for i in range(count)], "edges": []})
+    step = max(1, len(chip) // count)
+    return [chip[i:i + step] for i in range(0, len(chip), step)]
+
+
+class FakeAsyncClient:
+    def __init__(self, tokens, interval):
+        self.chat = _Obj(completions=self)
+        self.tokens = tokens
+        self.interval = interval
+
+    async def create(self, **kwargs):
+        return FakeAsyncStream(self.tokens, self.interval)
+
+
+class FakeAsyncStream:
+    def __init__(self, tokens, interval):
+        self.tokens = tokens
+        self.interval = interval
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def __aiter__(self):
+        for token in self.tokens:
+            await asyncio.sleep(self.interval)
+            yield _chunk(token)
+
+
+class FakeSyncClient:
+    def __init__(self, tokens, interval):
+        self.chat = _Obj(completions=self)
+        self.tokens = tokens
+        self.interval = interval
+
+    def create(self, **kwargs):
+        def stream():
+            for token in self.tokens:
+                time.sleep(self.interval)
+                yield _chunk(token)
+        return stream()
+
+
+def run_client(port, cookie, description, results):
+    started = time.perf_counter()
+    first_byte = None
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    body = urllib.parse.urlencode({'description': description, 'api_key': 'sk-load-test', 'model_name': ''})
+    try:
+        conn.request('POST', '/generate_chip_ai_stream', body=body, headers={
+            'Content-Type': 'application/x-www-form-urlencoded', 'Cookie': cookie})
+        response = conn.getresponse()
+        content_events = 0
+        for line in response:
+            if first_byte is None:
+                first_byte = time.perf_counter() - started
+            if line.startswith(b'data: ') and b'"content"' in line:
+                content_events += 1
+        results.append({"ok": response.status == 200 and content_events > 0,
+                        "ttfb": first_byte or 0.0, "total": time.perf_counter() - started})
+    except Exception as e:
+        results.append({"ok": False, "error": str(e), "ttfb": 0.0, "total": time.perf_counter() - started})
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', type=int, default=300)
+    parser.add_argument('--tokens', type=int, default=40)
+    parser.add_argument('--interval', type=float, default=0.05)
+    parser.add_argument('--mode', choices=('async', 'sync'), default='async')
+    args = parser.parse_args()
+    os.environ["AI_ASYNC_STREAMING"] = "1" if args.mode == 'async' else "0"
+
+    from werkzeug.serving import make_server
+    import ai_service
+    from app import app
+    from models import db
+    from utils import create_user
+
+    tokens = _fake_tokens(args.tokens)
+    async_client = FakeAsyncClient(tokens, args.interval)
+    sync_client = FakeSyncClient(tokens, args.interval)
+    ai_service.async_openai_clients.get = lambda api_key, timeout=None: async_client
+    ai_service.openai_clients.get = lambda api_key, timeout=None: sync_client
+
+    with app.app_context():
+        db.create_all()
+        create_user('load_test_user', 'x')
+    with app.test_client() as client:
+        client.get('/get_ai_models')  # 触发首次请求时的建表/迁移
+        with client.session_transaction() as session:
+            session['_user_id'] = 'load_test_user'
+            session['_fresh'] = True
+        cookie = f"session={client.get_cookie('session').value}"
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    server.socket.listen(args.clients)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_port
+
+    expected = args.tokens * args.interval
+    print(f"模式 {args.mode}，{args.clients} 个并发请求，每个约 {len(tokens)} 个 token × {args.interval}s ≈ {expected:.1f}s")
+    results = []
+    threads = [threading.Thread(target=run_client, args=(port, cookie, f"load test {i} {time.time()}", results))
+               for i in range(args.clients)]
+    peak_threads = 0
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        peak_threads = max(peak_threads, threading.active_count())
+        time.sleep(0.05)
+    wall = time.perf_counter() - started
+    server.shutdown()
+
+    ok = [r for r in results if r["ok"]]
+    totals = sorted(r["total"] for r in ok) or [0.0]
+    ttfbs = sorted(r["ttfb"] for r in ok) or [0.0]
+    print(f"成功 {len(ok)}/{len(results)}，总耗时 {wall:.2f}s（单个生成约 {expected:.1f}s）")
+    print(f"首字节 p50 {statistics.median(ttfbs) * 1000:.0f} ms，p95 {ttfbs[int(len(ttfbs) * 0.95) - 1] * 1000:.0f} ms")
+    print(f"单请求总耗时 p50 {statistics.median(totals):.2f}s，p95 {totals[int(len(totals) * 0.95) - 1]:.2f}s")
+    print(f"本进程峰值线程数 {peak_threads}（含压测客户端线程 {args.clients} 个）")
+    if args.mode == 'async':
+        print(f"事件循环: {ai_service.ai_stream_bridge.stats()}")
+    errors = [r.get("error") for r in results if not r["ok"]]
+    if errors:
+        print(f"失败示例: {errors[:3]}")
+
+
+if __name__ == '__main__':
+    main()
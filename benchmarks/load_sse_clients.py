@@ -0,0 +1,197 @@
+# benchmarks/load_sse_clients.py
+"""
+对运行中的应用压测 AI 流式接口：用 --clients 个并发 SSE 客户端共发出 --requests 个 /generate_chip_ai_stream 请求，
+统计吞吐量，以及首字节、首个内容块、排队等待和总耗时的分位数，并按结果（成功 / 流中错误 / 429 / 其他）计数。
+测试账号 <prefix>0..N-1 会自动注册并登录；每个请求的描述都不同，不会命中生成缓存（--same-description 用于测合并）。
+应用应以 SILICONFLOW_BASE_URL 指向 mock_siliconflow.py 启动，例如:
+  python benchmarks/mock_siliconflow.py --ttft 0.5 --tokens-per-second 50 &
+  SILICONFLOW_BASE_URL=http://127.0.0.1:8900/v1 gunicorn -w 4 --threads 64 app:app
+  python benchmarks/load_sse_clients.py --url http://127.0.0.1:8000 --clients 100 --requests 400
+每个用户受 AI_RATE_* / AI_MAX_STREAMS_PER_USER 限制，要测上游路径本身请增加 --users 或以 AI_ADMISSION=0 启动应用。
+"""
+import argparse
+import http.client
+import json
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Target:
+    def __init__(self, url, timeout):
+        parsed = urllib.parse.urlsplit(url)
+        self.https = parsed.scheme == "https"
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if self.https else 80)
+        self.prefix = parsed.path.rstrip('/')
+        self.timeout = timeout
+
+    def connect(self):
+        connection_class = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        return connection_class(self.host, self.port, timeout=self.timeout)
+
+    def post_form(self, path, fields, cookie=None):
+        """发送表单，返回 (状态码, Set-Cookie 中的 cookie 字典)；不跟随重定向。"""
+        conn = self.connect()
+        try:
+            headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+            if cookie:
+                headers['Cookie'] = cookie
+            conn.request('POST', self.prefix + path, body=urllib.parse.urlencode(fields), headers=headers)
+            response = conn.getresponse()
+            response.read()
+            cookies = {}
+            for header in response.headers.get_all('Set-Cookie') or []:
+                name, _, rest = header.partition('=')
+                cookies[name.strip()] = rest.split(';', 1)[0]
+            return response.status, cookies
+        finally:
+            conn.close()
+
+
+def login(target, username, password):
+    """注册（已存在时忽略）并登录，返回 Cookie 请求头。"""
+    target.post_form('/register', {'username': username, 'password': password})
+    # 带 next，避免登录成功后的重定向依赖首页路由
+    status, cookies = target.post_form('/login?next=/', {'username': username, 'password': password})
+    if 'session' not in cookies:
+        raise RuntimeError(f"用户 {username} 登录失败（状态码 {status}）")
+    return "; ".join(f"{name}={value}" for name, value in cookies.items())
+
+
+def run_request(target, cookie, description, api_key, model):
+    result = {"outcome": "exception", "ttfb": None, "ttft": None, "queue_wait": None, "total": None,
+              "content_chars": 0, "events": 0, "error": None}
+    started = time.perf_counter()
+    conn = target.connect()
+    try:
+        conn.request('POST', target.prefix + '/generate_chip_ai_stream',
+                     body=urllib.parse.urlencode({'description': description, 'api_key': api_key, 'model_name': model}),
+                     headers={'Content-Type': 'application/x-www-form-urlencoded', 'Cookie': cookie,
+                              'Accept': 'text/event-stream'})
+        response = conn.getresponse()
+        result["ttfb"] = time.perf_counter() - started
+        if response.status != 200:
+            body = response.read().decode('utf-8', 'replace')
+            result["outcome"] = "rejected" if response.status == 429 else f"http_{response.status}"
+            result["error"] = body[:200]
+            return result
+        for line in response:
+            if not line.startswith(b'data: '):
+                continue
+            event = json.loads(line[6:])
+            result["events"] += 1
+            if event.get('event') == 'admitted':
+                result["queue_wait"] = time.perf_counter() - started
+            elif 'error' in event:
+                result["error"] = event['error']
+            elif 'content' in event:
+                if result["ttft"] is None:
+                    result["ttft"] = time.perf_counter() - started
+                result["content_chars"] += len(event['content'])
+        if result["error"]:
+            result["outcome"] = "stream_error"
+        elif result["content_chars"]:
+            result["outcome"] = "ok"
+        else:
+            result["outcome"] = "empty"
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        result["total"] = time.perf_counter() - started
+        conn.close()
+    return result
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(q * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(results, wall):
+    outcomes = {}
+    for result in results:
+        outcomes[result["outcome"]] = outcomes.get(result["outcome"], 0) + 1
+    ok = [r for r in results if r["outcome"] == "ok"]
+    summary = {
+        "requests": len(results),
+        "wall_seconds": round(wall, 3),
+        "outcomes": outcomes,
+        "throughput_rps": round(len(ok) / wall, 3) if wall else 0.0,
+        "content_chars_per_second": round(sum(r["content_chars"] for r in ok) / wall, 1) if wall else 0.0,
+        "queued": sum(1 for r in results if r["queue_wait"] is not None),
+        "latency": {},
+    }
+    for name, source in (("ttfb", results), ("ttft", ok), ("queue_wait", results), ("total", ok)):
+        values = sorted(r[name] for r in source if r[name] is not None)
+        summary["latency"][name] = {
+            "count": len(values),
+            **{label: round(percentile(values, q), 4) if values else None
+               for label, q in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0))},
+        }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='应用的根地址')
+    parser.add_argument('--clients', type=int, default=50, help='同时打开的 SSE 连接数')
+    parser.add_argument('--requests', type=int, default=None, help='请求总数，默认等于 --clients')
+    parser.add_argument('--users', type=int, default=None, help='轮流使用的测试账号数，默认等于 --clients')
+    parser.add_argument('--user-prefix', default='loadtest_')
+    parser.add_argument('--password', default='loadtest-password')
+    parser.add_argument('--api-key', default='sk-mock', help='随请求提交的 API Key（模拟上游接受任意值）')
+    parser.add_argument('--model', default='', help='模型名，空表示使用应用的默认模型')
+    parser.add_argument('--same-description', action='store_true', help='所有请求使用同一个描述')
+    parser.add_argument('--timeout', type=float, default=300.0, help='单个连接的读超时（秒）')
+    parser.add_argument('--output', help='把汇总和每个请求的结果写入该 JSON 文件')
+    args = parser.parse_args()
+    total_requests = args.requests or args.clients
+    user_count = max(1, args.users or args.clients)
+
+    target = Target(args.url, args.timeout)
+    print(f"登录 {user_count} 个测试账号...")
+    with ThreadPoolExecutor(max_workers=min(user_count, 16)) as pool:
+        cookies = list(pool.map(lambda i: login(target, f"{args.user_prefix}{i}", args.password), range(user_count)))
+
+    run_id = int(time.time())
+    progress = {"done": 0}
+    progress_lock = threading.Lock()
+
+    def one(index):
+        description = (f"做一个把两个输入相加再输出的芯片（压测 {run_id}）" if args.same_description
+                       else f"做一个把两个输入相加再输出的芯片（压测 {run_id} #{index}）")
+        result = run_request(target, cookies[index % user_count], description, args.api_key, args.model)
+        with progress_lock:
+            progress["done"] += 1
+            if progress["done"] % max(1, total_requests // 10) == 0:
+                print(f"  已完成 {progress['done']}/{total_requests}")
+        return result
+
+    print(f"{args.clients} 个并发客户端，共 {total_requests} 个请求 -> {args.url}")
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as pool:
+        results = list(pool.map(one, range(total_requests)))
+    wall = time.perf_counter() - started
+    summary = summarize(results, wall)
+
+    print(f"\n总耗时 {wall:.2f}s，结果: {summary['outcomes']}，其中排队过 {summary['queued']} 个")
+    print(f"吞吐: {summary['throughput_rps']:.2f} 个成功请求/s，{summary['content_chars_per_second']:.0f} 字符/s")
+    print(f"{'指标':<12} {'样本':>6} {'p50(s)':>9} {'p90(s)':>9} {'p99(s)':>9} {'max(s)':>9}")
+    for name, stats in summary["latency"].items():
+        cells = " ".join(f"{stats[label]:>9.3f}" if stats[label] is not None else f"{'-':>9}" for label in ("p50", "p90", "p99", "max"))
+        print(f"{name:<12} {stats['count']:>6} {cells}")
+    errors = [r["error"] for r in results if r["outcome"] != "ok" and r["error"]]
+    if errors:
+        print(f"失败示例: {errors[:3]}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({"summary": summary, "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.output}")
+
+
+if __name__ == '__main__':
+    main()
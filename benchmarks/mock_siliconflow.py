@@ -0,0 +1,284 @@
+# benchmarks/mock_siliconflow.py
+"""
+本地的 OpenAI 兼容模拟上游（代替 SiliconFlow），压测 /generate_chip_ai_stream 时不消耗真实 token、不受上游限速。
+提供 GET /v1/models 和 POST /v1/chat/completions（流式与非流式，支持 stream_options.include_usage），
+回放库中成功的 AiRequestLog 原始回复（--from-db），没有记录时用合成芯片 JSON。
+可配置首个 token 延迟、token 速率，以及按比例注入 500 错误、429 限速和流中途断开。GET /mock/stats 返回计数。
+用法: python benchmarks/mock_siliconflow.py [--port 8900] [--from-db] [--ttft 0.8] [--tokens-per-second 40]
+                                           [--error-rate 0.02] [--rate-limit-rate 0.05] [--disconnect-rate 0.01]
+然后以 SILICONFLOW_BASE_URL=http://127.0.0.1:8900/v1 启动应用，再用 load_sse_clients.py 施压。
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from synthetic_chips import make_mixed_chip  # noqa: E402
+
+
+def load_recorded_responses(limit):
+    """取最近 limit 条成功的 AI 请求的原始回复（需要应用的数据库）。"""
+    from app import app  # 只在回放记录时导入
+    from content_store import attach_texts
+    from models import AiRequestLog
+
+    with app.app_context():
+        rows = (AiRequestLog.query.filter_by(succeeded=True)
+                .order_by(AiRequestLog.id.desc()).limit(limit).all())
+        attach_texts(rows)
+        return [row.raw_ai_response_text for row in rows if row.raw_ai_response_text]
+
+
+def synthetic_responses(count, seed=0):
+    rng = random.Random(seed)
+    return [json.dumps(make_mixed_chip(rng.randrange(4, 40), fan_out=rng.randrange(1, 4), seed=i), ensure_ascii=False, indent=2)
+            for i in range(count)]
+
+
+class MockUpstream:
+    """回复语料、延迟/故障参数和计数（所有处理线程共享）。"""
+
+    def __init__(self, responses, models, ttft=0.8, ttft_jitter=0.3, tokens_per_second=40.0, chars_per_token=4,
+                 error_rate=0.0, rate_limit_rate=0.0, disconnect_rate=0.0, retry_after=1, seed=None):
+        self.responses = responses
+        self.models = models
+        self.ttft = ttft
+        self.ttft_jitter = ttft_jitter
+        self.tokens_per_second = tokens_per_second
+        self.chars_per_token = max(1, chars_per_token)
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.disconnect_rate = disconnect_rate
+        self.retry_after = retry_after
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self.counters = {"requests": 0, "streams": 0, "completed": 0, "errors_injected": 0,
+                         "rate_limited": 0, "disconnects": 0, "client_aborts": 0, "active": 0, "peak_active": 0,
+                         "completion_tokens": 0}
+
+    def bump(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+            if name == "active":
+                self.counters["peak_active"] = max(self.counters["peak_active"], self.counters["active"])
+
+    def decide(self):
+        """为一个请求抽取结果：'error' / 'rate_limit' / 'disconnect' / 'ok'，以及回复文本和首个 token 延迟。"""
+        with self._lock:
+            self._next_id += 1
+            roll = self._rng.random()
+            text = self._rng.choice(self.responses)
+            ttft = max(0.0, self._rng.gauss(self.ttft, self.ttft * self.ttft_jitter))
+            request_id = self._next_id
+        if roll < self.error_rate:
+            outcome = "error"
+        elif roll < self.error_rate + self.rate_limit_rate:
+            outcome = "rate_limit"
+        elif roll < self.error_rate + self.rate_limit_rate + self.disconnect_rate:
+            outcome = "disconnect"
+        else:
+            outcome = "ok"
+        return outcome, text, ttft, f"chatcmpl-mock-{request_id}"
+
+    def chunks(self, text):
+        step = self.chars_per_token
+        return [text[i:i + step] for i in range(0, len(text), step)]
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    upstream = None  # 由 make_server 设置
+
+    def log_message(self, format, *args):  # 压测时逐条访问日志太多
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, message, error_type, headers=None):
+        self._send_json(status, {"error": {"message": message, "type": error_type, "code": status}}, headers)
+
+    def _write_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _write_event(self, payload):
+        self._write_chunk(b"data: " + json.dumps(payload, ensure_ascii=False).encode('utf-8') + b"\n\n")
+
+    def do_GET(self):
+        if self.path.rstrip('/') in ("/v1/models", "/models"):
+            created = int(time.time())
+            self._send_json(200, {"object": "list", "data": [
+                {"id": model, "object": "model", "created": created, "owned_by": "mock"} for model in self.upstream.models]})
+        elif self.path == "/mock/stats":
+            self._send_json(200, self.upstream.stats())
+        else:
+            self._send_error(404, f"未知路径 {self.path}", "not_found")
+
+    def do_POST(self):
+        try:
+            self._handle_post()
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端放弃了请求（例如对冲请求被取消）
+            self.upstream.bump("client_aborts")
+            self.close_connection = True
+
+    def _handle_post(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw_body = self.rfile.read(length) if length else b""
+        if self.path.rstrip('/') not in ("/v1/chat/completions", "/chat/completions"):
+            self._send_error(404, f"未知路径 {self.path}", "not_found")
+            return
+        if not self.headers.get("Authorization", "").startswith("Bearer "):
+            self._send_error(401, "缺少 API Key", "authentication_error")
+            return
+        try:
+            body = json.loads(raw_body or b"{}")
+        except json.JSONDecodeError:
+            self._send_error(400, "请求体不是合法的 JSON", "invalid_request_error")
+            return
+        upstream = self.upstream
+        upstream.bump("requests")
+        outcome, text, ttft, completion_id = upstream.decide()
+        if outcome == "error":
+            upstream.bump("errors_injected")
+            self._send_error(500, "模拟的上游内部错误", "internal_error")
+            return
+        if outcome == "rate_limit":
+            upstream.bump("rate_limited")
+            self._send_error(429, "模拟的上游限速", "rate_limit_error", {"Retry-After": str(upstream.retry_after)})
+            return
+        model = body.get("model") or upstream.models[0]
+        prompt_tokens = len(json.dumps(body.get("messages", []), ensure_ascii=False)) // 4
+        pieces = upstream.chunks(text)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(pieces), "total_tokens": prompt_tokens + len(pieces)}
+        time.sleep(ttft)
+        if not body.get("stream"):
+            time.sleep(len(pieces) / upstream.tokens_per_second if upstream.tokens_per_second > 0 else 0)
+            upstream.bump("completed")
+            upstream.bump("completion_tokens", len(pieces))
+            self._send_json(200, {"id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+                                  "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                                  "usage": usage})
+            return
+        self._stream(completion_id, model, pieces, usage, outcome == "disconnect",
+                     bool((body.get("stream_options") or {}).get("include_usage")))
+
+    def _stream(self, completion_id, model, pieces, usage, disconnect, include_usage):
+        upstream = self.upstream
+        interval = 1.0 / upstream.tokens_per_second if upstream.tokens_per_second > 0 else 0.0
+        created = int(time.time())
+
+        def chunk(delta, finish_reason=None):
+            return {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+        upstream.bump("streams")
+        upstream.bump("active")
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            self._write_event(chunk({"role": "assistant", "content": ""}))
+            cut_at = len(pieces) // 2 if disconnect else None
+            for index, piece in enumerate(pieces):
+                if index == cut_at:
+                    # 不发结束块就关闭连接，客户端会看到不完整的分块传输
+                    upstream.bump("disconnects")
+                    self.close_connection = True
+                    return
+                self._write_event(chunk({"content": piece}))
+                if interval:
+                    time.sleep(interval)
+            self._write_event(chunk({}, "stop"))
+            if include_usage:
+                self._write_event({"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                                   "model": model, "choices": [], "usage": usage})
+            self._write_chunk(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+            upstream.bump("completed")
+            upstream.bump("completion_tokens", len(pieces))
+        finally:
+            upstream.bump("active", -1)
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def make_server(upstream, host="127.0.0.1", port=8900):
+    handler = type("BoundMockHandler", (MockHandler,), {"upstream": upstream})
+    return MockServer((host, port), handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--from-db', action='store_true', help='回放应用数据库中成功的 AiRequestLog 原始回复')
+    parser.add_argument('--limit', type=int, default=500, help='--from-db 时最多读取的记录数')
+    parser.add_argument('--models', default='mock/chip-model', help='/v1/models 返回的模型 id，逗号分隔（请求任何模型都会响应）')
+    parser.add_argument('--ttft', type=float, default=0.8, help='首个 token 的平均延迟（秒）')
+    parser.add_argument('--ttft-jitter', type=float, default=0.3, help='首个 token 延迟的相对标准差')
+    parser.add_argument('--tokens-per-second', type=float, default=40.0, help='每个流的 token 速率，0 表示不限速')
+    parser.add_argument('--chars-per-token', type=int, default=4, help='每个 token（流中每一块）的字符数')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回 500 的比例')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='返回 429 的比例')
+    parser.add_argument('--retry-after', type=int, default=1, help='429 响应的 Retry-After 秒数')
+    parser.add_argument('--disconnect-rate', type=float, default=0.0, help='流发到一半断开的比例')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--report-interval', type=float, default=10.0, help='打印计数的间隔秒数，0 表示不打印')
+    args = parser.parse_args()
+
+    responses = load_recorded_responses(args.limit) if args.from_db else []
+    if responses:
+        print(f"回放 {len(responses)} 条记录的AI回复。")
+    else:
+        if args.from_db:
+            print("数据库中没有成功的AI请求记录，改用合成芯片 JSON。")
+        responses = synthetic_responses(50, seed=args.seed or 0)
+    upstream = MockUpstream(
+        responses, [m.strip() for m in args.models.split(',') if m.strip()], ttft=args.ttft, ttft_jitter=args.ttft_jitter,
+        tokens_per_second=args.tokens_per_second, chars_per_token=args.chars_per_token, error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate, disconnect_rate=args.disconnect_rate, retry_after=args.retry_after, seed=args.seed)
+    server = make_server(upstream, args.host, args.port)
+    print(f"模拟上游已启动：SILICONFLOW_BASE_URL=http://{args.host}:{server.server_port}/v1")
+    if args.report_interval > 0:
+        def report():
+            while True:
+                time.sleep(args.report_interval)
+                print(f"[mock] {upstream.stats()}")
+        threading.Thread(target=report, daemon=True).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"[mock] 最终计数: {upstream.stats()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+# benchmarks/synthetic_chips.py
+"""生成用于基准测试的合成芯片图（结构与真实芯片相近：输入/常量 -> 运算链 -> 输出）。"""
+import random
+
+
+def make_chip(num_nodes, fan_in=2, window=30, seed=0):
+    """
+    num_nodes: 节点总数。
+    fan_in: 每个 ADD 节点的输入边数（轮流连到 A/B 端口，大于2时同一端口会有多条入边）。
+    window: 运算节点只从最近 window 个节点中选取上游，控制边的"局部性"。
+    """
+    rng = random.Random(seed)
+    nodes, edges = [], []
+    num_sources = max(1, num_nodes // 5)
+    num_outputs = max(1, num_nodes // 10) if num_nodes > 2 else 0
+    num_ops = max(0, num_nodes - num_sources - num_outputs)
+    producers = []  # (node_id, output_port)
+    for i in range(num_sources):
+        node_id = f"src{i}"
+        if i % 2 == 0:
+            nodes.append({"id": node_id, "type": "INPUT", "label": f"In {i}", "attrs": {"name": f"#in{i}", "data_type": "DECIMAL"}})
+        else:
+            nodes.append({"id": node_id, "type": "Constant (Decimal)", "label": f"C{i}", "attrs": {"value": i}})
+        producers.append((node_id, "OUTPUT"))
+    for i in range(num_ops):
+        node_id = f"op{i}"
+        nodes.append({"id": node_id, "type": "ADD", "label": f"Add {i}"})
+        for k in range(max(1, fan_in)):
+            port = ("A", "B")[k % 2]
+            from_node, from_port = producers[max(0, len(producers) - 1 - rng.randrange(min(window, len(producers))))]
+            edges.append({"from_node": from_node, "from_port": from_port, "to_node": node_id, "to_port": port})
+        producers.append((node_id, "A+B"))
+    for i in range(num_outputs):
+        node_id = f"out{i}"
+        nodes.append({"id": node_id, "type": "OUTPUT", "label": f"Out {i}", "attrs": {"name": f"#out{i}", "data_type": "DECIMAL"}})
+        from_node, from_port = producers[rng.randrange(len(producers))]
+        edges.append({"from_node": from_node, "from_port": from_port, "to_node": node_id, "to_port": "INPUT"})
+    return {"nodes": nodes, "edges": edges}
+
+
+_SOURCE_MAKERS = (
+    lambda i, rng: {"type": "Constant (Decimal)", "attrs": {"value": round(rng.uniform(-100, 100), 3)}},
+    lambda i, rng: {"type": "Constant (String)", "attrs": {"value": f"text-{i}-" + "x" * rng.randrange(0, 24)}},
+    lambda i, rng: {"type": "Constant (Vector)", "attrs": {"value": f"({rng.randrange(10)}, {rng.randrange(10)}, {rng.randrange(10)})"}},
+    lambda i, rng: {"type": "INPUT", "attrs": {"name": f"#in{i}", "data_type": rng.choice(("DECIMAL", "STRING", "VECTOR", "ENTITY", "ANY"))}},
+    lambda i, rng: {"type": "TIME"},
+)
+_SOURCE_OUTPUTS = {"Constant (Decimal)": ("OUTPUT",), "Constant (String)": ("OUTPUT",), "Constant (Vector)": ("OUTPUT",),
+                   "INPUT": ("OUTPUT",), "TIME": ("TIME", "DELTA TIME", "SIN TIME", "COS TIME")}
+
+
+def _sticker(i, rng):
+    lines = ["注释第 %d 行：" % (k + 1) + "说明" * rng.randrange(1, 12) for k in range(rng.randrange(1, 6))]
+    return {"type": "Sticker", "attrs": {"Header": f"Note {i}", "Text": "\n".join(lines)}}
+
+
+def make_mixed_chip(num_nodes, fan_out=2, sticker_ratio=0.05, window=30, seed=0):
+    """
+    覆盖 MODULE_CATALOG 中所有类型的合成芯片：常量 / INPUT（各种数据类型）/ TIME -> ADD / VARIABLE -> OUTPUT，
+    另有 sticker_ratio 比例的多行 Sticker 注释节点（不连边）。
+    fan_out: 每个输出端口最多连到几个下游端口；可用的上游端口用完时才重复使用已满的端口。
+    """
+    rng = random.Random(seed)
+    nodes, edges = [], []
+    num_stickers = int(num_nodes * sticker_ratio)
+    graph_nodes = max(1, num_nodes - num_stickers)
+    num_sources = max(1, graph_nodes // 5)
+    num_outputs = max(1, graph_nodes // 10) if graph_nodes > 2 else 0
+    num_ops = max(0, graph_nodes - num_sources - num_outputs)
+    producers = []  # (node_id, output_port)
+    remaining = {}  # (node_id, output_port) -> 还能连接的下游端口数
+    fan_out = max(1, fan_out)
+
+    def connect(to_node, to_port):
+        recent = producers[-window:]
+        candidates = [p for p in recent if remaining[p] > 0] or recent
+        producer = rng.choice(candidates)
+        remaining[producer] -= 1
+        edges.append({"from_node": producer[0], "from_port": producer[1], "to_node": to_node, "to_port": to_port})
+
+    def add_producer(node_id, port):
+        producers.append((node_id, port))
+        remaining[(node_id, port)] = fan_out
+
+    for i in range(num_sources):
+        node = _SOURCE_MAKERS[i % len(_SOURCE_MAKERS)](i, rng)
+        node.update(id=f"src{i}", label=f"Src {i}")
+        nodes.append(node)
+        for port in _SOURCE_OUTPUTS[node["type"]]:
+            add_producer(node["id"], port)
+    for i in range(num_ops):
+        node_id = f"op{i}"
+        if i % 4 == 3:
+            nodes.append({"id": node_id, "type": "VARIABLE", "label": f"Var {i}", "attrs": {"name": f"var{i}", "var_type": "DECIMAL"}})
+            in_ports, out_port = ("INPUT", "SET"), "VAR"
+        else:
+            nodes.append({"id": node_id, "type": "ADD", "label": f"Add {i}"})
+            in_ports, out_port = ("A", "B"), "A+B"
+        for port in in_ports:
+            connect(node_id, port)
+        add_producer(node_id, out_port)
+    for i in range(num_outputs):
+        node_id = f"out{i}"
+        nodes.append({"id": node_id, "type": "OUTPUT", "label": f"Out {i}", "attrs": {"name": f"#out{i}", "data_type": "DECIMAL"}})
+        connect(node_id, "INPUT")
+    for i in range(num_stickers):
+        node = _sticker(i, rng)
+        node.update(id=f"note{i}", label="")
+        nodes.append(node)
+    return {"nodes": nodes, "edges": edges}
@@ -0,0 +1,276 @@
+# content_store.py
+"""
+日志正文的内容寻址存储。
+
+ChipCreation.chip_json_str、AiRequestLog.raw_ai_response / generated_json_str 不再逐行保存原文，
+而是按 UTF-8 文本的 SHA-256 存进 ContentBlob（zlib 压缩），日志行只保存哈希：
+同一个示例芯片被提交上千次也只存一份，AI 回复与提取出的 JSON 相同时两列指向同一个 blob。
+写入由 log_writer 在同一个批量事务里完成（已存在的 blob 不再压缩）；读取用模型上的 *_text 属性，
+列表页先用 attach_texts() 一次取齐一页引用的所有正文。迁移前的旧行哈希为空，属性直接返回原列。
+blob 的个数和字节总数由 store_blobs / delete_unreferenced_blobs 在同一事务里维护为 SiteCounter 行，
+管理面板读计数行，不再对 ContentBlob 求和；命令行的 stats 仍做一次精确统计。
+
+转换旧数据：python content_store.py migrate [--vacuum]，完成后报告节省的空间。
+"""
+import argparse
+import hashlib
+import os
+import zlib
+
+from sqlalchemy import delete, func, insert, literal, select, text, update
+
+from models import db, ContentBlob, ChipCreation, AiRequestLog, SiteCounter
+
+CONTENT_COMPRESS_LEVEL = int(os.environ.get("CONTENT_COMPRESS_LEVEL", "6"))
+
+# 模型 -> [(原文列, 哈希列)]
+BLOB_FIELDS = {
+    ChipCreation: [("chip_json_str", "chip_json_hash")],
+    AiRequestLog: [("raw_ai_response", "raw_ai_response_hash"), ("generated_json_str", "generated_json_hash")],
+}
+_IN_CHUNK = 500  # IN 查询每次最多带的参数个数
+# 计数行名 -> 初始化（计数行不存在时）用的聚合表达式
+BLOB_COUNTERS = {
+    "content_blobs": func.count(),
+    "content_blob_text_bytes": func.coalesce(func.sum(ContentBlob.size), 0),
+    "content_blob_stored_bytes": func.coalesce(func.sum(func.length(ContentBlob.data)), 0),
+}
+
+
+def content_hash(text_value):
+    return hashlib.sha256(text_value.encode('utf-8')).hexdigest()
+
+
+def _placeholder(model, text_field):
+    # 旧库中 chip_json_str 是 NOT NULL，已转存的行写空串
+    return None if model.__table__.c[text_field].nullable else ""
+
+
+def externalize_rows(model, rows):
+    """把待插入的行字典中的原文换成哈希引用（原地修改），返回 {hash: text}，由调用方 store_blobs。"""
+    blobs = {}
+    for text_field, hash_field in BLOB_FIELDS.get(model, ()):
+        placeholder = _placeholder(model, text_field)
+        for row in rows:
+            text_value = row.get(text_field)
+            row[hash_field] = None  # 每行的键集合保持一致，executemany 才能一次插入
+            if not text_value:
+                continue
+            digest = content_hash(text_value)
+            blobs[digest] = text_value
+            row[hash_field] = digest
+            row[text_field] = placeholder
+    return blobs
+
+
+def _existing_hashes(hashes):
+    hashes = list(hashes)
+    found = set()
+    for start in range(0, len(hashes), _IN_CHUNK):
+        chunk = hashes[start:start + _IN_CHUNK]
+        found.update(db.session.scalars(select(ContentBlob.hash).where(ContentBlob.hash.in_(chunk))))
+    return found
+
+
+def _seed_blob_counter(name):
+    query = select(literal(name), BLOB_COUNTERS[name]).select_from(ContentBlob.__table__)
+    return insert(SiteCounter).from_select(['name', 'value'], query).prefix_with("OR IGNORE")
+
+
+def _bump_blob_counters(count, text_bytes, stored_bytes):
+    # 调用方负责事务；计数行不存在时用一次聚合初始化，结果已包含本事务的改动
+    deltas = {"content_blobs": count, "content_blob_text_bytes": text_bytes, "content_blob_stored_bytes": stored_bytes}
+    for name, delta in deltas.items():
+        if not delta:
+            continue
+        updated = db.session.execute(
+            update(SiteCounter).where(SiteCounter.name == name).values(value=SiteCounter.value + delta)).rowcount
+        if not updated:
+            db.session.execute(_seed_blob_counter(name))
+
+
+def store_blobs(blobs):
+    """
+    在调用方的事务中写入还不存在的 blob，返回 (新写入的个数, 压缩后的字节数)。
+    应在插入引用它们的日志行之后调用：此时事务已持有写锁，归档（retention.py）不能在检查与提交之间删掉这些 blob。
+    """
+    if not blobs:
+        return 0, 0
+    existing = _existing_hashes(blobs)
+    rows = []
+    for digest, text_value in blobs.items():
+        if digest in existing:
+            continue
+        raw = text_value.encode('utf-8')
+        rows.append({"hash": digest, "data": zlib.compress(raw, CONTENT_COMPRESS_LEVEL), "size": len(raw)})
+    stored_bytes = sum(len(row["data"]) for row in rows)
+    if rows:
+        # 另一个进程可能刚写入了相同内容
+        db.session.execute(insert(ContentBlob.__table__).prefix_with("OR IGNORE"), rows)
+        _bump_blob_counters(len(rows), sum(row["size"] for row in rows), stored_bytes)
+    return len(rows), stored_bytes
+
+
+def delete_unreferenced_blobs(hashes):
+    """在调用方的事务中删除 hashes 里已没有任何日志行引用的 blob（归档删除行之后调用），返回删除个数。"""
+    hashes = [h for h in set(hashes) if h]
+    deleted = text_bytes = stored_bytes = 0
+    for start in range(0, len(hashes), _IN_CHUNK):
+        chunk = hashes[start:start + _IN_CHUNK]
+        # 先查出要删的 blob 及其大小（调用方已删过行、持有写锁，查与删之间不会有新引用），用于维护计数
+        query = select(ContentBlob.hash, ContentBlob.size, func.length(ContentBlob.data)).where(ContentBlob.hash.in_(chunk))
+        for model, fields in BLOB_FIELDS.items():
+            for _, hash_field in fields:
+                column = getattr(model, hash_field)
+                query = query.where(ContentBlob.hash.notin_(select(column).where(column.in_(chunk))))
+        unreferenced = db.session.execute(query).all()
+        if not unreferenced:
+            continue
+        db.session.execute(delete(ContentBlob).where(ContentBlob.hash.in_([row[0] for row in unreferenced])))
+        deleted += len(unreferenced)
+        text_bytes += sum(row[1] or 0 for row in unreferenced)
+        stored_bytes += sum(row[2] or 0 for row in unreferenced)
+    _bump_blob_counters(-deleted, -text_bytes, -stored_bytes)
+    return deleted
+
+
+def load_texts(hashes):
+    """返回 {hash: 解压后的文本}，找不到的哈希不在结果中。"""
+    hashes = [h for h in set(hashes) if h]
+    texts = {}
+    for start in range(0, len(hashes), _IN_CHUNK):
+        chunk = hashes[start:start + _IN_CHUNK]
+        for digest, data in db.session.execute(select(ContentBlob.hash, ContentBlob.data).where(ContentBlob.hash.in_(chunk))):
+            texts[digest] = zlib.decompress(data).decode('utf-8')
+    return texts
+
+
+def attach_texts(rows):
+    """为一批 ORM 行一次取齐引用的正文，之后读 *_text 属性不再逐行查询。返回 rows。"""
+    hashes = set()
+    for row in rows:
+        for _, hash_field in BLOB_FIELDS.get(type(row), ()):
+            hashes.add(getattr(row, hash_field))
+    texts = load_texts(hashes)
+    for row in rows:
+        row._blob_texts = texts
+    return rows
+
+
+def blob_stats(exact=False):
+    """
+    ContentBlob 的条目数、原文总字节数和压缩后总字节数（需要应用上下文）。默认读 SiteCounter 计数行，
+    只有计数行不存在时才扫描一次；exact=True 时直接对 ContentBlob 求和（命令行用）。
+    """
+    if exact:
+        count, size, stored = db.session.execute(select(*BLOB_COUNTERS.values()).select_from(ContentBlob.__table__)).one()
+    else:
+        values = dict(db.session.query(SiteCounter.name, SiteCounter.value).filter(SiteCounter.name.in_(BLOB_COUNTERS)).all())
+        if len(values) < len(BLOB_COUNTERS):
+            for name in BLOB_COUNTERS:
+                if name not in values:
+                    db.session.execute(_seed_blob_counter(name))
+            db.session.commit()
+            values = dict(db.session.query(SiteCounter.name, SiteCounter.value).filter(SiteCounter.name.in_(BLOB_COUNTERS)).all())
+        count, size, stored = (values[name] for name in BLOB_COUNTERS)
+    return {
+        "blobs": count,
+        "text_bytes": size,
+        "stored_bytes": stored,
+        "compression_ratio": round(1 - stored / size, 4) if size else 0.0,
+    }
+
+
+def _database_bytes():
+    page_count = db.session.execute(text("PRAGMA page_count")).scalar()
+    page_size = db.session.execute(text("PRAGMA page_size")).scalar()
+    free_pages = db.session.execute(text("PRAGMA freelist_count")).scalar()
+    return page_count * page_size, free_pages * page_size
+
+
+def migrate_legacy_rows(batch_size=500):
+    """
+    把哈希为空、原文非空的旧行转存为 blob 并清空原列，每批一个事务，可以中断后重跑。
+    返回 {"rows", "text_bytes", "new_blobs", "blob_bytes"}。需要应用上下文。
+    """
+    report = {"rows": 0, "text_bytes": 0, "new_blobs": 0, "blob_bytes": 0}
+    for model, fields in BLOB_FIELDS.items():
+        columns = [model.id] + [getattr(model, name) for pair in fields for name in pair]
+        last_id = 0
+        while True:
+            batch = db.session.execute(
+                select(*columns).where(model.id > last_id).order_by(model.id).limit(batch_size)).all()
+            if not batch:
+                break
+            last_id = batch[-1].id
+            blobs = {}
+            updates = []
+            for row in batch:
+                values = {}
+                for text_field, hash_field in fields:
+                    text_value = getattr(row, text_field)
+                    if getattr(row, hash_field) is not None or not text_value:
+                        continue
+                    digest = content_hash(text_value)
+                    blobs[digest] = text_value
+                    values[hash_field] = digest
+                    values[text_field] = _placeholder(model, text_field)
+                    report["text_bytes"] += len(text_value.encode('utf-8'))
+                if values:
+                    updates.append((row.id, values))
+            for row_id, values in updates:
+                db.session.execute(update(model).where(model.id == row_id).values(**values))
+            new_blobs, blob_bytes = store_blobs(blobs)
+            db.session.commit()
+            report["rows"] += len(updates)
+            report["new_blobs"] += new_blobs
+            report["blob_bytes"] += blob_bytes
+            if updates:
+                print(f"{model.__tablename__}: 已转换到 id {last_id}，本批 {len(updates)} 行，新增 blob {new_blobs} 个。")
+    return report
+
+
+def _format_bytes(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(n) < 1024 or unit == "GB":
+            return f"{n:.1f}{unit}" if unit != "B" else f"{n}B"
+        n /= 1024
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="日志正文的内容寻址存储：转换旧行、查看占用。")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser("migrate", help="把旧行的正文转存为压缩的 ContentBlob")
+    migrate_parser.add_argument("--batch-size", type=int, default=500, help="每个事务处理的行数")
+    migrate_parser.add_argument("--vacuum", action="store_true", help="完成后执行 VACUUM，把释放的页还给文件系统")
+    subparsers.add_parser("stats", help="查看 ContentBlob 的条目数和压缩率")
+    args = parser.parse_args(argv)
+
+    from app import app  # 只在命令行使用时导入，避免与 log_writer 循环引用
+    from utils import ensure_schema_columns
+
+    with app.app_context():
+        db.create_all()
+        ensure_schema_columns()
+        if args.command == "migrate":
+            before, _ = _database_bytes()
+            report = migrate_legacy_rows(args.batch_size)
+            print(f"转换 {report['rows']} 行：原文 {_format_bytes(report['text_bytes'])}，"
+                  f"新增 {report['new_blobs']} 个 blob 共 {_format_bytes(report['blob_bytes'])}"
+                  f"（节省 {_format_bytes(report['text_bytes'] - report['blob_bytes'])}）。")
+            if args.vacuum:
+                db.session.commit()
+                with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                    conn.execute(text("VACUUM"))
+                after, _ = _database_bytes()
+                print(f"数据库文件 {_format_bytes(before)} -> {_format_bytes(after)}。")
+            else:
+                _, free = _database_bytes()
+                print(f"数据库中有 {_format_bytes(free)} 空闲页；加 --vacuum 可缩小文件。")
+        stats = blob_stats(exact=True)
+        print(f"ContentBlob: {stats['blobs']} 个，原文 {_format_bytes(stats['text_bytes'])}，"
+              f"存储 {_format_bytes(stats['stored_bytes'])}（压缩节省 {stats['compression_ratio'] * 100:.1f}%）。")
+
+
+if __name__ == '__main__':
+    main()
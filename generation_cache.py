@@ -0,0 +1,283 @@
+# generation_cache.py
+"""
+AI 生成结果缓存与相同请求合并（single-flight）。
+
+键为 (规范化后的描述, 模型, 提示词版本) 的 SHA-256，随请求日志一起写入 AiRequestLog.generation_key。
+- 命中：把缓存的 JSON 按 GENERATION_REPLAY_CHUNK_CHARS 切块立即回放，路由照常解析、渲染、记录日志；
+- 未命中但相同的请求正在生成：挂到同一个上游流上，从头读取已经收到的内容。合并还要求 flight_scope 相同
+  （路由传 API Key 的指纹），否则上游的认证/限流错误会传给使用别的 Key 的请求；结果缓存仍在所有 Key 之间共享；
+- 都没有：由后台线程消费上游流（发起的客户端断开也会跑完并写入缓存），所有订阅者读同一个缓冲区。
+只缓存能解析且带 nodes 数组的结果。内存 LRU 未命中时再按 generation_key 查一次数据库（跨进程、重启后仍有效），
+每个进程首次使用时用最近成功的 AiRequestLog 记录预热。
+回放和合并时先产出一个 StreamMeta(source="cache" / "coalesced")，便于路由区分指标；上游的 StreamMeta 原样转发。
+上游的 StreamMeta 表明实际由别的模型（对冲/备用模型）生成时，结果不写入缓存，免得以所选模型的键回放别的模型的输出。
+"""
+import calendar
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from content_store import attach_texts
+from models import AiRequestLog
+from stream_json import StreamMeta, extract_json_text
+
+GENERATION_CACHE_ENABLED = os.environ.get("GENERATION_CACHE", "1") != "0"
+GENERATION_CACHE_MAX = int(os.environ.get("GENERATION_CACHE_MAX", "512"))
+GENERATION_CACHE_TTL = float(os.environ.get("GENERATION_CACHE_TTL", "86400"))
+GENERATION_CACHE_SEED = int(os.environ.get("GENERATION_CACHE_SEED", "500"))
+GENERATION_REPLAY_CHUNK_CHARS = int(os.environ.get("GENERATION_REPLAY_CHUNK_CHARS", "256"))
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+def normalize_description(description):
+    return _WHITESPACE_RE.sub(' ', unicodedata.normalize('NFKC', description)).strip()
+
+
+def generation_key(description, model_name, prompt_version):
+    payload = json.dumps([normalize_description(description), model_name, prompt_version], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def api_key_fingerprint(api_key):
+    """API Key 的短指纹，用作合并范围，不保存 Key 本身。"""
+    return hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()[:16]
+
+
+def cacheable_json(raw_text):
+    """返回可缓存的 JSON 文本（能解析且带 nodes 数组），否则返回 None。"""
+    json_text = extract_json_text(raw_text or "")
+    if json_text is None:
+        return None
+    try:
+        data = json.loads(json_text)
+    except json.JSONDecodeError:
+        return None
+    if isinstance(data, dict) and isinstance(data.get('nodes'), list):
+        return json_text
+    return None
+
+
+class _Flight:
+    """一次进行中的上游生成：收到的文本块按顺序追加，订阅者各自从头读取。"""
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.cond = threading.Condition()
+
+
+class GenerationCache:
+    def __init__(self, enabled=GENERATION_CACHE_ENABLED, max_entries=GENERATION_CACHE_MAX,
+                 ttl=GENERATION_CACHE_TTL, seed_rows=GENERATION_CACHE_SEED,
+                 replay_chunk_chars=GENERATION_REPLAY_CHUNK_CHARS):
+        self.enabled = enabled
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.seed_rows = seed_rows
+        self.replay_chunk_chars = max(1, replay_chunk_chars)
+        self._entries = OrderedDict()  # key -> (json_text, 过期时间戳)
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._seeded_pid = None
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.stored = 0
+
+    def _get_locked(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _put_locked(self, key, json_text, expires_at):
+        self._entries[key] = (json_text, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _recent_rows_query(self):
+        since = datetime.utcnow() - timedelta(seconds=self.ttl)
+        return (AiRequestLog.query
+                .filter(AiRequestLog.succeeded.is_(True), AiRequestLog.created_at >= since)
+                .order_by(AiRequestLog.id.desc()))
+
+    def _row_expiry(self, row):
+        created_at = row.created_at or datetime.utcnow()
+        return calendar.timegm(created_at.utctimetuple()) + self.ttl
+
+    def _ensure_seeded(self):
+        # 需要应用上下文；每个进程只预热一次
+        with self._lock:
+            if self._seeded_pid == os.getpid():
+                return
+            self._seeded_pid = os.getpid()
+            self._entries.clear()
+            self._flights.clear()
+        if self.seed_rows <= 0:
+            return
+        try:
+            rows = (self._recent_rows_query()
+                    .filter(AiRequestLog.generation_key.isnot(None))
+                    .limit(self.seed_rows).all())
+        except SQLAlchemyError as e:
+            print(f"生成结果缓存预热失败: {e}")
+            return
+        attach_texts(rows)
+        seeded = 0
+        with self._lock:
+            for row in reversed(rows):  # 从旧到新放入，最近的记录排在 LRU 末尾
+                json_text = cacheable_json(row.generated_json_text)
+                if json_text is not None:
+                    self._put_locked(row.generation_key, json_text, self._row_expiry(row))
+                    seeded += 1
+        print(f"生成结果缓存已从请求日志预热 {seeded} 条。")
+
+    def _load_from_db(self, key):
+        try:
+            rows = attach_texts(self._recent_rows_query().filter(AiRequestLog.generation_key == key).limit(5).all())
+        except SQLAlchemyError as e:
+            print(f"生成结果缓存查询数据库失败: {e}")
+            return None
+        for row in rows:
+            json_text = cacheable_json(row.generated_json_text)
+            if json_text is not None:
+                with self._lock:
+                    self._put_locked(key, json_text, self._row_expiry(row))
+                return json_text
+        return None
+
+    def stream(self, key, start_upstream, flight_scope=None, model=None):
+        """
+        返回原始文本块（夹带 StreamMeta）的生成器（需在应用上下文中迭代）。start_upstream() 返回上游文本块的迭代器，
+        只有既没有缓存、也没有 flight_scope 相同的同一请求在进行时才会被调用（在调用方线程中调用，在后台线程中迭代）。
+        model 为键对应的模型，上游实际模型与之不同时不缓存结果。
+        """
+        if not self.enabled:
+            yield from start_upstream()
+            return
+        self._ensure_seeded()
+        flight_key = (key, flight_scope)
+        with self._lock:
+            cached = self._get_locked(key)
+            in_flight = flight_key in self._flights
+        if cached is not None:
+            with self._lock:
+                self.hits += 1
+        elif not in_flight:
+            cached = self._load_from_db(key)
+            if cached is not None:
+                with self._lock:
+                    self.db_hits += 1
+        if cached is not None:
+            yield from self._replay(cached)
+            return
+
+        with self._lock:
+            cached = self._get_locked(key)
+            flight = self._flights.get(flight_key)
+            leader = cached is None and flight is None
+            if cached is not None:
+                self.hits += 1
+            elif leader:
+                flight = _Flight()
+                self._flights[flight_key] = flight
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if cached is not None:
+            yield from self._replay(cached)
+            return
+        if not leader:
+            yield StreamMeta(source="coalesced")
+        if leader:
+            # 在调用方线程里创建上游迭代器，调用方可以在断开之前就把资源（如准入槽位）交给它，见 main_routes
+            try:
+                upstream = start_upstream()
+            except Exception as e:
+                flight.error = e
+                self._finish_flight(key, flight_key, flight, model)
+                raise
+            threading.Thread(target=self._run_flight, args=(key, flight_key, flight, upstream, model),
+                             name="generation-flight", daemon=True).start()
+        yield from self._follow(flight)
+
+    def _replay(self, json_text):
+        yield StreamMeta(source="cache")
+        step = self.replay_chunk_chars
+        for start in range(0, len(json_text), step):
+            yield json_text[start:start + step]
+
+    def _run_flight(self, key, flight_key, flight, upstream, model=None):
+        try:
+            for chunk in upstream:
+                with flight.cond:
+                    flight.chunks.append(chunk if isinstance(chunk, (str, StreamMeta)) else str(chunk))
+                    flight.cond.notify_all()
+        except Exception as e:
+            flight.error = e
+        finally:
+            self._finish_flight(key, flight_key, flight, model)
+
+    def _finish_flight(self, key, flight_key, flight, model):
+        served_models = {c.fields["model"] for c in flight.chunks if isinstance(c, StreamMeta) and c.fields.get("model")}
+        if flight.error is not None or (model is not None and served_models - {model}):
+            json_text = None
+        else:
+            json_text = cacheable_json("".join(c for c in flight.chunks if isinstance(c, str)))
+        with self._lock:
+            if json_text is not None:
+                self._put_locked(key, json_text, time.time() + self.ttl)
+                self.stored += 1
+            self._flights.pop(flight_key, None)
+        with flight.cond:
+            flight.done = True
+            flight.cond.notify_all()
+
+    def _follow(self, flight):
+        position = 0
+        while True:
+            with flight.cond:
+                while position >= len(flight.chunks) and not flight.done:
+                    flight.cond.wait()
+                new_chunks = flight.chunks[position:]
+                position = len(flight.chunks)
+                done = flight.done
+            yield from new_chunks
+            if done:
+                if flight.error is not None:
+                    raise flight.error
+                return
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.db_hits + self.misses + self.coalesced
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "in_flight": len(self._flights),
+                "hits": self.hits,
+                "db_hits": self.db_hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "stored": self.stored,
+                "hit_rate": round((self.hits + self.db_hits + self.coalesced) / lookups, 4) if lookups else 0.0,
+            }
+
+
+generation_cache = GenerationCache()
@@ -0,0 +1,176 @@
+# generation_policy.py
+"""
+AI 生成的重试 / 对冲 / 备用模型策略。
+
+只在收到第一个 token 之前生效（已经转发给前端的内容无法拼接到另一次生成上）。
+"首个 token" 指上游的第一个增量，推理模型先输出的 reasoning_content 也算（open_stream 此时先产出一个 StreamMeta）：
+- 暂时性失败（限流、连接错误/超时、408/409/429/5xx）按带抖动的指数退避重试 AI_RETRY_ATTEMPTS 次；
+- 异步路径上，主模型超过 AI_HEDGE_AFTER 秒仍没有首个 token 时，同时向备用模型发起请求，
+  谁先产出首个 token 就转发谁，另一个立即取消（关闭其上游连接）。默认关闭（0），需要时显式配置；
+- 主模型重试用尽仍是暂时性失败时，改用备用模型（同步路径只有这一步，没有对冲）。
+open_stream(model) 返回该模型的文本块（异步）生成器，创建请求的异常在第一次取值时抛出。
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+
+import openai
+
+AI_RETRY_ATTEMPTS = int(os.environ.get("AI_RETRY_ATTEMPTS", "2"))
+AI_RETRY_BASE_DELAY = float(os.environ.get("AI_RETRY_BASE_DELAY", "0.5"))
+AI_RETRY_MAX_DELAY = float(os.environ.get("AI_RETRY_MAX_DELAY", "4"))
+AI_HEDGE_AFTER = float(os.environ.get("AI_HEDGE_AFTER", "0"))
+
+TRANSIENT_STATUS_CODES = (408, 409, 429)
+
+
+def is_transient(error):
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in TRANSIENT_STATUS_CODES or error.status_code >= 500
+    return False
+
+
+def backoff_delay(attempt, base=AI_RETRY_BASE_DELAY, cap=AI_RETRY_MAX_DELAY):
+    # full jitter：在 [0, min(cap, base * 2^attempt)] 内均匀取值，避免大量请求同时重试
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class PolicyStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.fallbacks = 0
+
+    def count(self, field):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "retries": self.retries,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "fallbacks": self.fallbacks,
+            }
+
+
+policy_stats = PolicyStats()
+
+
+def retrying_stream(open_stream, model, fallback_model=None, retries=AI_RETRY_ATTEMPTS):
+    """同步路径：首个 token 之前重试暂时性失败，重试用尽后改用备用模型。"""
+    models = [model] + ([fallback_model] if fallback_model and fallback_model != model else [])
+    for index, current_model in enumerate(models):
+        attempt = 0
+        while True:
+            stream = open_stream(current_model)
+            try:
+                first = next(stream)
+            except StopIteration:
+                return
+            except Exception as e:
+                if not is_transient(e):
+                    raise
+                if attempt < retries:
+                    delay = backoff_delay(attempt)
+                    attempt += 1
+                    policy_stats.count('retries')
+                    print(f"AI Service (policy): 模型 '{current_model}' 暂时失败（{type(e).__name__}），{delay:.2f}s 后第 {attempt} 次重试。")
+                    time.sleep(delay)
+                    continue
+                if index + 1 < len(models):
+                    policy_stats.count('fallbacks')
+                    print(f"AI Service (policy): 模型 '{current_model}' 重试用尽，改用备用模型 '{models[index + 1]}'。")
+                    break
+                raise
+            yield first
+            yield from stream
+            return
+
+
+async def _afirst_chunk(open_stream, model, retries):
+    attempt = 0
+    while True:
+        stream = open_stream(model)
+        try:
+            return stream, await stream.__anext__()
+        except StopAsyncIteration:
+            return stream, None
+        except Exception as e:
+            if attempt >= retries or not is_transient(e):
+                raise
+            delay = backoff_delay(attempt)
+            attempt += 1
+            policy_stats.count('retries')
+            print(f"AI Service (policy): 模型 '{model}' 暂时失败（{type(e).__name__}），{delay:.2f}s 后第 {attempt} 次重试。")
+            await asyncio.sleep(delay)
+
+
+async def ahedged_stream(open_stream, model, fallback_model=None, retries=AI_RETRY_ATTEMPTS, hedge_after=AI_HEDGE_AFTER):
+    """异步路径：重试 + 对冲 + 备用模型，转发最先产出首个 token 的那一路。"""
+    if fallback_model == model:
+        fallback_model = None
+    task_models = {}
+    winner = None
+    winner_stream = None
+
+    def start(task_model):
+        task = asyncio.ensure_future(_afirst_chunk(open_stream, task_model, retries))
+        task_models[task] = task_model
+        return task
+
+    try:
+        pending = {start(model)}
+        second_started = fallback_model is None
+        last_error = None
+        while pending and winner is None:
+            timeout = hedge_after if not second_started and hedge_after > 0 else None
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                second_started = True
+                pending.add(start(fallback_model))
+                policy_stats.count('hedges')
+                print(f"AI Service (policy): 模型 '{model}' {hedge_after:.1f}s 内没有首个 token，对冲请求备用模型 '{fallback_model}'。")
+                continue
+            for task in done:
+                if task.exception() is None:
+                    if winner is None:
+                        winner = task
+                else:
+                    last_error = task.exception()
+            if winner is None and not pending and not second_started and is_transient(last_error):
+                second_started = True
+                pending.add(start(fallback_model))
+                policy_stats.count('fallbacks')
+                print(f"AI Service (policy): 模型 '{model}' 重试用尽，改用备用模型 '{fallback_model}'。")
+        if winner is None:
+            raise last_error
+        winner_stream, first = winner.result()
+        if task_models[winner] != model:
+            policy_stats.count('hedge_wins')
+            print(f"AI Service (policy): 由备用模型 '{task_models[winner]}' 完成本次生成。")
+        for task in task_models:
+            if task is not winner and not task.done():
+                task.cancel()
+        if first is None:
+            return
+        yield first
+        async for chunk in winner_stream:
+            yield chunk
+    finally:
+        for task in task_models:
+            if task is winner:
+                continue
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled() and task.exception() is None:
+                await task.result()[0].aclose()  # 同时拿到首个 token 的另一路
+        if winner_stream is not None:
+            await winner_stream.aclose()
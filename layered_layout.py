@@ -0,0 +1,279 @@
+# layered_layout.py
+"""
+纯 Python 的分层（Sugiyama 风格）布局引擎，用于从左到右的芯片图。
+
+不需要 fork Graphviz 的 dot 进程，返回值与 chip_logic.compute_graphviz_layout 相同：
+{node_id: (x, y)}，坐标系与 Graphviz 一致（y 轴向上，SVG 阶段会再翻转）。
+
+步骤：
+1. 去环：DFS 找出回边并反向；
+2. 分层：最长路径分层，再把纯源点（常量、输入）拉到紧挨其后继的前一层；
+3. 跨多层的边插入虚拟节点；
+4. 减少交叉：逐层重心排序，上下交替扫描，保留交叉数最少的顺序；
+5. 坐标分配：x 按每层最大宽度累加；y 在保持层内顺序和最小间距的前提下，
+   用保序回归（PAVA）把节点拉向相邻层邻居的平均位置，尊重每个节点的实际高度。
+"""
+from bisect import bisect_right
+
+DEFAULT_NODE_SEP = 72.0   # 同层相邻节点的间距 (pt)，对应 Graphviz nodesep=1.0
+DEFAULT_RANK_SEP = 108.0  # 相邻层之间的间距 (pt)，对应 Graphviz ranksep=1.5
+DUMMY_NODE_HEIGHT = 10.0
+DEFAULT_SWEEPS = 4
+DEFAULT_REFINE_PASSES = 4
+# 虚拟节点总数超过 (节点数+边数) 的这个倍数时，不再为长边插入虚拟节点，
+# 而是让长边直接参与相邻层的重心计算，避免病态图（大量超长边）把布局拖成二次复杂度
+DUMMY_BUDGET_FACTOR = 4
+
+
+def _break_cycles(n, adjacency):
+    """迭代式DFS，返回需要反向的回边集合 {(u, v)}。"""
+    state = [0] * n  # 0=未访问 1=在栈上 2=已完成
+    back_edges = set()
+    for root in range(n):
+        if state[root]:
+            continue
+        state[root] = 1
+        stack = [(root, iter(adjacency[root]))]
+        while stack:
+            u, successors = stack[-1]
+            for v in successors:
+                if state[v] == 0:
+                    state[v] = 1
+                    stack.append((v, iter(adjacency[v])))
+                    break
+                if state[v] == 1:
+                    back_edges.add((u, v))
+            else:
+                state[u] = 2
+                stack.pop()
+    return back_edges
+
+
+def _topological_order(n, successors, in_degree):
+    in_degree = list(in_degree)
+    order = [u for u in range(n) if in_degree[u] == 0]
+    head = 0
+    while head < len(order):
+        u = order[head]
+        head += 1
+        for v in successors[u]:
+            in_degree[v] -= 1
+            if in_degree[v] == 0:
+                order.append(v)
+    return order
+
+
+def _assign_ranks(n, successors, predecessors, topo_order):
+    rank = [0] * n
+    for u in topo_order:
+        for v in successors[u]:
+            if rank[v] < rank[u] + 1:
+                rank[v] = rank[u] + 1
+    # 纯源点（没有前驱的常量、输入等）靠近它们的第一个使用者，避免长边横穿整张图
+    for u in reversed(topo_order):
+        if not predecessors[u] and successors[u]:
+            rank[u] = min(rank[v] for v in successors[u]) - 1
+    return rank
+
+
+def _count_inversions(sequence):
+    """用树状数组统计逆序对数量，O(m log m)。"""
+    if not sequence:
+        return 0
+    values = sorted(set(sequence))
+    size = len(values)
+    tree = [0] * (size + 1)
+    inversions = 0
+    for seen, value in enumerate(sequence):
+        idx = bisect_right(values, value)
+        # 已插入元素中 <= value 的数量
+        not_greater = 0
+        i = idx
+        while i > 0:
+            not_greater += tree[i]
+            i -= i & -i
+        inversions += seen - not_greater
+        i = idx
+        while i <= size:
+            tree[i] += 1
+            i += i & -i
+    return inversions
+
+
+def _count_crossings(layers, down, position):
+    total = 0
+    for layer in layers[:-1]:
+        pairs = []
+        for u in layer:
+            pu = position[u]
+            for v in down[u]:
+                pairs.append((pu, position[v]))
+        pairs.sort()
+        total += _count_inversions([pv for _, pv in pairs])
+    return total
+
+
+def _reorder_layer(layer, neighbors, position):
+    def barycenter(u):
+        adjacent = neighbors[u]
+        if not adjacent:
+            return position[u]
+        return sum(position[v] for v in adjacent) / len(adjacent)
+    layer.sort(key=barycenter)
+    for idx, u in enumerate(layer):
+        position[u] = idx
+
+
+def _isotonic_place(layer, desired, heights, node_sep, is_dummy):
+    """
+    在"层内顺序不变、相邻节点至少间隔 node_sep"的约束下，
+    求与 desired 平方误差最小的 y 坐标（PAVA 保序回归，O(k)）。
+    """
+    k = len(layer)
+    offsets = [0.0] * k
+    for i in range(1, k):
+        a, b = layer[i - 1], layer[i]
+        gap = node_sep / 2 if (is_dummy[a] or is_dummy[b]) else node_sep
+        offsets[i] = offsets[i - 1] + heights[a] / 2 + gap + heights[b] / 2
+    blocks = []  # [总和, 数量]
+    for i in range(k):
+        blocks.append([desired[i] - offsets[i], 1])
+        while len(blocks) > 1 and blocks[-2][0] * blocks[-1][1] > blocks[-1][0] * blocks[-2][1]:
+            total, count = blocks.pop()
+            blocks[-1][0] += total
+            blocks[-1][1] += count
+    result = []
+    for total, count in blocks:
+        mean = total / count
+        result.extend([mean] * count)
+    return [result[i] + offsets[i] for i in range(k)]
+
+
+def layered_layout(node_sizes, edges, node_sep=DEFAULT_NODE_SEP, rank_sep=DEFAULT_RANK_SEP,
+                   sweeps=DEFAULT_SWEEPS, refine_passes=DEFAULT_REFINE_PASSES, insert_dummies=True):
+    """
+    node_sizes: 有序字典 {node_id: (width, height)}，单位 pt。
+    edges: [(from_node_id, to_node_id), ...]，端点不在 node_sizes 中的边和自环会被忽略。
+    insert_dummies: 是否为跨层长边插入虚拟节点（超出 DUMMY_BUDGET_FACTOR 预算时自动关闭）。
+    返回 {node_id: (x, y)}，Graphviz 坐标系（y 轴向上）。
+    """
+    node_ids = list(node_sizes.keys())
+    n_real = len(node_ids)
+    if n_real == 0:
+        return {}
+    index_of = {node_id: i for i, node_id in enumerate(node_ids)}
+
+    # 用 dict 去重并保持输入顺序（结果确定，且不需要 O(E log E) 的排序）
+    edge_set = {}
+    for from_id, to_id in edges:
+        u = index_of.get(from_id)
+        v = index_of.get(to_id)
+        if u is None or v is None or u == v:
+            continue
+        edge_set[(u, v)] = None
+    adjacency = [[] for _ in range(n_real)]
+    for u, v in edge_set:
+        adjacency[u].append(v)
+    back_edges = _break_cycles(n_real, adjacency)
+    dag_edges = list(dict.fromkeys((v, u) if (u, v) in back_edges else (u, v) for (u, v) in edge_set))
+
+    successors = [[] for _ in range(n_real)]
+    predecessors = [[] for _ in range(n_real)]
+    in_degree = [0] * n_real
+    for u, v in dag_edges:
+        successors[u].append(v)
+        predecessors[v].append(u)
+        in_degree[v] += 1
+    topo_order = _topological_order(n_real, successors, in_degree)
+    rank = _assign_ranks(n_real, successors, predecessors, topo_order)
+
+    # --- 构建分层结构（含虚拟节点）---
+    widths = [float(node_sizes[node_id][0]) for node_id in node_ids]
+    heights = [float(node_sizes[node_id][1]) for node_id in node_ids]
+    is_dummy = [False] * n_real
+    down = [[] for _ in range(n_real)]
+    up = [[] for _ in range(n_real)]
+    num_ranks = max(rank) + 1
+    layers = [[] for _ in range(num_ranks)]
+
+    def new_dummy(r):
+        rank.append(r)
+        widths.append(0.0)
+        heights.append(DUMMY_NODE_HEIGHT)
+        is_dummy.append(True)
+        down.append([])
+        up.append([])
+        layers[r].append(len(rank) - 1)
+        return len(rank) - 1
+
+    if insert_dummies:
+        dummy_count = sum(rank[v] - rank[u] - 1 for u, v in dag_edges)
+        insert_dummies = dummy_count <= DUMMY_BUDGET_FACTOR * (n_real + len(dag_edges))
+    for u in topo_order:
+        layers[rank[u]].append(u)
+    for u in topo_order:
+        for v in successors[u]:
+            prev = u
+            if insert_dummies:
+                for r in range(rank[u] + 1, rank[v]):
+                    dummy = new_dummy(r)
+                    down[prev].append(dummy)
+                    up[dummy].append(prev)
+                    prev = dummy
+            down[prev].append(v)
+            up[v].append(prev)
+
+    # --- 减少交叉 ---
+    position = [0] * len(rank)
+    for layer in layers:
+        for idx, u in enumerate(layer):
+            position[u] = idx
+    if sweeps > 0 and num_ranks > 1:
+        best_crossings = _count_crossings(layers, down, position)
+        best_layers = [list(layer) for layer in layers]
+        for _ in range(sweeps):
+            if best_crossings == 0:
+                break
+            for r in range(1, num_ranks):
+                _reorder_layer(layers[r], up, position)
+            for r in range(num_ranks - 2, -1, -1):
+                _reorder_layer(layers[r], down, position)
+            crossings = _count_crossings(layers, down, position)
+            if crossings < best_crossings:
+                best_crossings = crossings
+                best_layers = [list(layer) for layer in layers]
+        layers = best_layers
+        for layer in layers:
+            for idx, u in enumerate(layer):
+                position[u] = idx
+
+    # --- 坐标分配 ---
+    x_center = []
+    x_start = 0.0
+    for layer in layers:
+        layer_width = max((widths[u] for u in layer), default=0.0)
+        x_center.append(x_start + layer_width / 2)
+        x_start += layer_width + rank_sep
+
+    y = [0.0] * len(rank)
+    for layer in layers:
+        placed = _isotonic_place(layer, [0.0] * len(layer), heights, node_sep, is_dummy)
+        for u, yu in zip(layer, placed):
+            y[u] = yu
+
+    def refine(layer_indices, neighbor_lists):
+        for r in layer_indices:
+            layer = layers[r]
+            desired = []
+            for u in layer:
+                adjacent = neighbor_lists(u)
+                desired.append(sum(y[v] for v in adjacent) / len(adjacent) if adjacent else y[u])
+            for u, yu in zip(layer, _isotonic_place(layer, desired, heights, node_sep, is_dummy)):
+                y[u] = yu
+
+    for _ in range(refine_passes):
+        refine(range(1, num_ranks), lambda u: up[u])
+        refine(range(num_ranks - 2, -1, -1), lambda u: down[u])
+    refine(range(num_ranks), lambda u: up[u] + down[u])
+
+    return {node_ids[u]: (x_center[rank[u]], -y[u]) for u in range(n_real)}
@@ -0,0 +1,224 @@
+# log_writer.py
+"""
+AiRequestLog / ChipCreation 的后台批量写入。
+
+请求线程只把 (模型类, 字段) 放进有界队列；后台线程攒够 LOG_WRITER_BATCH_SIZE 行
+或等待 LOG_WRITER_FLUSH_INTERVAL 秒后，用一次事务（executemany）提交整批，
+SQLite 上每批只有一次 fsync。队列满时最多等待 LOG_WRITER_PUT_TIMEOUT 秒，仍然满就丢弃该行并计数。
+进程退出时（atexit）会把队列中剩余的行全部写完。
+通过 count_rows() 登记的计数（如管理面板的总请求数）在同一个事务里对 SiteCounter 行做 value = value + n，
+计数行不存在时用一次 COUNT(*) 初始化，之后读取总数不再扫描日志表。
+日志正文（芯片JSON、AI回复）在同一个事务里去重压缩写入 ContentBlob，日志行只保存哈希，见 content_store.py。
+批次因 OperationalError（如 "database is locked"）失败时回滚后重试，最多 LOG_WRITER_RETRIES 次，
+等待时间从 LOG_WRITER_RETRY_BACKOFF 秒起每次翻倍；仍然失败或遇到其它数据库错误才丢弃整批并计入 failed。
+"""
+import atexit
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import func, insert, literal, select, update
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+
+from models import db, SiteCounter, ChipCreation, AiRequestLog
+from content_store import externalize_rows, store_blobs
+
+LOG_WRITER_QUEUE_SIZE = int(os.environ.get("LOG_WRITER_QUEUE_SIZE", "10000"))
+LOG_WRITER_BATCH_SIZE = int(os.environ.get("LOG_WRITER_BATCH_SIZE", "200"))
+LOG_WRITER_FLUSH_INTERVAL = float(os.environ.get("LOG_WRITER_FLUSH_INTERVAL", "0.5"))
+LOG_WRITER_PUT_TIMEOUT = float(os.environ.get("LOG_WRITER_PUT_TIMEOUT", "0.05"))
+LOG_WRITER_RETRIES = int(os.environ.get("LOG_WRITER_RETRIES", "3"))
+LOG_WRITER_RETRY_BACKOFF = float(os.environ.get("LOG_WRITER_RETRY_BACKOFF", "0.2"))
+
+_STOP = object()
+
+
+class LogWriter:
+    def __init__(self, queue_size=LOG_WRITER_QUEUE_SIZE, batch_size=LOG_WRITER_BATCH_SIZE,
+                 flush_interval=LOG_WRITER_FLUSH_INTERVAL, put_timeout=LOG_WRITER_PUT_TIMEOUT,
+                 retries=LOG_WRITER_RETRIES, retry_backoff=LOG_WRITER_RETRY_BACKOFF):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.retries = max(0, retries)
+        self.retry_backoff = retry_backoff
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._app = None
+        self._thread = None
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._counters = {}  # 模型类 -> [(计数名, 条件字段字典)]
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.retried = 0
+        self.batches = 0
+
+    def init_app(self, app):
+        self._app = app
+        atexit.register(self.shutdown)
+
+    def count_rows(self, model, name, **where):
+        """登记一个随批量写入维护的计数：model 每写入一行满足 where（字段相等）的记录，计数 name 加一。"""
+        self._counters.setdefault(model, []).append((name, where))
+
+    def _seed_counter_query(self, model, name, where):
+        count_query = select(literal(name), func.count()).select_from(model.__table__)
+        for field, value in where.items():
+            count_query = count_query.where(model.__table__.c[field] == value)
+        return insert(SiteCounter).from_select(['name', 'value'], count_query).prefix_with("OR IGNORE")
+
+    def _bump_counters(self, model, rows):
+        # 调用方负责事务；日志行已在同一事务中插入，初始化时的 COUNT(*) 已包含它们
+        for name, where in self._counters.get(model, ()):
+            delta = sum(1 for row in rows if all(row.get(field) == value for field, value in where.items()))
+            if not delta:
+                continue
+            updated = db.session.execute(
+                update(SiteCounter).where(SiteCounter.name == name).values(value=SiteCounter.value + delta)).rowcount
+            if not updated:
+                db.session.execute(self._seed_counter_query(model, name, where))
+
+    def counter_values(self):
+        """返回所有已登记计数的当前值（需要应用上下文）。只有计数行不存在时才会扫描一次日志表来初始化。"""
+        names = {name: (model, where) for model, counters in self._counters.items() for name, where in counters}
+        values = dict(db.session.query(SiteCounter.name, SiteCounter.value).filter(SiteCounter.name.in_(names)).all())
+        missing = [name for name in names if name not in values]
+        if missing:
+            for name in missing:
+                model, where = names[name]
+                db.session.execute(self._seed_counter_query(model, name, where))
+            db.session.commit()
+            values = dict(db.session.query(SiteCounter.name, SiteCounter.value).filter(SiteCounter.name.in_(names)).all())
+        return values
+
+    def _count(self, field, delta=1):
+        with self._stats_lock:
+            setattr(self, field, getattr(self, field) + delta)
+
+    def _ensure_started(self):
+        if self._started_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._started_pid == os.getpid():
+                return
+            if self._started_pid is not None:
+                # fork 出的子进程：父进程队列里的内容由父进程负责写入
+                self._queue = queue.Queue(maxsize=self._queue.maxsize)
+            self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+            self._thread.start()
+            self._started_pid = os.getpid()
+
+    def submit(self, model, **fields):
+        """把一行日志放入写入队列，返回是否成功入队（队列满而被丢弃时为 False）。"""
+        if "created_at" in model.__table__.columns and "created_at" not in fields:
+            fields["created_at"] = datetime.utcnow()  # 记录请求发生的时间，而不是写入的时间
+        self._ensure_started()
+        try:
+            self._queue.put((model, fields), timeout=self.put_timeout)
+        except queue.Full:
+            self._count('dropped')
+            print(f"日志写入队列已满，丢弃一条 {model.__name__} 记录。")
+            return False
+        self._count('submitted')
+        return True
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch):
+        rows_by_model = {}
+        for model, fields in batch:
+            rows_by_model.setdefault(model, []).append(fields)
+        # externalize_rows 原地替换正文，只能做一次；重试时复用同一批行和 blob
+        blobs = {}
+        for model, rows in rows_by_model.items():
+            blobs.update(externalize_rows(model, rows))
+        attempt = 0
+        while True:
+            try:
+                with self._app.app_context():
+                    for model, rows in rows_by_model.items():
+                        db.session.execute(insert(model), rows)
+                        self._bump_counters(model, rows)
+                    store_blobs(blobs)  # 在行之后写入，见 content_store.store_blobs
+                    db.session.commit()
+                break
+            except SQLAlchemyError as e:
+                self._rollback()
+                if isinstance(e, OperationalError) and attempt < self.retries:
+                    delay = self.retry_backoff * (2 ** attempt)
+                    attempt += 1
+                    self._count('retried')
+                    print(f"批量写入 {len(batch)} 条日志失败（{e.orig}），{delay:.1f} 秒后第 {attempt} 次重试。")
+                    time.sleep(delay)
+                    continue
+                self._count('failed', len(batch))
+                print(f"批量写入 {len(batch)} 条日志失败: {e}")
+                return
+        self._count('written', len(batch))
+        self._count('batches')
+
+    def _rollback(self):
+        try:
+            with self._app.app_context():
+                db.session.rollback()
+        except SQLAlchemyError:
+            pass
+
+    def shutdown(self, timeout=10):
+        """停止后台线程，写完队列中剩余的行。"""
+        if self._started_pid != os.getpid() or self._thread is None:
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            print("日志写入队列在退出时仍然是满的，部分记录可能丢失。")
+            return
+        self._thread.join(timeout)
+        self._started_pid = None
+        self._thread = None
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "queued": self._queue.qsize(),
+                "queue_size": self._queue.maxsize,
+                "submitted": self.submitted,
+                "written": self.written,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "retried": self.retried,
+                "batches": self.batches,
+            }
+
+
+log_writer = LogWriter()
+# 管理面板上的总数，随日志批量写入增量维护
+log_writer.count_rows(ChipCreation, 'chip_creations')
+log_writer.count_rows(AiRequestLog, 'ai_requests')
+log_writer.count_rows(AiRequestLog, 'ai_requests_succeeded', succeeded=True)
@@ -1,13 +1,23 @@
 import json
+import os
+import time
 import traceback
-from flask import Blueprint, render_template, request, jsonify, Response, current_app
-from flask_login import login_required, current_user, copy_current_request_context
+from flask import Blueprint, render_template, request, jsonify, Response, stream_with_context
+from flask_login import login_required, current_user
 
-from models import db, ChipCreation, AiRequestLog
-from chip_logic import chip_json_to_svg_html
-from ai_service import generate_chip_json_stream, get_available_models
+from models import ChipCreation, AiRequestLog
+from log_writer import log_writer
+from render_executor import render_executor, RenderPoolBusy, RenderTimeout
+from ai_service import stream_chip_json, get_available_models, metric_model_label, DEFAULT_CHAT_MODEL, PROMPT_VERSION
+from generation_cache import api_key_fingerprint, generation_cache, generation_key
+from render_cache import render_cache, chip_render_key
+from chip_logic import LARGE_GRAPH_NODE_THRESHOLD, effective_layout_engine
+from render_sessions import render_sessions, PreviewRenderer, PatchError, PatchTooLarge
+from stream_json import ChipStreamParser, StreamMeta, extract_json_text
+from metrics import observe_ai_request, observe_render
+from admission import ai_admission, AdmissionRejected, AdmissionTimeout
+from site_counter import get_visit_count
 from utils import (
-    get_visit_count,
     get_api_key_for_user,
     save_api_key_for_user,
 )
@@ -67,14 +77,14 @@ def get_ai_models_route():
     api_key = get_api_key_for_user(current_user.username)
     print(f"获取模型列表：用户 {current_user.username} 的 API Key 长度为 {len(api_key) if api_key else 0}。")
     try:
-        models, error = get_available_models(api_key)
+        models, error, refreshing = get_available_models(api_key)
         if error:
             status_code = 401 if "API Key" in error or "认证失败" in error else 500
             return jsonify({"success": False, "error": f"无法获取模型列表: {error}"}), status_code
         if not isinstance(models, list) or not all(isinstance(m, str) for m in models):
             print(f"get_available_models 返回的格式不正确: {models}")
             return jsonify({"success": False, "error": "从AI服务获取的模型列表格式不正确。"}), 500
-        return jsonify({"success": True, "models": models})
+        return jsonify({"success": True, "models": models, "refreshing": refreshing})
     except Exception as e:
         print(f"获取AI模型列表时发生严重服务器错误: {e}")
         traceback.print_exc()
@@ -101,33 +111,74 @@ def generate_chip_ai_stream_route():
             yield f"data: {json.dumps({'error': 'API Key未提供或未保存。请在高级工具中设置。'})}\n\n"
             return
         return Response(error_stream_key(), mimetype='text/event-stream')
+    # 限速与并发上限（跨 worker 共享，见 admission.py）：超限立即 429，全局满时排队
+    try:
+        ticket = ai_admission.admit(logged_in_username)
+    except AdmissionRejected as e:
+        print(f"AI request by '{logged_in_username}' rejected: {e}")
+        return jsonify({"success": False, "error": str(e)}), 429, {"Retry-After": str(e.retry_after)}
     print(f"Streaming AI request for user '{logged_in_username}' using API key (length: {len(current_api_key)}), Model: '{model_name_from_form}'")
     raw_response_accumulator = []
 
-    @copy_current_request_context
     def event_stream_with_logging(username_for_log, current_api_key_for_stream, selected_model, ip_addr, user_agent_str):
         succeeded_parsing_json = False
         final_generated_json_str = None
         ai_error_message = None
+        # 边接收边解析：nodes / edges 中的元素一闭合就推送 node / edge 事件，并定期推送局部渲染结果
+        chip_parser = ChipStreamParser()
+        last_partial_at = 0.0
+        partial_progress = (0, 0)
+        preview = PreviewRenderer()
+        # 延迟与用量：StreamMeta 带来实际模型（可能是备用模型）、token 用量和结果来源
+        started_at = time.monotonic()
+        first_chunk_at = None
+        chunk_count = 0
+        stream_info = {"source": "upstream"}
+        # 相同的 (描述, 模型, 提示词版本) 直接回放缓存，或挂到使用同一 API Key 的、正在进行的同一次生成上
+        model_to_use = (selected_model or '').strip() or DEFAULT_CHAT_MODEL
+        cache_key = generation_key(user_description, model_to_use, PROMPT_VERSION)
+        def start_upstream():
+            # 上游在生成线程里跑完（客户端断开也一样），准入槽位要一直占到上游结束
+            ai_admission.hold(ticket)
+            return _holding_slot(ticket, stream_chip_json(user_description, current_api_key_for_stream, selected_model))
+
+        upstream_chunks = generation_cache.stream(
+            cache_key, start_upstream,
+            flight_scope=api_key_fingerprint(current_api_key_for_stream), model=model_to_use)
         try:
-            for chunk in generate_chip_json_stream(user_description, current_api_key_for_stream, selected_model):
+            for chunk in upstream_chunks:
+                if isinstance(chunk, StreamMeta):
+                    stream_info.update(chunk.fields)
+                    continue
+                if first_chunk_at is None:
+                    first_chunk_at = time.monotonic()
+                chunk_count += 1
                 if isinstance(chunk, str):
                     raw_response_accumulator.append(chunk)
                 else:
                     print(f"警告：AI流收到非字符串块: {type(chunk)}, value: {chunk}")
                     raw_response_accumulator.append(str(chunk))
                 yield f"data: {json.dumps({'content': str(chunk)})}\n\n"
-            yield f"data: {json.dumps({'event': 'done'})}\n\n"
+                for kind, element in chip_parser.feed(str(chunk)):
+                    yield _sse({'event': kind, kind: element})
+                progress = (len(chip_parser.nodes), len(chip_parser.edges))
+                if (AI_PARTIAL_RENDER_INTERVAL > 0 and 0 < progress[0] <= LARGE_GRAPH_NODE_THRESHOLD
+                        and progress != partial_progress):
+                    # 整个JSON刚闭合时立即更新预览，否则按间隔节流
+                    if chip_parser.finished or time.monotonic() - last_partial_at >= AI_PARTIAL_RENDER_INTERVAL:
+                        partial_chip = chip_parser.chip_data()
+                        update = _render_preview(preview, partial_chip, final=chip_parser.finished)
+                        last_partial_at = time.monotonic()
+                        partial_progress = progress
+                        if update is not None:
+                            counts = {'nodes': len(partial_chip["nodes"]), 'edges': len(partial_chip["edges"]), 'complete': chip_parser.finished}
+                            if "html" in update:
+                                yield _sse({'event': 'partial_svg', 'html': update["html"], **counts})
+                            else:
+                                yield _sse({'event': 'partial_patch', 'changes': update, **counts})
             full_raw_response = "".join(map(str, raw_response_accumulator))
-            json_candidate_str = full_raw_response.strip()
-            if json_candidate_str.startswith("```json"):
-                json_candidate_str = json_candidate_str[7:].strip()
-            if json_candidate_str.endswith("```"):
-                json_candidate_str = json_candidate_str[:-3].strip()
-            first_brace = json_candidate_str.find('{')
-            last_brace = json_candidate_str.rfind('}')
-            if first_brace != -1 and last_brace != -1 and first_brace < last_brace:
-                final_generated_json_str = json_candidate_str[first_brace: last_brace + 1]
+            final_generated_json_str = extract_json_text(full_raw_response)
+            if final_generated_json_str is not None:
                 try:
                     json.loads(final_generated_json_str)
                     succeeded_parsing_json = True
@@ -146,7 +197,14 @@ def generate_chip_ai_stream_route():
             traceback.print_exc()
             yield f"data: {json.dumps({'error': ai_error_message})}\n\n"
         finally:
-            log_entry = AiRequestLog(
+            duration = time.monotonic() - started_at
+            ttft = first_chunk_at - started_at if first_chunk_at is not None else None
+            served_model = stream_info.get("model") or model_to_use
+            from_upstream = stream_info["source"] == "upstream"
+            observe_ai_request(metric_model_label(served_model), stream_info["source"], succeeded_parsing_json, ttft, duration, chunk_count,
+                               stream_info.get("prompt_tokens"), stream_info.get("completion_tokens"))
+            log_writer.submit(
+                AiRequestLog,
                 username=username_for_log,
                 description=user_description,
                 raw_ai_response="".join(map(str, raw_response_accumulator)),
@@ -155,24 +213,151 @@ def generate_chip_ai_stream_route():
                 error_message=ai_error_message,
                 ip_address=ip_addr,
                 user_agent=user_agent_str,
+                model_name=served_model,
+                # 备用模型的结果按实际模型记键，之后只在请求该模型时才从数据库回放
+                generation_key=cache_key if served_model == model_to_use else generation_key(user_description, served_model, PROMPT_VERSION),
+                result_source=stream_info["source"],
+                ttft_ms=round(ttft * 1000) if ttft is not None else None,
+                duration_ms=round(duration * 1000),
+                chunk_count=chunk_count,
+                prompt_tokens=stream_info.get("prompt_tokens") if from_upstream else None,
+                completion_tokens=stream_info.get("completion_tokens") if from_upstream else None,
             )
+            print(f"AI Request by {username_for_log} queued for logging. Success: {succeeded_parsing_json}")
+    # stream_with_context 让生成器在整个迭代期间都保有请求/应用上下文
+    stream_started = []
+    response = Response(
+        stream_with_context(_admitted_stream(ticket, event_stream_with_logging(
+            logged_in_username, current_api_key, model_name_from_form, request_ip_address, request_user_agent), stream_started)),
+        mimetype='text/event-stream'
+    )
+
+    def release_if_never_started():
+        # 响应在开始迭代之前就被关闭（客户端在第一个字节前断开）时，生成器的 finally 不会执行，槽位在这里释放
+        if not stream_started:
+            ai_admission.release(ticket)
+
+    response.call_on_close(release_if_never_started)
+    return response
+
+
+def _holding_slot(ticket, chunks):
+    """迭代上游文本块，结束（包括出错、被关闭）时释放 start_upstream 里 hold 的槽位。"""
+    try:
+        yield from chunks
+    finally:
+        ai_admission.release(ticket)
+
+
+def _admitted_stream(ticket, stream, started=None):
+    """
+    排队时先推送 queued 事件（位置变化时），占到槽位后再开始 stream；结束或客户端断开时释放本请求对槽位的持有，
+    上游仍在后台生成时槽位由它继续占着（见 _holding_slot）。开始执行时向 started（列表）追加一项，
+    此后由这里的 finally 负责释放，未开始就被关闭的情况由调用方处理。
+    """
+    if started is not None:
+        started.append(True)
+    try:
+        if ticket.position:
+            last_position = None
             try:
-                with current_app.app_context():
-                    db.session.add(log_entry)
-                    db.session.commit()
-                print(f"AI Request by {username_for_log} logged. Success: {succeeded_parsing_json}")
-            except Exception as db_err:
-                print(f"数据库日志记录失败: {db_err}")
-                db.session.rollback()
+                for position in ai_admission.wait_turn(ticket):
+                    if position != last_position:
+                        yield _sse({'event': 'queued', 'position': position})
+                        last_position = position
+            except AdmissionTimeout as e:
+                yield _sse({'error': str(e)})
+                return
+            yield _sse({'event': 'admitted'})
+        yield from stream
+    finally:
+        ai_admission.release(ticket)
+
+
+# AI流式生成期间两次局部预览之间的最小间隔（秒）；0 表示关闭局部预览
+AI_PARTIAL_RENDER_INTERVAL = float(os.environ.get("AI_PARTIAL_RENDER_INTERVAL", "1.5"))
+
+
+def _sse(payload):
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def _render_preview(preview, chip_data, final=False):
+    """
+    更新AI流的局部预览：在当前线程内线性时间渲染（不占用渲染进程池、不写渲染缓存），返回完整HTML或差异。
+    生成中途的数据可能不完整，渲染失败时返回 None，不影响AI流本身。
+    """
+    try:
+        return preview.render(chip_data, final=final)
+    except Exception as e:
+        print(f"AI流式预览渲染失败: {type(e).__name__}: {e}")
+        return None
+
+
+# 流式渲染的结果不超过这个字符数时才写入渲染缓存，避免为了缓存把整张超大图攒在内存里
+STREAM_CACHE_MAX_CHARS = int(os.environ.get("RENDER_STREAM_CACHE_MAX_CHARS", str(4 * 1024 * 1024)))
+# 流式渲染的响应在每块之后插入这个注释，前端据此把完整的节点/边片段逐块追加到图中（见 static/apiService.js）
+RENDER_STREAM_SEPARATOR = "<!--chunk-->"
+
+
+def _log_chip_creation(json_data_str):
+    # 只入队，由 log_writer 在后台批量写入数据库
+    username_to_log = current_user.username if current_user.is_authenticated else None
+    log_writer.submit(
+        ChipCreation,
+        username=username_to_log,
+        chip_json_str=json_data_str,
+        ip_address=request.remote_addr,
+        user_agent=request.user_agent.string,
+    )
+
+
+def _stream_and_cache(cache_key, first_chunk, chunks, layout):
+    collected = [first_chunk]
+    collected_chars = len(first_chunk)
+    chunk_ends = [collected_chars]
+    yield first_chunk + RENDER_STREAM_SEPARATOR
+    for chunk in chunks:
+        if collected is not None:
+            collected_chars += len(chunk)
+            if collected_chars <= STREAM_CACHE_MAX_CHARS:
+                collected.append(chunk)
+                chunk_ends.append(collected_chars)
+            else:
+                collected = None
+        yield chunk + RENDER_STREAM_SEPARATOR
+    if collected is not None and not layout.get("fallback"):
+        # 回退布局（如 dot 不可用）的结果不缓存，安装 Graphviz 后就能用上正常布局；
+        # chunk_ends 记录每块的结束位置，缓存命中时按原来的分块回放
+        render_cache.put(cache_key, {"html": "".join(collected), "layout": layout, "chunk_ends": chunk_ends})
+
+
+def _replay_stream(rendered):
+    """把缓存的渲染结果按流式格式发送；非流式渲染的缓存没有分块信息，整段作为第一块。"""
+    html = rendered["html"]
+    start = 0
+    for end in rendered.get("chunk_ends") or [len(html)]:
+        yield html[start:end] + RENDER_STREAM_SEPARATOR
+        start = end
+
+
+def _stream_response(body, session_id):
     return Response(
-        event_stream_with_logging(logged_in_username, current_api_key, model_name_from_form, request_ip_address, request_user_agent),
-        mimetype='text/event-stream'
+        body,
+        mimetype='text/html',
+        headers={
+            "X-Accel-Buffering": "no",
+            "Cache-Control": "no-store",
+            "X-Render-Session": session_id,
+        },
     )
 
 
 @main_bp.route('/generate_manual', methods=['POST'])
 def generate_diagram_post_manual():
     json_data_str = request.form.get('chip_json', '')
+    stream_requested = request.form.get('stream') == '1'
+    render_started = time.monotonic()
     try:
         if not json_data_str.strip():
             return "错误：没有提供JSON数据或数据为空。", 400
@@ -181,27 +366,71 @@ def generate_diagram_post_manual():
             return "错误：JSON数据顶层必须是一个对象。", 400
         if 'nodes' not in chip_data or not isinstance(chip_data['nodes'], list):
             return "错误：JSON数据结构不正确，缺少 'nodes' 数组或格式错误。", 400
-        html_output_fragment = chip_json_to_svg_html(chip_data)
-        try:
-            username_to_log = current_user.username if current_user.is_authenticated else None
-            log_entry = ChipCreation(
-                username=username_to_log,
-                chip_json_str=json_data_str,
-                ip_address=request.remote_addr,
-                user_agent=request.user_agent.string,
-            )
-            db.session.add(log_entry)
-            db.session.commit()
-            print(f"Manual chip creation by {username_to_log or 'Anonymous'} logged.")
-        except Exception as log_e:
-            print(f"Error logging manual chip creation: {log_e}")
-            db.session.rollback()
-        return html_output_fragment
+        cache_key = chip_render_key(chip_data, effective_layout_engine(chip_data))
+        rendered = render_cache.get(cache_key)
+        if rendered is None and stream_requested:
+            # 流式模式：先在渲染进程池中完成布局（受超时限制，出错时还能返回错误状态码），再边格式化边发送节点和边
+            layout = {}
+            chunks = render_executor.stream(chip_data, layout_sink=layout)
+            first_chunk = next(chunks)
+            observe_render('stream', time.monotonic() - render_started)
+            _log_chip_creation(json_data_str)
+            return _stream_response(_stream_and_cache(cache_key, first_chunk, chunks, layout),
+                                    render_sessions.create(chip_data, layout))
+        if rendered is None:
+            rendered = render_executor.render(chip_data)
+            if not rendered["layout"].get("fallback"):
+                render_cache.put(cache_key, rendered)
+            observe_render('rendered', time.monotonic() - render_started)
+        else:
+            observe_render('cache_hit', time.monotonic() - render_started)
+        _log_chip_creation(json_data_str)
+        if stream_requested:
+            # 请求的是流式格式（前端按分隔符读取），缓存命中时也要按同样的格式回放
+            return _stream_response(_replay_stream(rendered), render_sessions.create(chip_data, rendered["layout"]))
+        return rendered["html"], 200, {"X-Render-Session": render_sessions.create(chip_data, rendered["layout"])}
     except json.JSONDecodeError as e:
         return f"错误：提供的JSON数据格式无效。详情: {e}", 400
+    except RenderPoolBusy as e:
+        observe_render('busy', time.monotonic() - render_started)
+        print(f"渲染请求被拒绝: {e}")
+        return "服务器繁忙：当前排队的图表渲染任务过多，请稍后再试。", 503, {"Retry-After": "5"}
+    except RenderTimeout as e:
+        observe_render('timeout', time.monotonic() - render_started)
+        print(f"渲染超时: {e}")
+        return "错误：图表过于复杂，渲染超时。请尝试拆分或简化芯片图。", 504
     except KeyError as e:
+        observe_render('error', time.monotonic() - render_started)
         traceback.print_exc()
         return f"生成图表时发生内部服务器错误 (数据键错误): {str(e)}", 500
     except Exception as e:
+        observe_render('error', time.monotonic() - render_started)
         traceback.print_exc()
         return f"生成图表时发生内部错误: {str(e)}", 500
+
+
+@main_bp.route('/render_patch', methods=['POST'])
+def render_patch_route():
+    """
+    增量渲染：{"session_id": ..., "patch": [JSON Patch 操作]}，只返回变化的节点 <g> 和边 <path>。
+    会话不存在（过期、被淘汰或在其它进程里）返回 404，改动过多返回 409，前端都会改做完整渲染。
+    """
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({"success": False, "error": "请求体必须是JSON对象。"}), 400
+    session = render_sessions.get(payload.get("session_id"))
+    if session is None:
+        return jsonify({"success": False, "error": "渲染会话不存在或已过期。", "full_render": True}), 404
+    try:
+        with session.lock:
+            changes = session.apply_patch(payload.get("patch"))
+            chip_json_str = json.dumps(session.chip_data(), ensure_ascii=False)
+    except PatchError as e:
+        return jsonify({"success": False, "error": f"补丁无效: {e}"}), 400
+    except PatchTooLarge as e:
+        return jsonify({"success": False, "error": str(e), "full_render": True}), 409
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"success": False, "error": f"增量渲染时发生内部错误: {str(e)}", "full_render": True}), 500
+    _log_chip_creation(chip_json_str)
+    return jsonify({"success": True, **changes})
@@ -0,0 +1,229 @@
+# metrics.py
+"""
+进程内的请求指标（计数器 + 固定桶直方图），以 Prometheus 文本格式在 /admin/metrics 输出。
+
+- AI 生成：按模型和结果来源（upstream / cache / coalesced）统计请求数、成功数、首个 token 延迟、
+  整个流的耗时、文本块数和 token 用量；
+- /generate_manual：按结果（cache_hit / rendered / stream / busy / timeout / error）统计渲染耗时。
+每个 gunicorn worker 各有一份，抓取经过负载均衡时每次只看到其中一个进程（见 README）。
+管理面板上的按模型视图用直方图桶估算分位数。
+"""
+import math
+import os
+import threading
+import time
+
+METRICS_PREFIX = "tgweb_"
+AI_LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60, 120)
+RENDER_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # 标签值元组 -> 累计值
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def series(self):
+        with self._lock:
+            return dict(self._values)
+
+    def samples(self):
+        for key, value in sorted(self.series().items()):
+            yield self.name, list(zip(self.labelnames, key)), value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.labelnames = tuple(labelnames)
+        self._series = {}  # 标签值元组 -> [各桶计数（不累加）..., +Inf 桶, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def series(self):
+        with self._lock:
+            return {key: list(values) for key, values in self._series.items()}
+
+    def samples(self):
+        bounds = self.buckets + (float("inf"),)
+        for key, values in sorted(self.series().items()):
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(bounds, values):
+                cumulative += count
+                yield f"{self.name}_bucket", labels + [("le", _format_value(float(bound)))], cumulative
+            yield f"{self.name}_sum", labels, values[-2]
+            yield f"{self.name}_count", labels, values[-1]
+
+    def quantile(self, q, values):
+        """按桶线性插值估算分位数；values 为 series() 中的一项。落在 +Inf 桶时返回最大的有限边界。"""
+        total = values[-1]
+        if not total:
+            return None
+        rank = q * total
+        cumulative = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, values):
+            if count and cumulative + count >= rank:
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        return float(self.buckets[-1])
+
+
+class MetricsRegistry:
+    def __init__(self, prefix=METRICS_PREFIX):
+        self.prefix = prefix
+        self._metrics = []
+        self.started_at = time.time()
+
+    def counter(self, name, help_text, labelnames=()):
+        metric = Counter(self.prefix + name, help_text, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, buckets, labelnames=()):
+        metric = Histogram(self.prefix + name, help_text, buckets, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self, gauges=None):
+        """
+        返回 Prometheus 文本格式（version 0.0.4）。gauges 为 {组件名: stats() 字典}，
+        其中的数值字段输出为 <prefix><组件名>_<字段名> 的 gauge。
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        process_name = f"{self.prefix}process_start_time_seconds"
+        lines.append(f"# HELP {process_name} 当前 worker 进程内指标开始累计的时间（Unix 秒）。")
+        lines.append(f"# TYPE {process_name} gauge")
+        lines.append(f'{process_name}{_format_labels([("pid", os.getpid())])} {_format_value(self.started_at)}')
+        for component, stats in (gauges or {}).items():
+            for field, value in stats.items():
+                if not isinstance(value, (int, float)):
+                    continue
+                name = f"{self.prefix}{component}_{field}"
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+ai_requests_total = metrics.counter(
+    "ai_requests_total", "AI 生成请求数。", ("model", "source", "outcome"))
+ai_ttft_seconds = metrics.histogram(
+    "ai_time_to_first_token_seconds", "从收到请求到第一个文本块的秒数。", AI_LATENCY_BUCKETS, ("model", "source"))
+ai_duration_seconds = metrics.histogram(
+    "ai_stream_duration_seconds", "整个AI流（到最后一个文本块）的秒数。", AI_LATENCY_BUCKETS, ("model", "source"))
+ai_chunks_total = metrics.counter(
+    "ai_stream_chunks_total", "转发给前端的文本块数。", ("model", "source"))
+ai_prompt_tokens_total = metrics.counter(
+    "ai_prompt_tokens_total", "上游消耗的输入 token（上游未返回用量时为估算值）。", ("model",))
+ai_completion_tokens_total = metrics.counter(
+    "ai_completion_tokens_total", "上游生成的输出 token（上游未返回用量时为估算值）。", ("model",))
+render_seconds = metrics.histogram(
+    "render_duration_seconds", "/generate_manual 的渲染耗时（流式渲染只计到第一块）。", RENDER_LATENCY_BUCKETS, ("outcome",))
+
+
+def observe_ai_request(model, source, succeeded, ttft, duration, chunk_count, prompt_tokens=None, completion_tokens=None):
+    """记录一次AI生成。ttft 为 None 表示没有收到任何文本块；token 只在结果来自上游时计入。"""
+    model = model or "unknown"
+    ai_requests_total.inc(model=model, source=source, outcome="success" if succeeded else "failure")
+    if ttft is not None:
+        ai_ttft_seconds.observe(ttft, model=model, source=source)
+    ai_duration_seconds.observe(duration, model=model, source=source)
+    ai_chunks_total.inc(chunk_count, model=model, source=source)
+    if source == "upstream":
+        if prompt_tokens:
+            ai_prompt_tokens_total.inc(prompt_tokens, model=model)
+        if completion_tokens:
+            ai_completion_tokens_total.inc(completion_tokens, model=model)
+
+
+def observe_render(outcome, seconds):
+    render_seconds.observe(seconds, outcome=outcome)
+
+
+def ai_model_summary():
+    """管理面板的按模型视图：只统计来自上游的请求（缓存回放的延迟不代表模型本身），按请求数降序。"""
+    rows = {}
+    for (model, source, outcome), count in ai_requests_total.series().items():
+        if source != "upstream":
+            continue
+        row = rows.setdefault(model, {"model": model, "requests": 0, "succeeded": 0})
+        row["requests"] += count
+        if outcome == "success":
+            row["succeeded"] += count
+    ttft = {key[0]: values for key, values in ai_ttft_seconds.series().items() if key[1] == "upstream"}
+    duration = {key[0]: values for key, values in ai_duration_seconds.series().items() if key[1] == "upstream"}
+    summary = []
+    for model, row in rows.items():
+        requests = row["requests"]
+        row["success_rate"] = round(row["succeeded"] / requests, 4) if requests else 0.0
+        for label, histogram, series in (("ttft", ai_ttft_seconds, ttft), ("duration", ai_duration_seconds, duration)):
+            values = series.get(model)
+            row[f"{label}_p50"] = histogram.quantile(0.5, values) if values else None
+            row[f"{label}_p95"] = histogram.quantile(0.95, values) if values else None
+        row["prompt_tokens"] = ai_prompt_tokens_total.value(model=model)
+        row["completion_tokens"] = ai_completion_tokens_total.value(model=model)
+        summary.append(row)
+    summary.sort(key=lambda r: -r["requests"])
+    return summary
@@ -0,0 +1,125 @@
+# model_list_cache.py
+"""
+模型列表缓存（按 API Key 指纹，TTL + stale-while-revalidate）。
+
+- 新鲜条目直接返回；过期但仍在 MODEL_LIST_STALE_TTL 内的条目立即返回，同时在后台线程刷新；
+- 未命中时不等待上游：先返回预设列表并标记 refreshing，由前端稍后再取一次；
+- 上游失败按 MODEL_LIST_ERROR_TTL 负缓存，期间不再请求上游；若之前有成功结果则继续提供旧列表。
+同一指纹同时只有一个刷新在进行。
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from openai_clients import key_fingerprint
+
+MODEL_LIST_TTL = float(os.environ.get("MODEL_LIST_TTL", "600"))
+MODEL_LIST_STALE_TTL = float(os.environ.get("MODEL_LIST_STALE_TTL", "86400"))
+MODEL_LIST_ERROR_TTL = float(os.environ.get("MODEL_LIST_ERROR_TTL", "60"))
+MODEL_LIST_CACHE_MAX = int(os.environ.get("MODEL_LIST_CACHE_MAX", "256"))
+
+
+class ModelListCache:
+    def __init__(self, fetch, fallback_models, ttl=MODEL_LIST_TTL, stale_ttl=MODEL_LIST_STALE_TTL,
+                 error_ttl=MODEL_LIST_ERROR_TTL, max_entries=MODEL_LIST_CACHE_MAX):
+        self.fetch = fetch  # fetch(api_key) -> (models, error)
+        self.fallback_models = fallback_models
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.error_ttl = error_ttl
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict()  # 指纹 -> {"models", "error", "fetched_at", "expires_at"}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._pid = None
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+
+    def _check_pid(self):
+        # 调用方须持有 self._lock。刷新线程不会跟随 fork，子进程里清掉进行中的标记
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._refreshing.clear()
+
+    def get(self, api_key):
+        """返回 (models, error, refreshing)，从不等待上游。"""
+        if not api_key:
+            return self.fallback_models, None, False
+        fingerprint = key_fingerprint(api_key)
+        now = time.monotonic()
+        with self._lock:
+            self._check_pid()
+            entry = self._entries.get(fingerprint)
+            if entry is not None and now - entry["fetched_at"] > self.stale_ttl:
+                del self._entries[fingerprint]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(fingerprint)
+                if now < entry["expires_at"]:
+                    self.hits += 1
+                    return entry["models"], entry["error"], fingerprint in self._refreshing
+                self.stale_hits += 1
+            else:
+                self.misses += 1
+            started = self._start_refresh_locked(fingerprint, api_key)
+            refreshing = started or fingerprint in self._refreshing
+        if entry is not None:
+            return entry["models"], entry["error"], refreshing
+        return self.fallback_models, None, refreshing
+
+    def _start_refresh_locked(self, fingerprint, api_key):
+        if fingerprint in self._refreshing:
+            return False
+        self._refreshing.add(fingerprint)
+        self.refreshes += 1
+        threading.Thread(target=self._refresh, args=(fingerprint, api_key),
+                         name="model-list-refresh", daemon=True).start()
+        return True
+
+    def _refresh(self, fingerprint, api_key):
+        try:
+            models, error = self.fetch(api_key)
+        except Exception as e:
+            models, error = self.fallback_models, f"获取模型列表时发生未知错误: {e}"
+        now = time.monotonic()
+        with self._lock:
+            self._refreshing.discard(fingerprint)
+            previous = self._entries.get(fingerprint)
+            if error is None:
+                entry = {"models": models, "error": None, "fetched_at": now, "expires_at": now + self.ttl}
+            else:
+                self.refresh_failures += 1
+                if previous is not None and previous["error"] is None:
+                    # 之前成功过：继续提供旧列表，只是在 error_ttl 内不再请求上游
+                    entry = dict(previous, expires_at=now + self.error_ttl)
+                else:
+                    entry = {"models": models, "error": error, "fetched_at": now, "expires_at": now + self.error_ttl}
+            self._entries[fingerprint] = entry
+            self._entries.move_to_end(fingerprint)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def known_models(self):
+        """预设列表与所有已缓存的上游列表的并集（失败条目里是预设列表，不会引入新名字）。"""
+        with self._lock:
+            known = set(self.fallback_models)
+            for entry in self._entries.values():
+                known.update(entry["models"])
+            return known
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.stale_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "refreshes": self.refreshes,
+                "refresh_failures": self.refresh_failures,
+                "hit_rate": round((self.hits + self.stale_hits) / lookups, 4) if lookups else 0.0,
+            }
@@ -1,38 +1,114 @@
 # models.py
+import zlib
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
 
 db = SQLAlchemy() # SQLAlchemy实例将在app.py中初始化并绑定到app
 
+
+def _blob_text(instance, text_field, hash_field):
+    """日志正文：有哈希引用时从 ContentBlob 解压（优先用 content_store.attach_texts 预取的结果），否则是迁移前的原列。"""
+    digest = getattr(instance, hash_field)
+    if digest is None:
+        return getattr(instance, text_field)
+    texts = getattr(instance, '_blob_texts', None)
+    if texts is not None and digest in texts:
+        return texts[digest]
+    blob = db.session.get(ContentBlob, digest)
+    return blob.text() if blob is not None else None
+
 class ChipCreation(db.Model):
     """存储用户成功生成的芯片JSON数据。"""
+    # 管理面板按用户筛选后按 (created_at, id) 分页；SQLite 索引隐含 rowid，可直接按序读取
+    __table_args__ = (db.Index('ix_chip_creation_username_created_at', 'username', 'created_at'),)
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(80), nullable=True) # 可以是匿名用户，所以nullable=True
-    chip_json_str = db.Column(db.Text, nullable=False) # 存储JSON字符串
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    username = db.Column(db.String(80), nullable=True, index=True) # 可以是匿名用户，所以nullable=True
+    chip_json_str = db.Column(db.Text, nullable=False) # 旧记录的JSON字符串；新记录为空串，正文在 ContentBlob
+    chip_json_hash = db.Column(db.String(64), nullable=True, index=True) # ContentBlob.hash
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     ip_address = db.Column(db.String(45), nullable=True) # 记录请求IP (注意隐私)
     user_agent = db.Column(db.String(255), nullable=True)
 
+    @property
+    def chip_json_text(self):
+        return _blob_text(self, 'chip_json_str', 'chip_json_hash')
+
     def __repr__(self):
         return f'<ChipCreation {self.id} by {self.username or "Anonymous"} at {self.created_at}>'
 
 class AiRequestLog(db.Model):
     """记录用户向AI发起的请求。"""
+    __table_args__ = (db.Index('ix_ai_request_log_username_created_at', 'username', 'created_at'),)
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(80), nullable=False) # AI请求通常需要用户登录
+    username = db.Column(db.String(80), nullable=False, index=True) # AI请求通常需要用户登录
     description = db.Column(db.Text, nullable=False) # 用户输入的描述
-    raw_ai_response = db.Column(db.Text, nullable=True) # AI返回的原始文本（可能包含错误或非JSON内容）
-    generated_json_str = db.Column(db.Text, nullable=True) # 成功解析出的JSON字符串
-    succeeded = db.Column(db.Boolean, default=False) # AI是否成功返回并解析出JSON
+    raw_ai_response = db.Column(db.Text, nullable=True) # AI返回的原始文本（可能包含错误或非JSON内容）；新记录在 ContentBlob
+    generated_json_str = db.Column(db.Text, nullable=True) # 成功解析出的JSON字符串；新记录在 ContentBlob
+    raw_ai_response_hash = db.Column(db.String(64), nullable=True, index=True) # ContentBlob.hash
+    generated_json_hash = db.Column(db.String(64), nullable=True, index=True) # 与原始回复相同时指向同一个 blob
+    succeeded = db.Column(db.Boolean, default=False, index=True) # AI是否成功返回并解析出JSON
     error_message = db.Column(db.Text, nullable=True) # 如果AI调用或解析失败的错误信息
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     ip_address = db.Column(db.String(45), nullable=True)
     user_agent = db.Column(db.String(255), nullable=True)
+    model_name = db.Column(db.String(100), nullable=True) # 实际使用的模型（旧记录为空）
+    generation_key = db.Column(db.String(64), nullable=True, index=True) # 生成结果缓存的键，见 generation_cache.py
+    result_source = db.Column(db.String(16), nullable=True) # upstream / cache / coalesced，见 generation_cache.py
+    ttft_ms = db.Column(db.Integer, nullable=True) # 从收到请求到第一个文本块的毫秒数
+    duration_ms = db.Column(db.Integer, nullable=True) # 整个流的毫秒数
+    chunk_count = db.Column(db.Integer, nullable=True) # 转发给前端的文本块数
+    prompt_tokens = db.Column(db.Integer, nullable=True) # 上游返回的用量，未返回时为估算值；缓存回放为空
+    completion_tokens = db.Column(db.Integer, nullable=True)
     
+    @property
+    def raw_ai_response_text(self):
+        return _blob_text(self, 'raw_ai_response', 'raw_ai_response_hash')
+
+    @property
+    def generated_json_text(self):
+        return _blob_text(self, 'generated_json_str', 'generated_json_hash')
+
     def __repr__(self):
         status = "Success" if self.succeeded else "Failed"
         return f'<AiRequestLog {self.id} by {self.username} ({status}) at {self.created_at}>'
 
-# 你也可以在这里定义 User 模型 (如果不想和 app.py 中的 UserMixin 混淆)
-# 但为了简单，我们继续使用 app.py 中定义的 UserMixin 类进行登录管理，
-# 而这里的模型主要用于数据记录。
\ No newline at end of file
+class UserAccount(db.Model):
+    """注册用户（原 instance/users.json）。登录管理仍使用 auth.py 中的 UserMixin 类，其 id 即用户名。"""
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(80), unique=True, index=True, nullable=False)
+    password_hash = db.Column(db.String(255), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<UserAccount {self.username}>'
+
+class UserApiKey(db.Model):
+    """用户保存的 SiliconFlow API Key（原 instance/api_keys.json），每个用户一条。"""
+    username = db.Column(db.String(80), primary_key=True)
+    api_key = db.Column(db.Text, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<UserApiKey for {self.username}>'
+
+
+class SiteCounter(db.Model):
+    """全站计数器（如首页访问次数）。各进程只用 value = value + delta 原子累加，不做读-改-写。"""
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<SiteCounter {self.name}={self.value}>'
+
+class ContentBlob(db.Model):
+    """按 UTF-8 文本的 SHA-256 去重、zlib 压缩保存的日志正文，见 content_store.py。"""
+    hash = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.LargeBinary, nullable=False) # zlib 压缩后的 UTF-8 文本
+    size = db.Column(db.Integer, nullable=False) # 压缩前的字节数
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def text(self):
+        return zlib.decompress(self.data).decode('utf-8')
+
+    def __repr__(self):
+        return f'<ContentBlob {self.hash[:12]} {self.size}B>'
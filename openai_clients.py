@@ -0,0 +1,89 @@
+# openai_clients.py
+"""
+按 API Key 复用的 OpenAI 客户端。
+
+所有客户端共享同一个 HTTP 连接池（openai.DefaultHttpxClient），认证头由各客户端在每个请求上设置，
+因此不同用户的 Key 可以安全地复用到 SiliconFlow 的 keep-alive 连接，同一用户连续生成时不再重新握手 TLS。
+注册表以 Key 的 SHA-256 为键（内存中不保留明文 Key 作为字典键），
+闲置超过 OPENAI_CLIENT_IDLE_TTL 秒或超过 OPENAI_CLIENT_MAX_KEYS 个时按 LRU 淘汰。
+不同的超时通过 client.with_options(timeout=...) 获得，它返回共享同一连接池的轻量副本。
+async_client=True 时创建 AsyncOpenAI 客户端和异步连接池，只能在同一个事件循环中使用（见 async_bridge.py）。
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import openai
+
+OPENAI_CLIENT_MAX_KEYS = int(os.environ.get("OPENAI_CLIENT_MAX_KEYS", "64"))
+OPENAI_CLIENT_IDLE_TTL = float(os.environ.get("OPENAI_CLIENT_IDLE_TTL", "600"))
+
+
+def key_fingerprint(api_key):
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+
+class OpenAIClientRegistry:
+    def __init__(self, base_url, max_keys=OPENAI_CLIENT_MAX_KEYS, idle_ttl=OPENAI_CLIENT_IDLE_TTL, async_client=False):
+        self.base_url = base_url
+        self._client_class = openai.AsyncOpenAI if async_client else openai.OpenAI
+        self._http_client_class = openai.DefaultAsyncHttpxClient if async_client else openai.DefaultHttpxClient
+        self.max_keys = max(1, max_keys)
+        self.idle_ttl = idle_ttl
+        self._clients = OrderedDict()  # 指纹 -> [client, 最近使用时间]
+        self._lock = threading.Lock()
+        self._http_client = None
+        self._http_pid = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _shared_http_client(self):
+        # 调用方须持有 self._lock。连接池不能跨 fork 共享，子进程里重新创建
+        if self._http_pid != os.getpid():
+            self._http_client = self._http_client_class()
+            self._http_pid = os.getpid()
+            self._clients.clear()
+        return self._http_client
+
+    def _evict_idle(self, now):
+        # 调用方须持有 self._lock。客户端共享连接池，淘汰时只丢弃引用，不能 close()
+        while self._clients:
+            fingerprint, (_, last_used) = next(iter(self._clients.items()))
+            if now - last_used <= self.idle_ttl and len(self._clients) <= self.max_keys:
+                break
+            del self._clients[fingerprint]
+            self.evictions += 1
+
+    def get(self, api_key, timeout=None):
+        """返回该 Key 对应的客户端；timeout 不为 None 时返回设置了该超时的副本。"""
+        fingerprint = key_fingerprint(api_key)
+        now = time.monotonic()
+        with self._lock:
+            http_client = self._shared_http_client()
+            entry = self._clients.get(fingerprint)
+            if entry is not None:
+                entry[1] = now
+                self._clients.move_to_end(fingerprint)
+                self.hits += 1
+                client = entry[0]
+            else:
+                client = self._client_class(api_key=api_key, base_url=self.base_url, http_client=http_client)
+                self._clients[fingerprint] = [client, now]
+                self.misses += 1
+            self._evict_idle(now)
+        return client.with_options(timeout=timeout) if timeout is not None else client
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "cached_keys": len(self._clients),
+                "max_keys": self.max_keys,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
@@ -0,0 +1,180 @@
+# prompt_index.py
+"""
+芯片教程的章节索引，用于按需拼装系统提示。
+
+启动时把教程按编号切成小节（如 "3.1. `ADD"），对标题和正文建 BM25 索引。
+每次生成只发送核心规则（数据类型说明 + JSON 格式规范与示例，见 CORE_SECTIONS）
+加上与用户描述最相关的若干小节，总量控制在 PROMPT_SECTION_BUDGET（估算 token）以内。
+中文按字的二元组切词，英文/数字按单词切词；token 数是粗略估计（汉字约 1 个，其他字符约 4 个一 token）。
+"""
+import math
+import os
+import re
+import threading
+from collections import Counter
+
+PROMPT_RETRIEVAL = os.environ.get("PROMPT_RETRIEVAL", "1") != "0"
+PROMPT_SECTION_BUDGET = int(os.environ.get("PROMPT_SECTION_BUDGET", "3000"))
+PROMPT_MAX_SECTIONS = int(os.environ.get("PROMPT_MAX_SECTIONS", "12"))
+
+# 与教程 v1.0.5 的章节编号对应：12 为数据类型/实体/颜色等通用说明，14 为 JSON 格式规范和示例，每次都发送；
+# 13 为结语，不发送。找不到核心章节时调用方应退回完整教程。
+CORE_SECTIONS = ("12", "14")
+SKIPPED_SECTIONS = ("13",)
+HEADING_WEIGHT = 3
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_TOP_RE = re.compile(r'^ ?(\d{1,2})\.(?!\d)\s*(\S.*)$')
+_SUB_RE = re.compile(r'^ ?(\d{1,2})\.(\d{1,2})\.?\s+(\S.*)$')
+_TERM_RE = re.compile(r'[a-z0-9_]+|[一-鿿]+')
+# 英文描述里的虚词会误中 AND / OR 等模块名
+_STOPWORDS = frozenset(("a", "an", "the", "and", "or", "to", "of", "in", "on", "for", "with", "is", "it", "then", "when", "that", "this"))
+
+
+def tokenize(text):
+    terms = []
+    for run in _TERM_RE.findall(text.lower()):
+        if '一' <= run[0] <= '鿿':
+            if len(run) == 1:
+                terms.append(run)
+            else:
+                terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+        elif run not in _STOPWORDS:
+            terms.append(run)
+    return terms
+
+
+def estimate_tokens(text):
+    cjk = sum(1 for ch in text if '一' <= ch <= '鿿')
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+class TutorialIndex:
+    def __init__(self, text):
+        self.chunks = []  # {"top", "title", "text", "tokens", "is_section"}，按文档顺序
+        self._parse(text)
+        self.core_indices = [i for i, c in enumerate(self.chunks) if c["top"] in CORE_SECTIONS]
+        self.section_indices = [i for i, c in enumerate(self.chunks)
+                                if c["is_section"] and c["top"] not in CORE_SECTIONS and c["top"] not in SKIPPED_SECTIONS]
+        self.core_tokens = sum(self.chunks[i]["tokens"] for i in self.core_indices)
+        self.full_tokens = estimate_tokens(text)
+        self._build_bm25()
+
+    def _parse(self, text):
+        top_titles = {}
+        current = None
+        for line in text.splitlines():
+            sub = _SUB_RE.match(line)
+            top = None if sub else _TOP_RE.match(line)
+            if sub:
+                number = sub.group(1)
+                current = {"top": number, "title": f"{top_titles.get(number, '')} {sub.group(3)}".strip(),
+                           "lines": [line], "is_section": True}
+                self.chunks.append(current)
+            elif top:
+                number = top.group(1)
+                top_titles[number] = top.group(2).strip()
+                current = {"top": number, "title": top.group(2).strip(), "lines": [line], "is_section": False}
+                self.chunks.append(current)
+            elif current is not None:
+                current["lines"].append(line)
+        for chunk in self.chunks:
+            chunk["text"] = "\n".join(chunk.pop("lines")).strip("\n")
+            chunk["tokens"] = estimate_tokens(chunk["text"])
+
+    def _build_bm25(self):
+        self._term_freqs = {}
+        self._doc_lens = {}
+        doc_freq = Counter()
+        for i in self.section_indices:
+            chunk = self.chunks[i]
+            terms = tokenize(chunk["title"]) * HEADING_WEIGHT + tokenize(chunk["text"])
+            freqs = Counter(terms)
+            self._term_freqs[i] = freqs
+            self._doc_lens[i] = len(terms)
+            doc_freq.update(freqs.keys())
+        n = len(self.section_indices)
+        self._avg_len = (sum(self._doc_lens.values()) / n) if n else 0.0
+        self._idf = {term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in doc_freq.items()}
+
+    def search(self, query):
+        """返回 [(score, chunk_index)]，按得分降序，只含得分大于 0 的小节。"""
+        query_terms = set(tokenize(query)) & self._idf.keys()
+        if not query_terms:
+            return []
+        results = []
+        for i in self.section_indices:
+            freqs = self._term_freqs[i]
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self._doc_lens[i] / self._avg_len)
+            score = 0.0
+            for term in query_terms:
+                tf = freqs.get(term)
+                if tf:
+                    score += self._idf[term] * tf * (BM25_K1 + 1) / (tf + norm)
+            if score > 0:
+                results.append((score, i))
+        results.sort(key=lambda item: (-item[0], item[1]))
+        return results
+
+    def select(self, query, budget_tokens=PROMPT_SECTION_BUDGET, max_sections=PROMPT_MAX_SECTIONS):
+        """返回 (教程文本, 选中的小节标题列表)：核心章节 + 预算内最相关的小节，按文档顺序拼接。"""
+        chosen = []
+        used = 0
+        for _, i in self.search(query):
+            if len(chosen) >= max_sections:
+                break
+            tokens = self.chunks[i]["tokens"]
+            if used + tokens > budget_tokens:
+                continue
+            chosen.append(i)
+            used += tokens
+        indices = sorted(chosen + self.core_indices)
+        text = "\n\n".join(self.chunks[i]["text"] for i in indices)
+        return text, [self.chunks[i]["title"] for i in sorted(chosen)]
+
+
+def load_tutorial_index(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            index = TutorialIndex(f.read())
+    except OSError as e:
+        print(f"错误: 无法为提示词教程建立索引: {e}")
+        return None
+    if not index.core_indices:
+        print("警告: 教程中未找到核心章节，将继续发送完整教程。")
+        return None
+    return index
+
+
+class PromptSizeStats:
+    """按请求记录系统提示大小（估算 token），在管理面板上对比完整教程。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.full_prompt_tokens = 0
+        self.sections = 0
+
+    def record(self, prompt_tokens, full_prompt_tokens, sections):
+        with self._lock:
+            self.requests += 1
+            self.prompt_tokens += prompt_tokens
+            self.full_prompt_tokens += full_prompt_tokens
+            self.sections += sections
+
+    def stats(self):
+        with self._lock:
+            requests = self.requests
+            return {
+                "enabled": PROMPT_RETRIEVAL,
+                "requests": requests,
+                "avg_prompt_tokens": round(self.prompt_tokens / requests) if requests else 0,
+                "avg_full_prompt_tokens": round(self.full_prompt_tokens / requests) if requests else 0,
+                "avg_sections": round(self.sections / requests, 1) if requests else 0.0,
+                "saving_ratio": round(1 - self.prompt_tokens / self.full_prompt_tokens, 4) if self.full_prompt_tokens else 0.0,
+            }
+
+
+prompt_stats = PromptSizeStats()
@@ -0,0 +1,152 @@
+# render_cache.py
+"""
+芯片图渲染结果（以及布局结果）的内容寻址缓存。
+
+缓存键是规范化芯片JSON（键排序、紧凑分隔符）和布局引擎的SHA-256，
+因此同一张图无论缩进、键顺序如何变化都会命中同一条缓存，而更换 LAYOUT_ENGINE 后不会再读到旧引擎的结果。
+内存层是有界LRU；磁盘层（可选）放在 instance/ 下，跨进程、跨重启共享。
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from utils import INSTANCE_FOLDER_PATH
+
+# 渲染逻辑（chip_logic.py）有不兼容改动时递增，使旧的磁盘缓存自动失效
+RENDER_CACHE_VERSION = "2"
+
+RENDER_CACHE_MAX_ENTRIES = int(os.environ.get("RENDER_CACHE_MAX_ENTRIES", "256"))
+RENDER_CACHE_DISK_ENABLED = os.environ.get("RENDER_CACHE_DISK", "0") == "1"
+RENDER_CACHE_DIR = os.path.join(INSTANCE_FOLDER_PATH, 'render_cache')
+LAYOUT_CACHE_MAX_ENTRIES = int(os.environ.get("LAYOUT_CACHE_MAX_ENTRIES", "512"))
+LAYOUT_CACHE_DIR = os.path.join(INSTANCE_FOLDER_PATH, 'layout_cache')
+
+
+def canonical_json_hash(data, namespace=""):
+    """对任意可JSON序列化的数据求规范化哈希。namespace 用于区分不同用途的缓存。"""
+    canonical = json.dumps(data, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    hasher = hashlib.sha256()
+    hasher.update(namespace.encode('utf-8'))
+    hasher.update(b'\0')
+    hasher.update(canonical.encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def chip_render_key(chip_data, layout_engine=""):
+    return canonical_json_hash(chip_data, namespace=f"render-v{RENDER_CACHE_VERSION}-{layout_engine}")
+
+
+class ContentCache:
+    """
+    两级内容缓存：有界内存LRU + 可选磁盘层。
+    值必须可以被 json.dumps 序列化（磁盘层以JSON文件保存）。
+    """
+
+    def __init__(self, name, max_entries=256, disk_dir=None):
+        self.name = name
+        self.max_entries = max(1, int(max_entries))
+        self.disk_dir = disk_dir
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_errors = 0
+        if self.disk_dir and not os.path.exists(self.disk_dir):
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+
+    def _remember(self, key, value):
+        # 调用方须持有 self._lock
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+        value = self._read_disk(key) if self.disk_dir else None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, value)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._remember(key, value)
+        if self.disk_dir:
+            self._write_disk(key, value)
+
+    def _read_disk(self, key):
+        path = self._disk_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (IOError, json.JSONDecodeError) as e:
+            print(f"渲染缓存 [{self.name}]: 读取磁盘缓存 {path} 失败: {e}")
+            self.disk_errors += 1
+            return None
+
+    def _write_disk(self, key, value):
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(value, f, ensure_ascii=False)
+            os.replace(tmp_path, path)  # 原子替换，多进程并发写入同一键也安全
+        except (IOError, OSError, TypeError, ValueError) as e:
+            print(f"渲染缓存 [{self.name}]: 写入磁盘缓存 {path} 失败: {e}")
+            self.disk_errors += 1
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "name": self.name,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "disk_errors": self.disk_errors,
+                "hit_rate": round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+                "disk_enabled": bool(self.disk_dir),
+            }
+
+
+render_cache = ContentCache(
+    'render',
+    max_entries=RENDER_CACHE_MAX_ENTRIES,
+    disk_dir=RENDER_CACHE_DIR if RENDER_CACHE_DISK_ENABLED else None,
+)
+
+# 布局缓存：值为 {node_id: [x, y]}，键由 chip_logic.layout_fingerprint 计算。
+# 与渲染缓存分开，这样只改了标签/常量值的图虽然渲染缓存未命中，仍能跳过 Graphviz。
+layout_cache = ContentCache(
+    'layout',
+    max_entries=LAYOUT_CACHE_MAX_ENTRIES,
+    disk_dir=LAYOUT_CACHE_DIR if RENDER_CACHE_DISK_ENABLED else None,
+)
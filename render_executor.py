@@ -0,0 +1,240 @@
+# render_executor.py
+"""
+在有界进程池中渲染芯片图，结果为 {"html": HTML片段, "layout": 布局}（布局供增量渲染会话复用）。
+
+- 每个任务有超时（从交给工作进程时开始计时）；超时后整个工作进程组（包括它启动的 dot 子进程）被杀掉并补充新进程；
+- 正在执行 + 排队等待的任务数有上限，超过时立即抛出 RenderPoolBusy（路由返回 503），
+  排队等待空闲进程超过 RENDER_QUEUE_TIMEOUT 秒同样抛出 RenderPoolBusy，不影响任何工作进程，
+  这样一张病态的大图不会拖死其它用户的请求。
+RENDER_POOL_WORKERS=0 时退化为在请求线程内同步渲染（方便本地调试）。
+流式渲染（stream）的布局同样在进程池中完成（受同一超时和排队上限约束），请求线程只逐块做字符串格式化。
+"""
+import atexit
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+
+from chip_logic import (prepare_chip_render, prepare_chip_render_from_layout, iter_chip_svg_html, render_plan_layout,
+                        STREAM_CHUNK_ITEMS)
+
+RENDER_POOL_WORKERS = int(os.environ.get("RENDER_POOL_WORKERS", "2"))
+RENDER_QUEUE_LIMIT = int(os.environ.get("RENDER_QUEUE_LIMIT", "8"))
+RENDER_JOB_TIMEOUT = float(os.environ.get("RENDER_JOB_TIMEOUT", "20"))
+RENDER_QUEUE_TIMEOUT = float(os.environ.get("RENDER_QUEUE_TIMEOUT", "10"))
+
+
+def render_chip(chip_data, layout_engine=None):
+    render_plan = prepare_chip_render(chip_data, layout_engine=layout_engine)
+    return {"html": "".join(iter_chip_svg_html(render_plan)), "layout": render_plan_layout(render_plan)}
+
+
+def layout_chip(chip_data, layout_engine=None):
+    """只做渲染的计算阶段，返回 render_plan_layout 的结果（供流式渲染在请求线程内格式化）。"""
+    return render_plan_layout(prepare_chip_render(chip_data, layout_engine=layout_engine))
+
+
+# 工作进程可以执行的任务
+JOB_FUNCTIONS = {"render": render_chip, "layout": layout_chip}
+
+
+class RenderPoolBusy(Exception):
+    """渲染进程池已满（执行中 + 排队中的任务达到上限）。"""
+
+
+class RenderTimeout(Exception):
+    """渲染任务超过了 RENDER_JOB_TIMEOUT。"""
+
+
+def _worker_main(conn):
+    # 独立进程组：超时时用 killpg 一并杀掉 Graphviz 的 dot 子进程
+    if hasattr(os, 'setpgrp'):
+        os.setpgrp()
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if job is None:
+            break
+        kind, chip_data, layout_engine = job
+        try:
+            result = ("ok", JOB_FUNCTIONS[kind](chip_data, layout_engine=layout_engine))
+        except Exception as e:
+            result = ("error", e)  # 由请求进程重新抛出并记录
+        try:
+            conn.send(result)
+        except Exception as send_err:
+            # 异常对象无法 pickle 时退化为 RuntimeError
+            conn.send(("error", RuntimeError(f"{type(result[1]).__name__}: {result[1]} ({send_err})")))
+
+
+class _Worker:
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+        pid = self.process.pid
+        try:
+            if hasattr(os, 'killpg'):
+                os.killpg(pid, signal.SIGKILL)
+            else:
+                self.process.kill()
+        except (ProcessLookupError, PermissionError, OSError):
+            self.process.kill()
+        self.process.join(timeout=5)
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.kill()
+
+
+class RenderExecutor:
+    def __init__(self, workers=RENDER_POOL_WORKERS, queue_limit=RENDER_QUEUE_LIMIT, timeout=RENDER_JOB_TIMEOUT,
+                 queue_timeout=RENDER_QUEUE_TIMEOUT):
+        self.workers = max(0, workers)
+        self.queue_limit = max(0, queue_limit)
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max(1, self.workers + self.queue_limit))
+        self._idle = queue.Queue()
+        self._all_workers = []
+        self._start_lock = threading.Lock()
+        self._started_pid = None
+        self._stats_lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.worker_restarts = 0
+        self.in_flight = 0
+
+    def _ensure_started(self):
+        # 懒启动：避免在 import 阶段（或 Flask reloader 的父进程里）就 fork 出工作进程
+        if self._started_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._started_pid == os.getpid():
+                return
+            self._context = multiprocessing.get_context('spawn')
+            self._idle = queue.Queue()
+            self._all_workers = [_Worker(self._context) for _ in range(self.workers)]
+            for worker in self._all_workers:
+                self._idle.put(worker)
+            self._started_pid = os.getpid()
+            print(f"渲染进程池已启动: {self.workers} 个工作进程, 排队上限 {self.queue_limit}, 超时 {self.timeout}s")
+
+    def _replace(self, worker):
+        worker.kill()
+        replacement = _Worker(self._context)
+        with self._start_lock:
+            if worker in self._all_workers:
+                self._all_workers.remove(worker)
+            self._all_workers.append(replacement)
+        with self._stats_lock:
+            self.worker_restarts += 1
+        self._idle.put(replacement)
+
+    def _count(self, field, delta=1):
+        with self._stats_lock:
+            setattr(self, field, getattr(self, field) + delta)
+
+    def render(self, chip_data, layout_engine=None):
+        """渲染芯片图，返回 {"html", "layout"}。可能抛出 RenderPoolBusy / RenderTimeout 或渲染本身的异常。"""
+        return self._run("render", chip_data, layout_engine)
+
+    def _run(self, kind, chip_data, layout_engine):
+        if self.workers == 0:
+            return JOB_FUNCTIONS[kind](chip_data, layout_engine=layout_engine)
+        if not self._slots.acquire(blocking=False):
+            self._count('rejected')
+            raise RenderPoolBusy(f"渲染队列已满（{self.workers} 个执行中 + {self.queue_limit} 个排队）")
+        self._count('submitted')
+        self._count('in_flight')
+        try:
+            self._ensure_started()
+            try:
+                worker = self._idle.get(timeout=self.queue_timeout)
+            except queue.Empty:
+                # 只是排队太久：没有任何工作进程出问题，按繁忙处理（503），不计入渲染超时
+                self._count('rejected')
+                raise RenderPoolBusy(f"等待空闲渲染进程超过 {self.queue_timeout}s")
+            try:
+                worker.conn.send((kind, chip_data, layout_engine))
+                # 超时从任务交给工作进程时开始计算，排队时间不算在内
+                if not worker.conn.poll(self.timeout):
+                    self._count('timeouts')
+                    print(f"渲染任务超时 ({self.timeout}s)，终止工作进程 {worker.process.pid} 及其子进程。")
+                    self._replace(worker)
+                    worker = None
+                    raise RenderTimeout(f"图表渲染超过 {self.timeout}s")
+                status, payload = worker.conn.recv()
+            except (EOFError, OSError, BrokenPipeError) as e:
+                if worker is not None:
+                    print(f"渲染工作进程 {worker.process.pid} 异常退出: {e}，正在重启。")
+                    self._replace(worker)
+                    worker = None
+                self._count('failed')
+                raise RuntimeError(f"渲染工作进程异常退出: {e}")
+            finally:
+                if worker is not None:
+                    self._idle.put(worker)
+            if status == "ok":
+                self._count('completed')
+                return payload
+            self._count('failed')
+            raise payload
+        finally:
+            self._count('in_flight', -1)
+            self._slots.release()
+
+    def stream(self, chip_data, layout_engine=None, chunk_items=STREAM_CHUNK_ITEMS, layout_sink=None):
+        """
+        逐块产出HTML片段的生成器。layout_sink（dict）不为 None 时，布局完成后写入 render_plan_layout 的结果。
+        第一次 next() 时在进程池中完成布局（与 render 相同的排队上限和超时），RenderPoolBusy / RenderTimeout
+        和数据错误都在这时抛出，路由可以据此返回正常的错误状态码；之后只在调用方线程内做线性的字符串格式化。
+        """
+        layout = self._run("layout", chip_data, layout_engine)
+        render_plan = prepare_chip_render_from_layout(chip_data, layout)
+        if layout_sink is not None:
+            layout_sink.update(layout)
+        yield from iter_chip_svg_html(render_plan, chunk_items=chunk_items)
+
+    def shutdown(self):
+        if self._started_pid != os.getpid():
+            return
+        for worker in list(self._all_workers):
+            worker.stop()
+        self._all_workers = []
+        self._started_pid = None
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "workers": self.workers,
+                "queue_limit": self.queue_limit,
+                "timeout": self.timeout,
+                "queue_timeout": self.queue_timeout,
+                "in_flight": self.in_flight,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+                "worker_restarts": self.worker_restarts,
+            }
+
+
+render_executor = RenderExecutor()
+atexit.register(render_executor.shutdown)
@@ -0,0 +1,408 @@
+# render_sessions.py
+"""
+增量渲染会话。
+
+每次完整渲染（/generate_manual）都会创建一个会话，保存芯片JSON和各节点在SVG中的坐标。
+之后前端只需发送 JSON Patch（对 /nodes/<id>、/edges/<边键> 的 add / remove / replace），
+服务器沿用已有节点的位置，只重新生成受影响的节点 <g> 和边 <path>，不再重新布局整张图。
+
+- 修改节点：位置（中心点）不变，重新生成该节点和与它相连的边；
+- 新增节点：放在已有前驱的右侧（或后继的左侧），都没有时放到图的底部；
+- 删除节点：同时删除与它相连的边。
+新增节点的位置是启发式的，变化过多（见 RENDER_PATCH_MAX_RATIO）时返回 PatchTooLarge，由前端改做完整渲染。
+会话保存在当前进程内存中（有界LRU + 过期时间），多进程部署时找不到会话同样回退到完整渲染。
+PreviewRenderer 用同样的差异格式推送AI生成过程中的局部预览。
+"""
+import copy
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from chip_logic import (
+    get_module_spec,
+    calculate_node_dimensions,
+    assign_node_ports,
+    generate_node_svg,
+    generate_edge_svg,
+    generate_svg_definitions,
+    edge_key,
+    iter_chip_svg_html,
+    prepare_chip_preview,
+    prepare_chip_render_from_layout,
+    render_plan_layout,
+)
+from layered_layout import DEFAULT_NODE_SEP, DEFAULT_RANK_SEP
+
+RENDER_SESSION_MAX = int(os.environ.get("RENDER_SESSION_MAX", "200"))
+RENDER_SESSION_TTL = float(os.environ.get("RENDER_SESSION_TTL", "1800"))
+# 一次补丁涉及的节点超过 max(RENDER_PATCH_MIN_NODES, 节点总数 × 该比例) 时要求完整渲染
+RENDER_PATCH_MAX_RATIO = float(os.environ.get("RENDER_PATCH_MAX_RATIO", "0.5"))
+RENDER_PATCH_MIN_NODES = 50
+SVG_PADDING = 30.0
+EDGE_KEYS = ("from_node", "from_port", "to_node", "to_port")
+
+
+class PatchError(ValueError):
+    """补丁格式错误或与会话中的图不一致。"""
+
+
+class PatchTooLarge(Exception):
+    """补丁改动过多，增量渲染没有意义，应改做完整渲染。"""
+
+
+def _decode_pointer_token(token):
+    # RFC 6901：~1 表示 '/'，~0 表示 '~'
+    return token.replace("~1", "/").replace("~0", "~")
+
+
+def _apply_pointer(target, tokens, op, value):
+    """
+    在节点/边对象内部按 JSON Pointer 执行 add / remove / replace。
+    与 RFC 6902 一致，路径的父级必须已经存在（add 也不会自动创建中间对象），否则抛出 PatchError，由前端改做完整渲染。
+    """
+    parent = target
+    for token in tokens[:-1]:
+        if isinstance(parent, list):
+            if not token.isdigit() or int(token) >= len(parent):
+                raise PatchError(f"路径中的数组下标无效: {token}")
+            parent = parent[int(token)]
+        elif isinstance(parent, dict):
+            if token not in parent:
+                raise PatchError(f"路径不存在: {token}")
+            parent = parent[token]
+        else:
+            raise PatchError(f"路径穿过了非容器值: {token}")
+    last = tokens[-1]
+    if isinstance(parent, list):
+        if last == "-" and op == "add":
+            parent.append(value)
+            return
+        if not last.isdigit():
+            raise PatchError(f"数组下标无效: {last}")
+        index = int(last)
+        if op == "add":
+            if index > len(parent):
+                raise PatchError(f"数组下标越界: {last}")
+            parent.insert(index, value)
+        elif not 0 <= index < len(parent):
+            raise PatchError(f"数组下标越界: {last}")
+        elif op == "remove":
+            del parent[index]
+        else:
+            parent[index] = value
+    elif isinstance(parent, dict):
+        if op == "remove":
+            if last not in parent:
+                raise PatchError(f"路径不存在: {last}")
+            del parent[last]
+        elif op == "replace" and last not in parent:
+            raise PatchError(f"路径不存在: {last}")
+        else:
+            parent[last] = value
+    else:
+        raise PatchError(f"路径指向了非容器值: {last}")
+
+
+class RenderSession:
+    def __init__(self, chip_data, layout):
+        self.lock = threading.Lock()
+        self.touched_at = time.monotonic()
+        # 每次完整渲染都会创建会话，而大多数会话不会收到补丁，所以节点条目推迟到第一次补丁时再构建
+        self._initial = (chip_data, layout)
+        self.nodes = None
+
+    def _ensure_built(self):
+        if self._initial is None:
+            return
+        chip_data, layout = self._initial
+        self.nodes = OrderedDict((node["id"], node) for node in chip_data.get("nodes", []))
+        self.edges = OrderedDict()
+        for edge in chip_data.get("edges", []):
+            self.edges.setdefault(edge_key(edge), edge)
+        self.viewbox = list(layout["viewbox"])
+        self.node_id_map = {}
+        for node_id, node in self.nodes.items():
+            pos = layout["positions"].get(node_id)
+            if pos is not None:
+                self.node_id_map[node_id] = self._build_entry(node, tuple(pos))
+        self.port_types = self._edge_port_types(self.edges.values())
+        self._initial = None
+
+    def chip_data(self):
+        if self._initial is not None:
+            return self._initial[0]
+        return {"nodes": list(self.nodes.values()), "edges": list(self.edges.values())}
+
+    @staticmethod
+    def _build_entry(node, pos_svg):
+        spec = get_module_spec(node)
+        entry = {"data": node, "spec": spec, "dimensions": calculate_node_dimensions(node, spec), "ports": {}, "pos_svg": pos_svg}
+        assign_node_ports(entry, *pos_svg)
+        return entry
+
+    def _edge_port_types(self, edges):
+        port_types = set()
+        for edge in edges:
+            from_entry = self.node_id_map.get(edge["from_node"])
+            from_port = from_entry["ports"].get(f"out_{edge['from_port']}") if from_entry is not None else None
+            port_types.add(from_port["type"] if from_port is not None else "DEFAULT")
+        return port_types
+
+    def _parse_path(self, path):
+        if not isinstance(path, str) or not path.startswith("/"):
+            raise PatchError(f"无效的路径: {path!r}")
+        tokens = [_decode_pointer_token(token) for token in path[1:].split("/")]
+        if tokens[0] not in ("nodes", "edges") or len(tokens) < 2:
+            raise PatchError(f"只支持 /nodes/<id> 和 /edges/<边键> 路径: {path}")
+        return tokens[0], tokens[1], tokens[2:]
+
+    def _apply_op(self, op, changed_nodes, removed_nodes, changed_edges, removed_edges):
+        if not isinstance(op, dict):
+            raise PatchError("补丁中的每一项都必须是对象。")
+        kind = op.get("op")
+        if kind not in ("add", "remove", "replace"):
+            raise PatchError(f"不支持的操作: {kind!r}（支持 add / remove / replace）")
+        collection, key, rest = self._parse_path(op.get("path"))
+        value = op.get("value")
+        if kind != "remove" and "value" not in op:
+            raise PatchError(f"{kind} 操作缺少 value: {op.get('path')}")
+
+        if collection == "nodes":
+            if rest:
+                if key not in self.nodes:
+                    raise PatchError(f"节点不存在: {key}")
+                node = copy.deepcopy(self.nodes[key])
+                _apply_pointer(node, rest, kind, value)
+                if node.get("id") != key:
+                    raise PatchError("不能通过补丁修改节点 id，请删除后重新添加。")
+                self.nodes[key] = node
+                changed_nodes.add(key)
+            elif kind == "remove":
+                if self.nodes.pop(key, None) is None:
+                    raise PatchError(f"节点不存在: {key}")
+                removed_nodes.add(key)
+                changed_nodes.discard(key)
+                for ekey in [ekey for ekey, edge in self.edges.items() if key in (edge["from_node"], edge["to_node"])]:
+                    del self.edges[ekey]
+                    removed_edges.add(ekey)
+                    changed_edges.discard(ekey)
+            else:
+                if not isinstance(value, dict):
+                    raise PatchError(f"节点必须是对象: {key}")
+                if kind == "replace" and key not in self.nodes:
+                    raise PatchError(f"节点不存在: {key}")
+                node = dict(value)
+                if node.setdefault("id", key) != key:
+                    raise PatchError(f"节点 id 与路径不一致: {node['id']} != {key}")
+                self.nodes[key] = node
+                changed_nodes.add(key)
+                removed_nodes.discard(key)
+            return
+
+        if rest:
+            raise PatchError("边只支持整体 add / remove / replace。")
+        if kind in ("remove", "replace"):
+            if self.edges.pop(key, None) is None:
+                raise PatchError(f"边不存在: {key}")
+            removed_edges.add(key)
+            changed_edges.discard(key)
+        if kind in ("add", "replace"):
+            if not isinstance(value, dict) or any(field not in value for field in EDGE_KEYS):
+                raise PatchError(f"边必须包含 {', '.join(EDGE_KEYS)}")
+            for node_field in ("from_node", "to_node"):
+                if value[node_field] not in self.nodes:
+                    raise PatchError(f"边引用了不存在的节点: {value[node_field]}")
+            new_key = edge_key(value)
+            self.edges[new_key] = value
+            changed_edges.add(new_key)
+            removed_edges.discard(new_key)
+
+    def _place_new_node(self, node_id, dimensions):
+        """新增节点的启发式位置：已有前驱的右边一层 / 已有后继的左边一层 / 图的底部。"""
+        width, height = dimensions
+        preds = []; succs = []
+        for edge in self.edges.values():
+            if edge["to_node"] == node_id and edge["from_node"] in self.node_id_map:
+                preds.append(self.node_id_map[edge["from_node"]])
+            elif edge["from_node"] == node_id and edge["to_node"] in self.node_id_map:
+                succs.append(self.node_id_map[edge["to_node"]])
+        if preds:
+            x = max(entry["pos_svg"][0] + entry["dimensions"][0] / 2 for entry in preds) + DEFAULT_RANK_SEP + width / 2
+            y = sum(entry["pos_svg"][1] for entry in preds) / len(preds)
+        elif succs:
+            x = min(entry["pos_svg"][0] - entry["dimensions"][0] / 2 for entry in succs) - DEFAULT_RANK_SEP - width / 2
+            y = sum(entry["pos_svg"][1] for entry in succs) / len(succs)
+        else:
+            bottom = max((entry["pos_svg"][1] + entry["dimensions"][1] / 2 for entry in self.node_id_map.values()), default=SVG_PADDING - DEFAULT_NODE_SEP)
+            x = SVG_PADDING + width / 2
+            y = bottom + DEFAULT_NODE_SEP + height / 2
+        # 只向右、向下扩展画布，坐标不能小于边距
+        return (max(x, SVG_PADDING + width / 2), max(y, SVG_PADDING + height / 2))
+
+    def apply_patch(self, ops):
+        """
+        应用补丁并返回需要替换的SVG片段：
+        {"nodes": {id: svg 或 None(已删除)}, "edges": {边键: svg 或 None}, "viewbox": [宽, 高], "defs": 新的<defs> 或 None}
+        补丁无效时抛出 PatchError（其它任何异常同样）并保持会话不变。调用方须持有 session.lock。
+        """
+        if not isinstance(ops, list):
+            raise PatchError("patch 必须是数组。")
+        self._ensure_built()
+        # 节点在修改前会被深拷贝，所以浅拷贝各个集合就足以回滚；任何异常（包括重建 node_id_map 时的）都恢复原状
+        snapshot = (OrderedDict(self.nodes), OrderedDict(self.edges), dict(self.node_id_map), list(self.viewbox), set(self.port_types))
+        try:
+            return self._apply_patch(ops)
+        except Exception:
+            self.nodes, self.edges, self.node_id_map, self.viewbox, self.port_types = snapshot
+            raise
+
+    def _apply_patch(self, ops):
+        changed_nodes = set(); removed_nodes = set(); changed_edges = set(); removed_edges = set()
+        for op in ops:
+            self._apply_op(op, changed_nodes, removed_nodes, changed_edges, removed_edges)
+        limit = max(RENDER_PATCH_MIN_NODES, len(self.nodes) * RENDER_PATCH_MAX_RATIO)
+        if len(changed_nodes) + len(removed_nodes) > limit:
+            raise PatchTooLarge(f"补丁涉及 {len(changed_nodes) + len(removed_nodes)} 个节点，超过增量渲染上限 {int(limit)}")
+
+        for node_id in removed_nodes:
+            self.node_id_map.pop(node_id, None)
+        new_node_ids = []
+        for node_id in self.nodes:
+            if node_id not in changed_nodes:
+                continue
+            old_entry = self.node_id_map.get(node_id)
+            if old_entry is None:
+                new_node_ids.append(node_id)
+                continue
+            self.node_id_map[node_id] = self._build_entry(self.nodes[node_id], old_entry["pos_svg"])
+        for node_id in new_node_ids:
+            node = self.nodes[node_id]
+            spec = get_module_spec(node)
+            self.node_id_map[node_id] = self._build_entry(node, self._place_new_node(node_id, calculate_node_dimensions(node, spec)))
+
+        # 端口位置随节点变化，连接到已修改节点的边都要重画
+        for ekey, edge in self.edges.items():
+            if edge["from_node"] in changed_nodes or edge["to_node"] in changed_nodes:
+                changed_edges.add(ekey)
+
+        result = {"nodes": {}, "edges": {}, "viewbox": None, "defs": None}
+        for node_id in removed_nodes:
+            result["nodes"][node_id] = None
+        for node_id in changed_nodes:
+            entry = self.node_id_map[node_id]
+            result["nodes"][node_id] = generate_node_svg(entry["data"], entry["pos_svg"][0], entry["pos_svg"][1], self.node_id_map)
+            width, height = entry["dimensions"]
+            self.viewbox[0] = max(self.viewbox[0], entry["pos_svg"][0] + width / 2 + SVG_PADDING)
+            self.viewbox[1] = max(self.viewbox[1], entry["pos_svg"][1] + height / 2 + SVG_PADDING)
+        for ekey in removed_edges:
+            result["edges"][ekey] = None
+        for ekey in changed_edges:
+            result["edges"][ekey] = generate_edge_svg(self.edges[ekey], self.node_id_map, None)
+        new_port_types = self._edge_port_types(self.edges[ekey] for ekey in changed_edges) - self.port_types
+        if new_port_types:
+            self.port_types |= new_port_types
+            result["defs"] = generate_svg_definitions(self.port_types)
+        result["viewbox"] = list(self.viewbox)
+        return result
+
+
+class PreviewRenderer:
+    """
+    AI 生成过程中的局部预览（每个AI流一个）。在调用方线程内用线性时间布局渲染，不经渲染进程池、不写缓存；
+    第一次返回 {"html": 完整片段}，之后只返回与上次发送相比变化的节点/边（格式同 apply_patch 的结果），
+    前端用同一个 applyDiagramPatch 拼接。
+    AI 先输出全部节点再输出边：节点集合不变时沿用上次的坐标，只补画新边；出现新节点或 final=True 时才重新布局，
+    此时坐标变化的节点和相连的边也会出现在差异中。
+    """
+
+    def __init__(self):
+        self._nodes = None  # 节点id -> 上次发送的 <g>
+        self._edges = {}    # 边键 -> 上次发送的 <path>
+        self._defs = None
+        self._layout = None
+
+    def render(self, chip_data, final=False):
+        if self._layout is not None and not final and set(self._nodes) == {node["id"] for node in chip_data.get("nodes", [])}:
+            plan = prepare_chip_render_from_layout(chip_data, self._layout)
+        else:
+            plan = prepare_chip_preview(chip_data)
+            self._layout = render_plan_layout(plan)
+        node_id_map = plan["node_id_map"]
+        nodes = {node_id: generate_node_svg(entry["data"], entry["pos_svg"][0], entry["pos_svg"][1], node_id_map)
+                 for node_id, entry in node_id_map.items()}
+        edges = {edge_key(edge): generate_edge_svg(edge, node_id_map, None) for edge in plan["edges"]}
+        viewbox = list(plan["viewbox"])
+        if self._nodes is None:
+            result = {"html": "".join(iter_chip_svg_html(plan))}
+        else:
+            result = {
+                "nodes": _diff(self._nodes, nodes),
+                "edges": _diff(self._edges, edges),
+                "viewbox": viewbox,
+                "defs": plan["svg_definitions"] if plan["svg_definitions"] != self._defs else None,
+            }
+        self._nodes, self._edges, self._defs = nodes, edges, plan["svg_definitions"]
+        return result
+
+
+def _diff(previous, current):
+    changes = {key: markup for key, markup in current.items() if previous.get(key) != markup}
+    changes.update((key, None) for key in previous if key not in current)
+    return changes
+
+
+class RenderSessionStore:
+    """有界LRU + 过期时间的会话表。"""
+
+    def __init__(self, max_sessions=RENDER_SESSION_MAX, ttl=RENDER_SESSION_TTL):
+        self.max_sessions = max(1, max_sessions)
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.patches = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def create(self, chip_data, layout):
+        session = RenderSession(chip_data, layout)
+        session_id = secrets.token_urlsafe(16)
+        with self._lock:
+            self._sessions[session_id] = session
+            self.created += 1
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.evictions += 1
+        return session_id
+
+    def get(self, session_id):
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None and now - session.touched_at > self.ttl:
+                del self._sessions[session_id]
+                self.evictions += 1
+                session = None
+            if session is None:
+                self.misses += 1
+                return None
+            session.touched_at = now
+            self._sessions.move_to_end(session_id)
+            self.patches += 1
+            return session
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "created": self.created,
+                "patches": self.patches,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+render_sessions = RenderSessionStore()
@@ -0,0 +1,353 @@
+# retention.py
+"""
+请求日志的保留与归档。
+
+后台线程每隔 RETENTION_INTERVAL 秒把 created_at 早于 RETENTION_DAYS 天的 AiRequestLog / ChipCreation 行
+移到 instance/archive/<表名>/<YYYY-MM-DD>.jsonl.gz（按行的日期分区，gzip 追加写入）：
+每批最多 RETENTION_BATCH_SIZE 行，先读出并结束读事务，写好归档文件（fsync）后再用一个短事务删除这些行
+和不再被引用的 ContentBlob，批与批之间暂停 RETENTION_BATCH_PAUSE 秒，不会长时间占住数据库写锁。
+归档记录是自包含的（正文已解压内联）。先写归档再删除，中途崩溃最多在归档里留下重复行，读取时按 (id, created_at) 去重：
+表上没有 AUTOINCREMENT，表被清空后 id 会被重新使用，只按 id 会把不同的行当成重复而丢掉。
+多个 gunicorn worker 通过归档目录下的文件锁保证同一时间只有一个进程在归档。
+管理面板上的总数来自计数行（见 log_writer.count_rows），不受归档影响。
+
+命令行：python retention.py run | list | query | restore，见 --help。
+"""
+import argparse
+import gzip
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.exc import SQLAlchemyError
+
+from content_store import BLOB_FIELDS, delete_unreferenced_blobs, externalize_rows, load_texts, store_blobs
+from models import db, AiRequestLog, ChipCreation
+from utils import INSTANCE_FOLDER_PATH
+
+try:
+    import fcntl
+except ImportError:  # Windows 上只有单进程开发服务器，不需要跨进程锁
+    fcntl = None
+
+RETENTION_DAYS = float(os.environ.get("RETENTION_DAYS", "90"))
+RETENTION_INTERVAL = float(os.environ.get("RETENTION_INTERVAL", "3600"))
+RETENTION_BATCH_SIZE = int(os.environ.get("RETENTION_BATCH_SIZE", "500"))
+RETENTION_BATCH_PAUSE = float(os.environ.get("RETENTION_BATCH_PAUSE", "0.2"))
+RETENTION_ARCHIVE_DIR = os.environ.get("RETENTION_ARCHIVE_DIR") or os.path.join(INSTANCE_FOLDER_PATH, 'archive')
+RETENTION_START_DELAY = 30  # 进程启动后第一次归档前等待的秒数
+
+ARCHIVED_MODELS = {model.__tablename__: model for model in (AiRequestLog, ChipCreation)}
+
+
+def _row_record(row, model, texts):
+    record = {}
+    for column in model.__table__.columns:
+        value = getattr(row, column.key)
+        record[column.name] = value.isoformat() if isinstance(value, datetime) else value
+    for text_field, hash_field in BLOB_FIELDS.get(model, ()):
+        digest = record.pop(hash_field, None)
+        if digest is not None:
+            record[text_field] = texts.get(digest)
+    return record
+
+
+def _record_row(record, model):
+    """归档记录 -> 可插入的行字典（忽略模型中已不存在的列）。"""
+    columns = model.__table__.columns
+    row = {}
+    for name, value in record.items():
+        if name not in columns:
+            continue
+        if value is not None and isinstance(columns[name].type, db.DateTime):
+            value = datetime.fromisoformat(value)
+        row[name] = value
+    return row
+
+
+class LogArchiver:
+    def __init__(self, days=RETENTION_DAYS, interval=RETENTION_INTERVAL, batch_size=RETENTION_BATCH_SIZE,
+                 batch_pause=RETENTION_BATCH_PAUSE, archive_dir=RETENTION_ARCHIVE_DIR):
+        self.days = days
+        self.interval = interval
+        self.batch_size = max(1, batch_size)
+        self.batch_pause = batch_pause
+        self.archive_dir = archive_dir
+        self._app = None
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+        self._run_lock = threading.Lock()
+        self._stop = threading.Event()
+        self.runs = 0
+        self.archived = 0
+        self.blobs_deleted = 0
+        self.errors = 0
+        self.last_run_at = None
+        self.last_error = None
+
+    def init_app(self, app):
+        self._app = app
+
+    def ensure_started(self):
+        # 懒启动，fork 出的子进程里重新启动；RETENTION_DAYS 为 0 时不归档
+        if self.days <= 0 or self._started_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+            self._stop.clear()
+            threading.Thread(target=self._run, name="log-archiver", daemon=True).start()
+
+    def _run(self):
+        delay = RETENTION_START_DELAY
+        while not self._stop.wait(delay):
+            delay = self.interval
+            try:
+                with self._app.app_context():
+                    self.run_once()
+            except Exception as e:
+                self.errors += 1
+                self.last_error = str(e)
+                print(f"日志归档失败: {e}")
+
+    def partition_path(self, table_name, day):
+        return os.path.join(self.archive_dir, table_name, f"{day.isoformat()}.jsonl.gz")
+
+    def _acquire_process_lock(self):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        lock_file = open(os.path.join(self.archive_dir, '.lock'), 'a')
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return None
+        return lock_file
+
+    def run_once(self, days=None):
+        """把早于 days（默认 RETENTION_DAYS）天的行全部归档，返回 {表名: 行数}；其它进程正在归档时返回 None。需要应用上下文。"""
+        days = self.days if days is None else days
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        if not self._run_lock.acquire(blocking=False):
+            return None
+        try:
+            lock_file = self._acquire_process_lock()
+            if lock_file is None:
+                return None
+            try:
+                result = {}
+                for table_name, model in ARCHIVED_MODELS.items():
+                    total = 0
+                    while not self._stop.is_set():
+                        moved = self._archive_batch(model, cutoff)
+                        total += moved
+                        if moved < self.batch_size:
+                            break
+                        time.sleep(self.batch_pause)
+                    result[table_name] = total
+                self.runs += 1
+                self.last_run_at = datetime.utcnow()
+                if any(result.values()):
+                    print(f"日志归档完成（早于 {cutoff:%Y-%m-%d %H:%M}）: {result}")
+                return result
+            finally:
+                lock_file.close()
+        finally:
+            self._run_lock.release()
+
+    def _archive_batch(self, model, cutoff):
+        fields = BLOB_FIELDS.get(model, ())
+        try:
+            rows = (model.query.filter(model.created_at < cutoff)
+                    .order_by(model.created_at, model.id).limit(self.batch_size).all())
+            hashes = {getattr(row, hash_field) for row in rows for _, hash_field in fields} - {None}
+            texts = load_texts(hashes)
+            records = [_row_record(row, model, texts) for row in rows]
+        finally:
+            db.session.rollback()  # 结束读事务，写归档文件期间不持有数据库锁
+        if not records:
+            return 0
+        by_day = defaultdict(list)
+        for record in records:
+            by_day[datetime.fromisoformat(record["created_at"]).date()].append(record)
+        for day, day_records in by_day.items():
+            self._append(model.__tablename__, day, day_records)
+        try:
+            db.session.execute(delete(model).where(model.id.in_([record["id"] for record in records])))
+            deleted_blobs = delete_unreferenced_blobs(hashes)
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            raise  # 这些行已写入归档，下次运行会再写一遍，读取时按 (id, created_at) 去重
+        self.archived += len(records)
+        self.blobs_deleted += deleted_blobs
+        return len(records)
+
+    def _append(self, table_name, day, records):
+        path = self.partition_path(table_name, day)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        payload = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode('utf-8')
+        # 每次追加一个独立的 gzip member，gzip.open 读取时会依次读出所有 member
+        with open(path, 'ab') as f:
+            f.write(gzip.compress(payload))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def partitions(self, table_name, since=None, until=None):
+        """返回 [(日期, 路径)]，按日期升序；since / until 为包含边界的 date。"""
+        table_dir = os.path.join(self.archive_dir, table_name)
+        if not os.path.isdir(table_dir):
+            return []
+        found = []
+        for name in sorted(os.listdir(table_dir)):
+            if not name.endswith('.jsonl.gz'):
+                continue
+            try:
+                day = date.fromisoformat(name[:-len('.jsonl.gz')])
+            except ValueError:
+                continue
+            if (since is None or day >= since) and (until is None or day <= until):
+                found.append((day, os.path.join(table_dir, name)))
+        return found
+
+    def read(self, table_name, since=None, until=None, username=None):
+        """按日期范围（和用户名）迭代归档记录，同一 (id, created_at) 只返回一次。"""
+        seen = set()
+        for _, path in self.partitions(table_name, since, until):
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    record = json.loads(line)
+                    identity = (record.get("id"), record.get("created_at"))
+                    if identity in seen:
+                        continue
+                    seen.add(identity)
+                    if username is not None and record.get("username") != username:
+                        continue
+                    yield record
+
+    def restore(self, table_name, records, batch_size=None):
+        """
+        把归档记录写回热表，返回 (写回行数, 跳过行数)。需要应用上下文。
+        (id, created_at) 相同的行已存在时跳过；id 已被另一行占用时不保留原 id，由数据库分配新 id
+        （这类行再次写回时按 (username, created_at) 认出并跳过）。
+        """
+        model = ARCHIVED_MODELS[table_name]
+        batch_size = batch_size or self.batch_size
+        restored = skipped = 0
+        batch = []
+        for record in records:
+            batch.append(_record_row(record, model))
+            if len(batch) >= batch_size:
+                done = self._restore_batch(model, batch)
+                restored, skipped = restored + done, skipped + len(batch) - done
+                batch = []
+        if batch:
+            done = self._restore_batch(model, batch)
+            restored, skipped = restored + done, skipped + len(batch) - done
+        return restored, skipped
+
+    def _restore_batch(self, model, rows):
+        existing = dict(db.session.execute(
+            select(model.id, model.created_at).where(model.id.in_([row["id"] for row in rows]))).all())
+        used_ids = set(existing)
+        keep_id, new_id = [], []
+        for row in rows:
+            if row["id"] in existing and existing[row["id"]] == row.get("created_at"):
+                continue
+            if row["id"] in used_ids:
+                row = {name: value for name, value in row.items() if name != "id"}
+                new_id.append(row)
+            else:
+                used_ids.add(row["id"])
+                keep_id.append(row)
+        if new_id:
+            # 之前写回时已换过 id 的行：按 (username, created_at) 认出来，重复写回不会产生重复行
+            restored_before = set(db.session.execute(
+                select(model.username, model.created_at).where(model.created_at.in_([row.get("created_at") for row in new_id]))).all())
+            new_id = [row for row in new_id if (row.get("username"), row.get("created_at")) not in restored_before]
+        blobs = {}
+        for batch in (keep_id, new_id):
+            if batch:
+                blobs.update(externalize_rows(model, batch))
+                db.session.execute(insert(model.__table__), batch)
+        store_blobs(blobs)
+        db.session.commit()
+        if new_id:
+            print(f"{model.__tablename__}: {len(new_id)} 行的原 id 已被其它行占用，已用新 id 写回。")
+        return len(keep_id) + len(new_id)
+
+    def stats(self):
+        return {
+            "enabled": self.days > 0,
+            "days": self.days,
+            "runs": self.runs,
+            "archived": self.archived,
+            "blobs_deleted": self.blobs_deleted,
+            "errors": self.errors,
+            "last_run_at": self.last_run_at.strftime('%Y-%m-%d %H:%M:%S') if self.last_run_at else None,
+            "last_error": self.last_error,
+        }
+
+
+log_archiver = LogArchiver()
+
+
+def _parse_day(value):
+    return date.fromisoformat(value) if value else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="请求日志的归档：立即归档、列出分区、查询或写回归档的记录。")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="立即归档早于保留期的行")
+    run_parser.add_argument("--days", type=float, default=None, help=f"保留天数，默认 RETENTION_DAYS（{RETENTION_DAYS:g}）")
+    list_parser = subparsers.add_parser("list", help="列出归档分区")
+    list_parser.add_argument("--table", choices=sorted(ARCHIVED_MODELS), default=None)
+    for name, help_text in (("query", "按日期范围输出归档记录（JSON Lines）"), ("restore", "把日期范围内的归档记录写回数据库")):
+        sub = subparsers.add_parser(name, help=help_text)
+        sub.add_argument("--table", choices=sorted(ARCHIVED_MODELS), required=True)
+        sub.add_argument("--since", help="起始日期（含），YYYY-MM-DD")
+        sub.add_argument("--until", help="结束日期（含），YYYY-MM-DD")
+        sub.add_argument("--username", default=None)
+        if name == "query":
+            sub.add_argument("--limit", type=int, default=0, help="最多输出的记录数，0 表示不限")
+    args = parser.parse_args(argv)
+
+    if args.command == "list":
+        tables = [args.table] if args.table else sorted(ARCHIVED_MODELS)
+        for table_name in tables:
+            for day, path in log_archiver.partitions(table_name):
+                print(f"{table_name}\t{day.isoformat()}\t{os.path.getsize(path)}B\t{path}")
+        return
+    if args.command == "query":
+        records = log_archiver.read(args.table, _parse_day(args.since), _parse_day(args.until), args.username)
+        for count, record in enumerate(records, 1):
+            print(json.dumps(record, ensure_ascii=False))
+            if args.limit and count >= args.limit:
+                break
+        return
+
+    from app import app  # 只在需要数据库时导入
+    from utils import ensure_schema_columns
+
+    with app.app_context():
+        db.create_all()
+        ensure_schema_columns()
+        if args.command == "run":
+            result = log_archiver.run_once(args.days)
+            print("另一个进程正在归档，已跳过。" if result is None else f"已归档: {result}")
+        else:
+            records = log_archiver.read(args.table, _parse_day(args.since), _parse_day(args.until), args.username)
+            restored, skipped = log_archiver.restore(args.table, records)
+            print(f"已写回 {restored} 行，跳过已存在的 {skipped} 行。")
+            if restored:
+                print("注意：早于保留期的行会在下次归档时再次移出，需要长期保留时请调大 RETENTION_DAYS。")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+# site_counter.py
+"""
+进程内批量计数器（目前用于首页访问次数）。
+
+请求路径上只做一次加锁的内存自增；后台线程每隔 SITE_COUNTER_FLUSH_INTERVAL 秒把本进程
+累计的增量用 UPDATE ... SET value = value + :delta 原子地写入 SiteCounter 表，
+并读回全站总数。多个 gunicorn worker 各自累加自己的增量，数据库中的总数是精确的；
+进程退出时（atexit）会再刷新一次。读取时返回"最近一次读回的总数 + 本进程未刷新的增量"。
+"""
+import atexit
+import os
+import threading
+
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import db
+from utils import VISIT_COUNT_FILE
+
+SITE_COUNTER_FLUSH_INTERVAL = float(os.environ.get("SITE_COUNTER_FLUSH_INTERVAL", "5"))
+
+
+class BatchedCounter:
+    def __init__(self, name, legacy_file=None, flush_interval=SITE_COUNTER_FLUSH_INTERVAL):
+        self.name = name
+        self.legacy_file = legacy_file
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._pending = 0
+        self._total = 0
+        self._app = None
+        self._started_pid = None
+        self._stop = threading.Event()
+        self.flushes = 0
+        self.flush_errors = 0
+
+    def init_app(self, app):
+        self._app = app
+        atexit.register(self.flush)
+
+    def _ensure_started(self):
+        # 懒启动，并在 fork 出的子进程里重新启动刷新线程（线程不会被 fork 继承）
+        if self._started_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+            self._stop.clear()
+            threading.Thread(target=self._run, name=f"counter-flush-{self.name}", daemon=True).start()
+        # 本进程第一次使用时同步读一次总数，避免刚启动时显示的数字从 0 开始
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def increment(self, delta=1):
+        self._ensure_started()
+        with self._lock:
+            self._pending += delta
+            return self._total + self._pending
+
+    def value(self):
+        self._ensure_started()
+        with self._lock:
+            return self._total + self._pending
+
+    def _seed_row(self, conn):
+        """确保计数行存在；第一次创建时用旧的计数文件（如果有）作为初始值，然后重命名该文件。"""
+        initial = 0
+        if self.legacy_file and os.path.exists(self.legacy_file):
+            try:
+                with open(self.legacy_file, 'r') as f:
+                    count_str = f.read().strip()
+                    initial = int(count_str) if count_str.isdigit() else 0
+            except OSError as e:
+                print(f"读取旧计数文件 '{self.legacy_file}' 失败: {e}")
+        inserted = conn.execute(text("INSERT OR IGNORE INTO site_counter (name, value) VALUES (:name, :value)"),
+                                {"name": self.name, "value": initial}).rowcount
+        if inserted and self.legacy_file and os.path.exists(self.legacy_file):
+            try:
+                os.replace(self.legacy_file, f"{self.legacy_file}.migrated")
+                print(f"已将 {self.legacy_file} 中的计数 {initial} 迁移到数据库。")
+            except OSError:
+                pass
+
+    def flush(self):
+        """把本进程累计的增量写入数据库并读回总数。失败时增量保留到下一次。"""
+        if self._app is None:
+            return
+        with self._flush_lock:
+            with self._lock:
+                delta = self._pending
+            try:
+                with self._app.app_context():
+                    with db.engine.begin() as conn:
+                        if conn.execute(text("UPDATE site_counter SET value = value + :delta WHERE name = :name"),
+                                        {"delta": delta, "name": self.name}).rowcount == 0:
+                            self._seed_row(conn)
+                            conn.execute(text("UPDATE site_counter SET value = value + :delta WHERE name = :name"),
+                                         {"delta": delta, "name": self.name})
+                        total = conn.execute(text("SELECT value FROM site_counter WHERE name = :name"), {"name": self.name}).scalar()
+            except SQLAlchemyError as e:
+                self.flush_errors += 1
+                print(f"计数器 '{self.name}' 写入数据库失败（增量 {delta} 将在下次重试）: {e}")
+                return
+            with self._lock:
+                self._pending -= delta
+                self._total = total or 0
+            self.flushes += 1
+
+
+visit_counter = BatchedCounter('visits', legacy_file=VISIT_COUNT_FILE)
+
+
+def get_visit_count():
+    return visit_counter.value()
+
+
+def increment_and_get_visit_count():
+    return visit_counter.increment()
@@ -1,41 +1,127 @@
 // static/apiService.js
-import { showAiLoading, showAiError, hideAiError, showManualLoading, hideManualJsonError, showManualJsonError, appendMessage, setInputDisabledState } from './uiUpdater.js';
-import { displayChipDiagram } from './uiUpdater.js';
+import { showAiLoading, setAiLoadingText, showAiError, hideAiError, showManualLoading, hideManualJsonError, showManualJsonError, appendMessage, setInputDisabledState } from './uiUpdater.js';
+import { displayChipDiagram, appendDiagramMarkup, applyDiagramPatch, hasDisplayedDiagram } from './uiUpdater.js';
+
+// 节点数达到这个值时请求服务器流式返回图表（边生成边发送）
+const STREAM_RENDER_MIN_NODES = 500;
+// 与服务器 main_routes.RENDER_STREAM_SEPARATOR 一致：流式响应中每块（完整的节点/边片段）之后的分隔注释
+const RENDER_STREAM_SEPARATOR = '<!--chunk-->';
+
+// 上一次完整渲染的会话和对应的芯片JSON，用于计算增量补丁
+let lastRender = null;
+
+function edgeKey(edge) {
+    return `${edge.from_node}.${edge.from_port}->${edge.to_node}.${edge.to_port}`;
+}
+
+function escapePointer(token) {
+    return String(token).replace(/~/g, '~0').replace(/\//g, '~1');
+}
+
+// 比较新旧芯片JSON，生成 /render_patch 使用的 JSON Patch；无法增量处理（如节点id重复）时返回 null
+function buildChipPatch(oldChip, newChip) {
+    const oldNodes = new Map(), newNodes = new Map(), oldEdges = new Map(), newEdges = new Map();
+    for (const node of oldChip.nodes || []) oldNodes.set(node.id, node);
+    for (const node of newChip.nodes || []) {
+        if (!node || node.id === undefined || newNodes.has(node.id)) return null;
+        newNodes.set(node.id, node);
+    }
+    for (const edge of oldChip.edges || []) oldEdges.set(edgeKey(edge), edge);
+    for (const edge of newChip.edges || []) {
+        if (!edge || edge.from_node === undefined || edge.to_node === undefined) return null;
+        newEdges.set(edgeKey(edge), edge);
+    }
+    const patch = [];
+    for (const id of oldNodes.keys()) {
+        if (!newNodes.has(id)) patch.push({op: 'remove', path: `/nodes/${escapePointer(id)}`});
+    }
+    for (const key of oldEdges.keys()) {
+        // 端点节点被删除的边会随节点一起删除
+        const edge = oldEdges.get(key);
+        if (!newEdges.has(key) && newNodes.has(edge.from_node) && newNodes.has(edge.to_node)) {
+            patch.push({op: 'remove', path: `/edges/${escapePointer(key)}`});
+        }
+    }
+    for (const [id, node] of newNodes) {
+        if (!oldNodes.has(id)) patch.push({op: 'add', path: `/nodes/${escapePointer(id)}`, value: node});
+        else if (JSON.stringify(oldNodes.get(id)) !== JSON.stringify(node)) patch.push({op: 'replace', path: `/nodes/${escapePointer(id)}`, value: node});
+    }
+    for (const [key, edge] of newEdges) {
+        if (!oldEdges.has(key)) patch.push({op: 'add', path: '/edges/-', value: edge});
+    }
+    return patch;
+}
+
+// 尝试用增量补丁更新当前图表；成功返回 true，需要完整渲染时返回 false
+async function tryPatchDiagram(parsed) {
+    if (!lastRender || !hasDisplayedDiagram()) return false;
+    const patch = buildChipPatch(lastRender.chip, parsed);
+    if (patch === null) return false;
+    if (patch.length === 0) return true;
+    try {
+        const response = await fetch('/render_patch', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({session_id: lastRender.sessionId, patch: patch})
+        });
+        if (!response.ok) return false;
+        const data = await response.json();
+        if (!data.success || !applyDiagramPatch(data)) return false;
+        lastRender.chip = parsed;
+        return true;
+    } catch (error) {
+        console.warn("增量渲染失败，改为完整渲染:", error);
+        return false;
+    }
+}
 
 export async function triggerDiagramGenerationAPI(jsonString, isAiCall) {
     hideManualJsonError();
     const currentErrorBoxDisplayFunc = isAiCall ? showAiError : showManualJsonError;
-    const chatMessages = document.getElementById('chatMessages');
-    if(chatMessages){
-        const existingDiagram = chatMessages.querySelector('.diagram-output-file:not(#diagramResultContainerTemplate)');
-        if(existingDiagram) existingDiagram.remove();
-    }
     if (!jsonString || !jsonString.trim()) {
         currentErrorBoxDisplayFunc('错误：JSON内容不能为空！');
         return;
     }
+    let parsed;
+    let useStream = false;
     try {
-        const parsed = JSON.parse(jsonString);
+        parsed = JSON.parse(jsonString);
         if (typeof parsed !== 'object' || !parsed.nodes) throw new Error("JSON结构不正确，缺少'nodes'键。");
+        useStream = Array.isArray(parsed.nodes) && parsed.nodes.length >= STREAM_RENDER_MIN_NODES;
     } catch (e) {
         currentErrorBoxDisplayFunc((isAiCall ? 'AI生成的JSON格式无效: ' : '编辑器中JSON格式无效: ') + e.message);
         return;
     }
+    // 手动编辑后重新生成时优先走增量渲染，只替换变化的节点和边
+    if (!isAiCall && await tryPatchDiagram(parsed)) return;
+    lastRender = null;
+    const chatMessages = document.getElementById('chatMessages');
+    if(chatMessages){
+        const existingDiagram = chatMessages.querySelector('.diagram-output-file:not(#diagramResultContainerTemplate)');
+        if(existingDiagram) existingDiagram.remove();
+    }
     showManualLoading(true);
     if (isAiCall) showAiLoading(false);
     try {
+        const formParams = {'chip_json': jsonString};
+        if (useStream) formParams.stream = '1';
         const response = await fetch('/generate_manual', {
             method: 'POST',
             headers: {'Content-Type': 'application/x-www-form-urlencoded'},
-            body: new URLSearchParams({'chip_json': jsonString})
+            body: new URLSearchParams(formParams)
         });
         showManualLoading(false);
         if (!response.ok) {
             const errorText = await response.text();
             throw new Error('服务器错误: ' + response.status + '\n' + errorText);
         }
-        const htmlFragment = await response.text();
-        displayChipDiagram(htmlFragment, isAiCall);
+        if (useStream) {
+            await readStreamedDiagram(response, isAiCall);
+        } else {
+            displayChipDiagram(await response.text(), isAiCall);
+        }
+        const sessionId = response.headers.get('X-Render-Session');
+        lastRender = sessionId ? {sessionId: sessionId, chip: parsed} : null;
     } catch (error) {
         showManualLoading(false);
         currentErrorBoxDisplayFunc('图表生成失败: ' + error.message);
@@ -43,6 +129,37 @@ export async function triggerDiagramGenerationAPI(jsonString, isAiCall) {
     }
 }
 
+// 边接收边显示：第一块（容器、<svg> 开头和 <defs>）建立图表，之后每块节点/边直接追加到 SVG 中
+async function readStreamedDiagram(response, isAiCall) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let displayed = false;
+    for (;;) {
+        const { done, value } = await reader.read();
+        buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+        let separatorAt;
+        while ((separatorAt = buffer.indexOf(RENDER_STREAM_SEPARATOR)) !== -1) {
+            const piece = buffer.slice(0, separatorAt);
+            buffer = buffer.slice(separatorAt + RENDER_STREAM_SEPARATOR.length);
+            if (!displayed) {
+                displayChipDiagram(piece, isAiCall);
+                displayed = true;
+            } else {
+                appendDiagramMarkup(piece);
+            }
+        }
+        if (done) break;
+    }
+    if (!displayed) {
+        // 没有分隔符（例如旧版本服务器或缓存）时把整个响应当作完整图表
+        if (!buffer.trim()) throw new Error('服务器没有返回图表内容。');
+        displayChipDiagram(buffer, isAiCall);
+    } else if (buffer.trim()) {
+        appendDiagramMarkup(buffer);
+    }
+}
+
 export async function fetchAiModelsAPI() {
     try {
         const response = await fetch('/get_ai_models');
@@ -57,7 +174,8 @@ export async function fetchAiModelsAPI() {
             console.error("fetchAiModelsAPI API returned success=false:", data.error);
             throw new Error(data.error || "获取模型列表时发生未知错误。");
         }
-        return data.models;
+        // refreshing 为 true 表示服务端正在后台刷新模型列表，当前返回的是预设或旧列表
+        return { models: data.models, refreshing: !!data.refreshing };
     } catch (error) {
         console.error("fetchAiModelsAPI fetch/catch error:", error);
         throw error;
@@ -67,6 +185,7 @@ export async function fetchAiModelsAPI() {
 export async function requestAiGenerationStream(description, apiKey, modelName, onChunkReceived, onStreamEnd, onError) {
     let accumulatedContentResponse = "";
     showAiLoading(true);
+    setAiLoadingText(null); // 上一次可能停在排队提示上
     setInputDisabledState(true); // 禁用输入
     hideAiError();
     try {
@@ -88,17 +207,15 @@ export async function requestAiGenerationStream(description, apiKey, modelName,
         const reader = response.body.getReader();
         const decoder = new TextDecoder();
         let cancelled = false;
+        // 一个SSE事件（尤其是较大的 partial_svg）可能跨多个网络块，未以空行结束的部分留到下一次
+        let sseBuffer = "";
         async function push() {
             try {
                 const { done, value } = await reader.read();
-                if (done || cancelled) {
-                    if (!cancelled) onStreamEnd(accumulatedContentResponse);
-                    showAiLoading(false);
-                    setInputDisabledState(false); // 启用输入
-                    return;
-                }
-                const chunkText = decoder.decode(value, { stream: true });
-                const lines = chunkText.split('\n\n');
+                if (!done && !cancelled) sseBuffer += decoder.decode(value, { stream: true });
+                else if (!cancelled) sseBuffer += decoder.decode() + '\n\n';
+                const lines = sseBuffer.split('\n\n');
+                sseBuffer = lines.pop();
                 for (const line of lines) {
                     if (cancelled) break;
                     if (line.startsWith('data: ')) {
@@ -115,12 +232,24 @@ export async function requestAiGenerationStream(description, apiKey, modelName,
                             } else if (jsonData.content) { 
                                 accumulatedContentResponse += jsonData.content;
                                 onChunkReceived({ type: "content", data: jsonData.content });
+                            } else if (jsonData.event === 'node' || jsonData.event === 'edge') {
+                                onChunkReceived({ type: jsonData.event, data: jsonData[jsonData.event] });
+                            } else if (jsonData.event === 'partial_svg' || jsonData.event === 'partial_patch') {
+                                onChunkReceived({ type: jsonData.event, data: jsonData });
+                            } else if (jsonData.event === 'queued' || jsonData.event === 'admitted') {
+                                onChunkReceived({ type: jsonData.event, data: jsonData });
                             }
                         } catch (e) {
                             console.warn("解析SSE数据块时非JSON内容或格式错误:", line, e);
                         }
                     }
                 }
+                if (done || cancelled) {
+                    if (!cancelled) onStreamEnd(accumulatedContentResponse);
+                    showAiLoading(false);
+                    setInputDisabledState(false); // 启用输入
+                    return;
+                }
                 if (!cancelled) await push();
             } catch (streamError) {
                 console.error('读取AI响应流时出错:', streamError);
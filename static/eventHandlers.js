@@ -3,7 +3,8 @@ import {
     appendMessage, finalizeStreamingMessage, updateApiKeyStatus, showAiError, hideAiError,
     toggleAdvancedToolModal, toggleFeaturesSection, toggleSidebar, cacheDomElements,
     populateModelDropdown, setModelLoadStatus, updateCurrentSetModelDisplay, applySidebarState,
-    setInputDisabledState // 导入新函数
+    setInputDisabledState, // 导入新函数
+    displayChipDiagram, applyDiagramPatch, setAiLoadingText
 } from './uiUpdater.js';
 import {
     triggerDiagramGenerationAPI, requestAiGenerationStream, saveApiKeyAPI,
@@ -19,12 +20,14 @@ let userInput, sendButton, apiKeyInput, saveApiKeyButton, chipJsonTextarea,
 // 状态变量
 let aiResponseMessageDiv = null; // 用于追踪当前正在流式输出的AI回复消息元素
 
-async function loadAndDisplayModels() {
-    // ... (此函数与上一版本相同) ...
+const MODEL_LIST_RETRY_DELAY_MS = 2000;
+const MODEL_LIST_MAX_RETRIES = 3;
+
+async function loadAndDisplayModels(retry = 0) {
     if (!window.current_user_is_authenticated_from_server) { setModelLoadStatus("请先登录以加载和选择模型。", true); if(aiModelSelect) aiModelSelect.innerHTML = '<option value="">请先登录</option>'; updateCurrentSetModelDisplay("未登录"); return; }
-    setModelLoadStatus("正在加载模型列表...", false);
+    if (retry === 0) setModelLoadStatus("正在加载模型列表...", false);
     try {
-        const models = await fetchAiModelsAPI();
+        const { models, refreshing } = await fetchAiModelsAPI();
         const defaultModelFromService = models.length > 0 ? models[0] : null;
         populateModelDropdown(models, defaultModelFromService);
         setModelLoadStatus(models.length > 0 ? "模型列表已加载。" : "未能从API获取模型，显示预设列表。", false);
@@ -36,6 +39,10 @@ async function loadAndDisplayModels() {
             updateCurrentSetModelDisplay(aiModelSelect.value);
             localStorage.setItem('selectedAiModel', aiModelSelect.value);
         } else { updateCurrentSetModelDisplay("默认"); }
+        // 服务端未命中缓存时先给出预设列表，后台刷新完成后再取一次完整列表
+        if (refreshing && retry < MODEL_LIST_MAX_RETRIES) {
+            setTimeout(() => loadAndDisplayModels(retry + 1), MODEL_LIST_RETRY_DELAY_MS);
+        }
     } catch (error) {
         console.error("加载或填充模型列表失败:", error);
         setModelLoadStatus(`加载模型列表失败: ${error.message}`, true);
@@ -82,6 +89,17 @@ function handleUserInput() {
                     if (aiResponseMessageDiv) {
                         appendMessage(chunkData.data, 'bot', true, aiResponseMessageDiv);
                     }
+                } else if (chunkData.type === "partial_svg") {
+                    // AI仍在输出时先显示已解析部分的图表，结束后会被完整图表替换
+                    displayChipDiagram(chunkData.data.html, true);
+                } else if (chunkData.type === "partial_patch") {
+                    // 之后的预览只发送变化的节点和边；拼接失败时保留当前预览，结束后同样会被完整图表替换
+                    applyDiagramPatch(chunkData.data.changes);
+                } else if (chunkData.type === "queued") {
+                    // 服务器同时进行的生成已满，显示排队位置
+                    setAiLoadingText(`服务器繁忙，排队中（第 ${chunkData.data.position} 位）...`);
+                } else if (chunkData.type === "admitted") {
+                    setAiLoadingText(null);
                 }
             },
             (accumulatedContentResponse) => { // onStreamEnd
@@ -153,7 +153,60 @@ export function displayChipDiagram(htmlFragment, isAiGenerated) {
         } else { console.error("未能找到新图表中的下载按钮或SVG元素。"); }
     }, 100);
 }
+function currentDiagramSvg() {
+    if (!chatMessagesElem) return null;
+    return chatMessagesElem.querySelector('.diagram-output-file:not(#diagramResultContainerTemplate) .svg-render-area svg');
+}
+export function hasDisplayedDiagram() { return currentDiagramSvg() !== null; }
+// 把流式渲染的一块（若干完整的节点 <g> / 边 <path>，或结尾标签）追加到当前图表的 SVG 中
+export function appendDiagramMarkup(markup) {
+    const svg = currentDiagramSvg();
+    if (!svg) return false;
+    const holder = document.createElementNS('http://www.w3.org/2000/svg', 'g');
+    holder.innerHTML = markup;  // 按 HTML 规则解析，多余的结尾标签会被忽略
+    while (holder.firstChild) svg.appendChild(holder.firstChild);
+    return true;
+}
+// 把服务器返回的SVG片段解析成可插入的元素；片段不是合法XML时返回 null
+function parseSvgFragment(markup) {
+    const doc = new DOMParser().parseFromString(`<svg xmlns="http://www.w3.org/2000/svg">${markup}</svg>`, 'image/svg+xml');
+    if (doc.querySelector('parsererror')) return null;
+    return Array.from(doc.documentElement.children).map(el => document.importNode(el, true));
+}
+// 将 /render_patch 的结果拼接进当前图表：替换/删除/新增节点 <g> 和边 <path>，必要时更新 <defs> 和 viewBox。
+// 任何片段无法解析时不做修改并返回 false，由调用方改做完整渲染。
+export function applyDiagramPatch(changes) {
+    const svg = currentDiagramSvg();
+    if (!svg) return false;
+    const parsedNodes = [], parsedEdges = [];
+    for (const [id, markup] of Object.entries(changes.nodes || {})) {
+        const elements = markup ? parseSvgFragment(markup) : [];
+        if (elements === null) return false;
+        parsedNodes.push([id, elements]);
+    }
+    for (const [key, markup] of Object.entries(changes.edges || {})) {
+        const elements = markup ? parseSvgFragment(markup) : [];
+        if (elements === null) return false;
+        parsedEdges.push([key, elements]);
+    }
+    let newDefs = null;
+    if (changes.defs) { newDefs = parseSvgFragment(changes.defs); if (newDefs === null) return false; }
+    if (newDefs) { const oldDefs = svg.querySelector('defs'); newDefs.forEach(el => oldDefs ? svg.replaceChild(el, oldDefs) : svg.insertBefore(el, svg.firstChild)); }
+    for (const [id, elements] of parsedNodes) {
+        const existing = svg.querySelector(`[data-node-id="${CSS.escape(id)}"]`);
+        const anchor = existing ? existing.nextSibling : svg.querySelector('[data-edge-key]');
+        if (existing) existing.remove();
+        elements.forEach(el => svg.insertBefore(el, anchor));
+    }
+    for (const [key, elements] of parsedEdges) {
+        svg.querySelectorAll(`[data-edge-key="${CSS.escape(key)}"]`).forEach(el => el.remove());
+        elements.forEach(el => svg.appendChild(el));
+    }
+    if (changes.viewbox) svg.setAttribute('viewBox', `0 0 ${changes.viewbox[0]} ${changes.viewbox[1]}`);
+    return true;
+}
 export function showAiLoading(show) { if (aiLoadingIndicatorElem) { aiLoadingIndicatorElem.style.display = show ? 'flex' : 'none'; if (show && chatMessagesElem) { const latestUserPrompt = chatMessagesElem.querySelector('.latest-user-prompt'); if (latestUserPrompt && latestUserPrompt.nextSibling) { chatMessagesElem.insertBefore(aiLoadingIndicatorElem, latestUserPrompt.nextSibling); } else if (latestUserPrompt) { chatMessagesElem.appendChild(aiLoadingIndicatorElem); } else { chatMessagesElem.appendChild(aiLoadingIndicatorElem); } aiLoadingIndicatorElem.scrollIntoView({ behavior: "smooth", block: "end" }); } } }
+export function setAiLoadingText(message) { if (aiLoadingIndicatorElem) { const textElement = aiLoadingIndicatorElem.querySelector('.text'); if (textElement) { textElement.textContent = (message || 'AI 正在思考...') + ' '; const dots = document.createElement('span'); dots.className = 'dot-flashing'; textElement.appendChild(dots); } } }
 export function showAiError(message) { if (aiErrorBoxElem) { const textElement = aiErrorBoxElem.querySelector('.text') || aiErrorBoxElem; textElement.textContent = message; aiErrorBoxElem.style.display = 'flex'; if (chatMessagesElem) { const latestUserPrompt = chatMessagesElem.querySelector('.latest-user-prompt'); if (latestUserPrompt && latestUserPrompt.nextSibling) { chatMessagesElem.insertBefore(aiErrorBoxElem, latestUserPrompt.nextSibling); } else if (latestUserPrompt) { chatMessagesElem.appendChild(aiErrorBoxElem); } else { chatMessagesElem.appendChild(aiErrorBoxElem); } aiErrorBoxElem.scrollIntoView({ behavior: "smooth", block: "end" }); } } }
 export function hideAiError() { if(aiErrorBoxElem) aiErrorBoxElem.style.display = 'none'; }
 export function showManualLoading(show) { if (loadingIndicatorManualElem) loadingIndicatorManualElem.style.display = show ? 'block' : 'none'; }
@@ -0,0 +1,139 @@
+# stream_json.py
+"""
+从AI的流式输出中增量解析芯片JSON。
+
+AI 逐个 token 地返回形如 {"nodes": [...], "edges": [...]} 的文本（可能包在 ```json 代码块里），
+ChipStreamParser 每收到一段文本就向前扫描，nodes / edges 数组中的某个元素一闭合就立即解析并返回，
+不必等整个回复结束。扫描是单遍的，已经处理过的文本会被丢弃，总开销与回复长度成线性关系。
+"""
+import json
+
+TRACKED_ARRAYS = {"nodes": "node", "edges": "edge"}
+
+
+class ChipStreamParser:
+    def __init__(self):
+        self._buffer = ""        # 尚未完全处理的文本（从当前元素的开头算起）
+        self._pos = 0            # 下一个要扫描的字符在 _buffer 中的位置
+        self._depth = 0          # 当前括号嵌套深度；根对象内部为 1
+        self._in_string = False
+        self._escaped = False
+        self._string_start = None
+        self._last_key = None    # 根对象中最近一个字符串（遇到 '[' 时就是数组的键名）
+        self._array = None       # 当前所在的被跟踪数组："nodes" / "edges" / None
+        self._element_start = None
+        self._finished = False
+        self.nodes = []
+        self.edges = []
+        self.errors = 0
+
+    @property
+    def finished(self):
+        """根对象已经闭合。"""
+        return self._finished
+
+    def feed(self, text):
+        """追加一段文本，返回这段文本中新闭合的元素列表 [("node" | "edge", dict), ...]。"""
+        if self._finished or not text:
+            return []
+        self._buffer += text
+        completed = []
+        buffer = self._buffer
+        i = self._pos
+        length = len(buffer)
+        while i < length:
+            ch = buffer[i]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == '\\':
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._depth == 1 and self._string_start is not None:
+                        self._last_key = buffer[self._string_start + 1:i]
+                    self._string_start = None
+            elif self._depth == 0:
+                # 根对象之前的内容（代码块标记、说明文字）全部跳过
+                if ch == '{':
+                    self._depth = 1
+            elif ch == '"':
+                self._in_string = True
+                self._string_start = i
+            elif ch == '{' or ch == '[':
+                if self._depth == 1 and ch == '[':
+                    self._array = self._last_key if self._last_key in TRACKED_ARRAYS else None
+                elif self._depth == 2 and self._array is not None:
+                    self._element_start = i
+                self._depth += 1
+            elif ch == '}' or ch == ']':
+                self._depth -= 1
+                if self._depth == 2 and self._element_start is not None:
+                    element = self._decode(buffer[self._element_start:i + 1])
+                    if element is not None:
+                        kind = TRACKED_ARRAYS[self._array]
+                        (self.nodes if kind == "node" else self.edges).append(element)
+                        completed.append((kind, element))
+                    self._element_start = None
+                elif self._depth == 1:
+                    self._array = None
+                elif self._depth == 0:
+                    self._finished = True
+                    i += 1
+                    break
+            i += 1
+        # 丢弃已经处理完的文本，只保留未闭合元素（或未闭合字符串）的开头
+        keep_from = i
+        if self._element_start is not None:
+            keep_from = self._element_start
+        elif self._string_start is not None:
+            keep_from = self._string_start
+        self._buffer = buffer[keep_from:]
+        self._pos = i - keep_from
+        if self._element_start is not None:
+            self._element_start -= keep_from
+        if self._string_start is not None:
+            self._string_start -= keep_from
+        return completed
+
+    def _decode(self, text):
+        try:
+            element = json.loads(text)
+        except json.JSONDecodeError:
+            self.errors += 1
+            return None
+        return element if isinstance(element, dict) else None
+
+    def chip_data(self):
+        """目前已解析出的芯片；端点尚未出现的边会被过滤掉，保证可以直接渲染。"""
+        node_ids = {node.get("id") for node in self.nodes}
+        edges = [edge for edge in self.edges if edge.get("from_node") in node_ids and edge.get("to_node") in node_ids]
+        return {"nodes": list(self.nodes), "edges": edges}
+
+
+def extract_json_text(raw_text):
+    """从完整的AI回复中取出JSON对象文本（去掉 ```json 代码块标记和前后多余内容），找不到时返回 None。"""
+    candidate = raw_text.strip()
+    if candidate.startswith("```json"):
+        candidate = candidate[7:].strip()
+    if candidate.endswith("```"):
+        candidate = candidate[:-3].strip()
+    first_brace = candidate.find('{')
+    last_brace = candidate.rfind('}')
+    if first_brace != -1 and last_brace != -1 and first_brace < last_brace:
+        return candidate[first_brace: last_brace + 1]
+    return None
+
+
+class StreamMeta:
+    """
+    夹在AI文本块之间传递的元信息，不属于回复文本：上游流结束时附带实际模型和 token 用量，
+    生成结果缓存在回放/合并时附带结果来源（source）。消费方把各条的 fields 合并起来即可。
+    """
+    __slots__ = ("fields",)
+
+    def __init__(self, **fields):
+        self.fields = fields
+
+    def __repr__(self):
+        return f"StreamMeta({self.fields!r})"
@@ -1,6 +1,12 @@
 import json
 import os
 
+from sqlalchemy import inspect as sa_inspect, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError, OperationalError, SQLAlchemyError
+
+from models import db, UserAccount, UserApiKey
+
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 INSTANCE_FOLDER_PATH = os.path.join(BASE_DIR, '..', 'instance')
 if not os.path.exists(INSTANCE_FOLDER_PATH):
@@ -35,47 +41,104 @@ def save_json(filepath, data):
         return False
 
 
-def load_users():
-    return load_json(USERS_FILE)
+def get_user_record(username):
+    """按用户名查询注册用户（唯一索引），不存在时返回 None。"""
+    if not username:
+        return None
+    return db.session.execute(db.select(UserAccount).filter_by(username=username)).scalar_one_or_none()
 
 
-def save_users(users):
-    return save_json(USERS_FILE, users)
+def create_user(username, password_hash):
+    """新建用户。用户名已被占用时返回 False（多个进程并发注册同名用户时由唯一索引兜底）。"""
+    db.session.add(UserAccount(username=username, password_hash=password_hash))
+    try:
+        db.session.commit()
+        return True
+    except IntegrityError:
+        db.session.rollback()
+        return False
+    except SQLAlchemyError:
+        db.session.rollback()
+        raise
 
 
 def save_api_key_for_user(username, api_key):
-    keys_data = load_json(API_KEY_STORE_FILE)
-    keys_data[username] = api_key
-    if save_json(API_KEY_STORE_FILE, keys_data):
+    try:
+        db.session.merge(UserApiKey(username=username, api_key=api_key))
+        db.session.commit()
         print(f"用户 '{username}' 的 API Key 已保存。")
         return True
-    return False
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        print(f"错误: 保存用户 '{username}' 的 API Key 失败: {e}")
+        return False
 
 
 def get_api_key_for_user(username):
-    keys_data = load_json(API_KEY_STORE_FILE)
-    return keys_data.get(username)
-
-
-def get_visit_count():
-    if not os.path.exists(VISIT_COUNT_FILE):
-        return 0
-    try:
-        with open(VISIT_COUNT_FILE, 'r') as f:
-            count_str = f.read().strip()
-            return int(count_str) if count_str.isdigit() else 0
-    except Exception as e:
-        print(f"错误：读取访问次数文件 '{VISIT_COUNT_FILE}' 失败: {e}")
-        return 0
-
-
-def increment_and_get_visit_count():
-    count = get_visit_count()
-    count += 1
-    try:
-        with open(VISIT_COUNT_FILE, 'w') as f:
-            f.write(str(count))
-        return count
-    except Exception as e:
-        print(f"错误：写入访问次数文件 '{VISIT_COUNT_FILE}' 失败: {e}")
-        return count - 1
+    if not username:
+        return None
+    record = db.session.get(UserApiKey, username)
+    return record.api_key if record else None
+
+
+def migrate_json_user_stores():
+    """
+    一次性把 users.json / api_keys.json 导入数据库，成功后把文件重命名为 *.migrated。
+    已存在的用户名会被跳过（INSERT OR IGNORE），多个进程同时执行也是安全的。
+    """
+    for filepath, model, to_row in (
+        (USERS_FILE, UserAccount, lambda key, value: {"username": value.get("username", key), "password_hash": value["password_hash"]}),
+        (API_KEY_STORE_FILE, UserApiKey, lambda key, value: {"username": key, "api_key": value}),
+    ):
+        if not os.path.exists(filepath):
+            continue
+        data = load_json(filepath)
+        rows = []
+        for key, value in data.items():
+            try:
+                rows.append(to_row(key, value))
+            except (KeyError, AttributeError, TypeError):
+                print(f"迁移 {filepath}: 跳过格式错误的条目 {key!r}")
+        try:
+            if rows:
+                db.session.execute(sqlite_insert(model).prefix_with("OR IGNORE"), rows)
+            db.session.commit()
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            print(f"错误: 迁移 {filepath} 失败，下次启动时重试: {e}")
+            continue
+        try:
+            os.replace(filepath, f"{filepath}.migrated")
+        except FileNotFoundError:
+            pass  # 另一个进程已经完成了迁移
+        print(f"已将 {filepath} 中的 {len(rows)} 条记录迁移到数据库。")
+
+
+def ensure_schema_columns():
+    """
+    为已存在的旧表补上模型中新增的列和索引（create_all 只建新表，不会修改已有的表）。
+    新增的列必须允许为空；多个进程同时启动时，重复添加的报错直接忽略。
+    """
+    inspector = sa_inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            try:
+                with db.engine.begin() as conn:
+                    conn.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'))
+                print(f"数据库表 {table.name} 已添加列 {column.name}。")
+            except OperationalError as e:
+                if 'duplicate column' not in str(e).lower():
+                    raise
+        for index in table.indexes:
+            try:
+                index.create(db.engine, checkfirst=True)
+            except OperationalError as e:
+                if 'already exists' not in str(e).lower():
+                    raise